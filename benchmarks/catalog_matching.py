@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/catalog_matching.py
+Brett Stevenson (c) 2018
+
+Compares the match rate and latency of resolving video titles with the
+iTunes API, the local catalog and the catalog with the API as a fallback.
+The songs and titles are generated, with the titles decorated, misspelled
+and reordered the way YouTube titles are. The API is a local stand-in
+which returns the first song containing every keyword after a delay.
+  $ python benchmarks/catalog_matching.py --songs 50000 --titles 1000 --latency 150
+"""
+
+import os, sys, time, random, argparse, tempfile
+from types import SimpleNamespace
+from collections import defaultdict
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yt2mp3 import cache, catalog, throttle, video
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ra', 'ne', 'so', 'ti', 'ven', 'dor', 'la', 'shi', 'mon', 'ar', 'el', 'qu', 'zen')
+# The words of titles of songs which aren't in the catalog
+OTHER_WORDS = ('guitar', 'lesson', 'cover', 'tutorial', 'piano', 'reaction', 'unboxing', 'vlog', 'drum',
+               'remix', 'karaoke', 'acoustic', 'session', 'review', 'podcast', 'highlights')
+TEMPLATES = ('{artist} - {track}', '{artist} - {track} (Official Video)', '{track} by {artist} [HD]',
+             '{artist} "{track}" Lyrics', '{track} - {artist} (Audio)', '{artist} - {track} ft. Someone')
+
+
+def make_words(count, rng):
+  words = set()
+  while len(words) < count:
+    words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+  return sorted(words)
+
+
+def make_songs(count, words, rng):
+  songs, seen = list(), set()
+  # Common words appear in many more songs than rare ones
+  weights = [1/(rank+1) for rank in range(len(words))]
+  while len(songs) < count:
+    artist = ' '.join(rng.choices(words, weights, k=2)).title()
+    track = ' '.join(rng.choices(words, weights, k=rng.randint(1, 4))).title()
+    if (artist, track) in seen:
+      continue
+    seen.add((artist, track))
+    songs.append({'track_id': len(songs)+1, 'track_name': track, 'artist_name': artist,
+                  'collection_name': track+' - Single', 'artwork_url_100': 'https://example.com/100x100bb.jpg'})
+  return songs
+
+
+def misspell(word, rng):
+  i = rng.randrange(len(word))
+  return word[:i]+word[i+1:] if len(word) > 4 else word
+
+
+def make_titles(songs, count, rng, typos=0.2, unknown=0.1):
+  """
+  Generates YouTube-style titles for a sample of the songs
+  Returns:
+    A list of tuples of a title and the ID of its song, or None for titles
+    of songs which aren't in the catalog
+  """
+  titles = list()
+  for _ in range(count):
+    if rng.random() < unknown:
+      titles.append((' '.join(rng.sample(OTHER_WORDS, 4)).title(), None))
+      continue
+    song = rng.choice(songs)
+    track = song['track_name']
+    if rng.random() < typos:
+      words = track.split()
+      i = rng.randrange(len(words))
+      words[i] = misspell(words[i], rng)
+      track = ' '.join(words)
+    title = rng.choice(TEMPLATES).format(artist=song['artist_name'], track=track)
+    titles.append((title.lower() if rng.random() < 0.3 else title, song['track_id']))
+  return titles
+
+
+class RemoteSearch():
+  """
+  Stands in for the iTunes search API, returning the first song containing
+  every keyword
+  """
+  def __init__(self, songs, latency):
+    self.songs = songs
+    self.latency = latency
+    self.calls = 0
+    self.index = defaultdict(set)
+    for i, song in enumerate(songs):
+      for word in catalog.tokenize(song['track_name']+' '+song['artist_name']):
+        self.index[word].add(i)
+
+
+  def __call__(self, term, **kwargs):
+    self.calls += 1
+    time.sleep(self.latency)
+    words = catalog.tokenize(term)
+    matches = set.intersection(*[self.index.get(word, set()) for word in words]) if words else set()
+    if not matches:
+      raise LookupError('No results found with the keyword '+term)
+    return [SimpleNamespace(**self.songs[min(matches)])]
+
+
+def measure(titles, remote):
+  """
+  Resolves each title with video.get_data
+  Returns:
+    A tuple of the match rate, the median and 95th percentile latencies in
+    ms, and the number of API requests per title
+  """
+  calls = remote.calls
+  latencies, correct = list(), 0
+  for title, track_id in titles:
+    start = time.perf_counter()
+    result = video.get_data(title)
+    latencies.append((time.perf_counter()-start)*1000)
+    if getattr(result, 'track_id', None) == track_id:
+      correct += 1
+  latencies.sort()
+  return (correct/len(titles), latencies[len(latencies)//2],
+          latencies[int(len(latencies)*0.95)], (remote.calls-calls)/len(titles))
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Compare matching video titles locally and with the iTunes API')
+  parser.add_argument('--songs', type=int, default=20000, help='the number of songs in the catalog')
+  parser.add_argument('--titles', type=int, default=500, help='the number of titles resolved')
+  parser.add_argument('--latency', type=float, default=150, help='the delay of each API request, in ms')
+  parser.add_argument('--words', type=int, default=5000, help='the number of distinct words in the songs')
+  parser.add_argument('--seed', type=int, default=1, help='the seed of the generated songs and titles')
+  args = parser.parse_args(args)
+  rng = random.Random(args.seed)
+  songs = make_songs(args.songs, make_words(args.words, rng), rng)
+  titles = make_titles(songs, args.titles, rng)
+  remote = RemoteSearch(songs, args.latency/1000)
+  with tempfile.TemporaryDirectory() as temp, \
+       mock.patch('itunespy.search', remote), \
+       mock.patch.object(cache, 'enabled', False), \
+       mock.patch.object(cache, 'directory', temp), \
+       mock.patch.dict(throttle.RATES, clear=True), \
+       mock.patch.object(throttle, '_hosts', dict()), \
+       mock.patch.object(catalog, '_catalog', None):
+    start = time.perf_counter()
+    catalog.get_catalog(create=True).add(songs)
+    print('Imported %s songs in %.2f s' % (args.songs, time.perf_counter()-start))
+    print('%-18s %8s %10s %10s %14s' % ('path', 'matched', 'p50 (ms)', 'p95 (ms)', 'requests/title'))
+    # Keep the songs resolved by the API out of the catalog between paths
+    with mock.patch.object(catalog.Catalog, 'add'):
+      for name, enabled, threshold in (('api', False, 0), ('catalog', True, 0),
+                                       ('catalog+api', True, catalog.MATCH_THRESHOLD)):
+        with mock.patch.object(catalog, 'enabled', enabled), \
+             mock.patch.object(catalog, 'MATCH_THRESHOLD', threshold):
+          rate, p50, p95, calls = measure(titles, remote)
+        print('%-18s %7.1f%% %10.3f %10.3f %14.2f' % (name, rate*100, p50, p95, calls))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/http_handshakes.py
+Brett Stevenson (c) 2018
+
+Compares the number of TLS handshakes and the time per track of the
+previous per-request connections against the pooled HTTP session, using a
+local HTTPS server in place of YouTube and the iTunes artwork host.
+Requires the openssl command to generate a self-signed certificate.
+  $ python benchmarks/http_handshakes.py --tracks 50
+"""
+
+import os, sys, ssl, time, argparse, tempfile, threading, subprocess, requests
+from urllib.request import Request, urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yt2mp3 import net
+
+# The requests made for each track: search results, watch page and artwork
+PAGES = ('/results?search_query=track', '/watch?v=hMr3KtYUCcI', '/image/480x480bb.jpg')
+
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one write to avoid delayed ACK stalls
+  wbufsize = 64*1024
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    body = b'x'*16*1024
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class Server(ThreadingHTTPServer):
+  """
+  An HTTPS server which counts the handshakes of accepted connections
+  """
+  daemon_threads = True
+  handshakes = 0
+
+  def get_request(self):
+    request = super().get_request()
+    self.handshakes += 1
+    return request
+
+
+def start_server(cert, key):
+  server = Server(('localhost', 0), Handler)
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.load_cert_chain(cert, key)
+  server.socket = context.wrap_socket(server.socket, server_side=True)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def make_cert(directory):
+  cert = os.path.join(directory, 'cert.pem')
+  key = os.path.join(directory, 'key.pem')
+  subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                         '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost',
+                         '-addext', 'subjectAltName=DNS:localhost'],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return cert, key
+
+
+def unpooled(base, cert):
+  """
+  Requests the pages of a track the way the program previously did
+  """
+  for page in PAGES[:2]:
+    req = Request(base+page, headers={'User-Agent':'Mozilla/5.0'})
+    urlopen(req, context=ssl.create_default_context(cafile=cert)).read()
+  requests.get(base+PAGES[2], verify=cert).content
+
+
+def pooled(base, cert):
+  """
+  Requests the pages of a track using the shared HTTP session
+  """
+  for page in PAGES:
+    net.get(base+page).content
+
+
+def measure(func, server, base, cert, tracks):
+  server.handshakes = 0
+  start = time.perf_counter()
+  for _ in range(tracks):
+    func(base, cert)
+  elapsed = time.perf_counter()-start
+  return server.handshakes/tracks, elapsed*1000/tracks
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Count the TLS handshakes made per track')
+  parser.add_argument('--tracks', type=int, default=50, help='the number of tracks to simulate')
+  args = parser.parse_args(args)
+  with tempfile.TemporaryDirectory() as temp:
+    cert, key = make_cert(temp)
+    net.CA_BUNDLE = cert
+    server = start_server(cert, key)
+    base = 'https://localhost:%s' % server.server_address[1]
+    for name, func in (('unpooled', unpooled), ('pooled', pooled)):
+      handshakes, ms = measure(func, server, base, cert, args.tracks)
+      print('%-9s %5.2f handshakes/track   %7.2f ms/track' % (name, handshakes, ms))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
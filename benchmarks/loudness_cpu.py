@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/loudness_cpu.py
+Brett Stevenson (c) 2018
+
+Compares the time of measuring the loudness of streamed audio with the
+NumPy meter against a pure-Python loop which filters every sample with the
+K-weighting biquads, and against the time of the transcode the meter
+observes. The synthetic source is a sweep of tones over noise whose level
+changes every few seconds, so the gates have something to remove.
+  $ python benchmarks/loudness_cpu.py --minutes 4 --python-seconds 20
+"""
+
+import os, sys, math, time, wave, array, random, argparse, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yt2mp3 import loudness, transcode
+
+
+def make_pcm(seconds, rate=44100):
+  """
+  Generates interleaved stereo 16-bit samples
+  """
+  rand = random.Random(0)
+  samples = array.array('h')
+  for second in range(int(seconds)):
+    level = (0.05, 0.3, 0.6, 0.01)[second//3 % 4]
+    freq = 100*2**(second % 7)
+    for i in range(rate):
+      value = level*(0.7*math.sin(2*math.pi*freq*i/rate)+0.3*rand.uniform(-1, 1))
+      samples.append(int(value*32767))
+      samples.append(int(value*0.8*32767))
+  return samples.tobytes()
+
+
+def measure_python(pcm, rate=44100, channels=2):
+  """
+  Measures the loudness by filtering each sample in turn
+  """
+  filters = loudness.get_filters(rate)
+  samples = array.array('h')
+  samples.frombytes(pcm)
+  size = int(round(rate*loudness.STEP))
+  powers, peak = list(), 0
+  for channel in range(channels):
+    states = [[0.0, 0.0] for _ in filters]
+    total, channel_powers = 0.0, list()
+    for n, sample in enumerate(samples[channel::channels]):
+      peak = max(peak, abs(sample))
+      x = sample/32768.0
+      # Direct form II transposed biquads
+      for (b, a), state in zip(filters, states):
+        y = b[0]*x+state[0]
+        state[0] = b[1]*x-a[1]*y+state[1]
+        state[1] = b[2]*x-a[2]*y
+        x = y
+      total += x*x
+      if (n+1) % size == 0:
+        channel_powers.append(total/size)
+        total = 0.0
+    powers = [p+q for p, q in zip(powers, channel_powers)] if powers else channel_powers
+  return {'loudness': loudness.integrate(powers), 'peak': peak/32768.0}
+
+
+def measure_numpy(pcm, rate=44100, channels=2):
+  """
+  Measures the loudness by passing the samples to the meter in the chunks
+  the converter streams
+  """
+  meter = loudness.Meter(rate, channels)
+  for i in range(0, len(pcm), transcode.CHUNK_SIZE):
+    meter(pcm[i:i+transcode.CHUNK_SIZE])
+  return meter.result()
+
+
+def timed(func, *args, **kwargs):
+  start = time.perf_counter()
+  result = func(*args, **kwargs)
+  return result, time.perf_counter()-start
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Compare the NumPy loudness meter with a pure-Python loop')
+  parser.add_argument('--minutes', type=float, default=4, help='the length of the audio measured by the meter')
+  parser.add_argument('--python-seconds', type=float, default=20, help='the length measured by the pure-Python loop')
+  args = parser.parse_args(args)
+  pcm = make_pcm(args.minutes*60)
+  short = pcm[:int(args.python_seconds*44100)*4]
+  print('%-28s %12s %14s %10s' % ('method', 'time (s)', 's per minute', 'LUFS'))
+  python, python_time = timed(measure_python, short)
+  reference, _ = timed(measure_numpy, short)
+  print('%-28s %12.3f %14.4f %10.2f' % ('pure Python (%ss)' % args.python_seconds, python_time,
+                                       python_time/args.python_seconds*60, python['loudness']))
+  print('%-28s %12s %14s %10.2f' % ('numpy (same %ss)' % args.python_seconds, '', '', reference['loudness']))
+  result, numpy_time = timed(measure_numpy, pcm)
+  print('%-28s %12.3f %14.4f %10.2f' % ('numpy (%sm)' % args.minutes, numpy_time,
+                                       numpy_time/args.minutes, result['loudness']))
+  print('speedup: %.0fx' % ((python_time/args.python_seconds)/(numpy_time/(args.minutes*60))))
+  with tempfile.TemporaryDirectory() as temp:
+    source = os.path.join(temp, 'source.wav')
+    with wave.open(source, 'wb') as f:
+      f.setnchannels(2)
+      f.setsampwidth(2)
+      f.setframerate(44100)
+      f.writeframes(pcm)
+    output = os.path.join(temp, 'output.mp3')
+    _, plain = timed(transcode.stream, source, output)
+    _, metered = timed(transcode.stream, source, output, observers=[loudness.Meter()])
+  print('transcode: %.2fs, with the meter: %.2fs (%.1f%% of the transcode)' %
+        (plain, metered, numpy_time/plain*100))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
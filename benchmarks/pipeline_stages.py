@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/pipeline_stages.py
+Brett Stevenson (c) 2018
+
+Measures the latency and throughput of each stage of converting a song,
+without a network. The iTunes API, youtube_dl and the YouTube results page
+are replaced by local stand-ins serving the recorded responses in
+benchmarks/fixtures after a configurable delay, and downloads are served
+from generated audio.
+  $ python benchmarks/pipeline_stages.py --runs 10 --latency 50 --save
+  $ python benchmarks/pipeline_stages.py --runs 10 --latency 50
+The first command stores a baseline, and the second flags the stages which
+have slowed down since, exiting with a non-zero status.
+"""
+
+import os, io, sys, json, math, time, wave, array, shutil, argparse, tempfile, contextlib
+from collections import defaultdict
+from unittest import mock
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yt2mp3 import artwork, cache, library, net, throttle, util, video
+from yt2mp3.song import Song
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+QUERY = {'track_name': 'Have a Cigar', 'artist_name': 'Pink Floyd'}
+
+
+class Backends():
+  """
+  A class used to represent the local stand-ins for the network services
+  ...
+  Attributes
+  ----------
+  fixtures : str
+    The directory of the recorded responses
+  latency : float
+    The number of seconds each request is delayed by
+  audio : str
+    The path of the audio file served for each download
+  calls : dict
+    The number of requests made to each service
+  """
+  def __init__(self, fixtures, latency, audio):
+    self.latency = latency
+    self.audio = audio
+    self.calls = defaultdict(int)
+    with open(os.path.join(fixtures, 'itunes_tracks.json'), encoding='utf-8') as f:
+      self.tracks = json.load(f)
+    with open(os.path.join(fixtures, 'video_info.json'), encoding='utf-8') as f:
+      self.videos = json.load(f)
+    with open(os.path.join(fixtures, 'results_page.html'), 'rb') as f:
+      self.results_page = f.read()
+    output = io.BytesIO()
+    Image.new('RGB', (600, 600), (200, 40, 40)).save(output, format='PNG')
+    self.artwork = output.getvalue()
+
+
+  def request(self, service):
+    self.calls[service] += 1
+    time.sleep(self.latency)
+
+
+  def search_track(self, term, **kwargs):
+    self.request('itunes')
+    words = term.lower().split()
+    return [Track(track) for track in self.tracks if all(w in track['track_name'].lower() for w in words)]
+
+
+  def search(self, term, **kwargs):
+    self.request('itunes')
+    words = term.lower().split()
+    matches = [Track(track) for track in self.tracks
+               if all(w in (track['track_name']+' '+track['artist_name']).lower() for w in words)]
+    if not matches:
+      raise LookupError('No results found with the keyword '+term)
+    return matches
+
+
+  def get(self, url, **kwargs):
+    self.request('youtube' if 'youtube.com' in url else 'artwork')
+    content = self.results_page if 'youtube.com/results' in url else self.artwork
+    return mock.Mock(content=content, status_code=200)
+
+
+  def youtube_dl(self, params=None):
+    backends = self
+
+    class YoutubeDL():
+      def __init__(self, params=None):
+        self.params = params or {}
+
+      def __enter__(self):
+        return self
+
+      def __exit__(self, *exc):
+        pass
+
+      def extract_info(self, url, download=True, process=True, ie_key=None):
+        backends.request('youtube_dl')
+        return json.loads(json.dumps(backends.videos[video.get_id(url)]))
+
+      def process_ie_result(self, info, download=True):
+        backends.request('youtube_dl')
+        best = max(info['formats'], key=lambda f: f.get('abr') or 0)
+        info.update(best)
+        if download:
+          shutil.copyfile(backends.audio, self.params['outtmpl'] % info)
+        return info
+
+    return YoutubeDL(params)
+
+
+  @contextlib.contextmanager
+  def install(self, directory):
+    """
+    Replaces the network services, caches and output directory for the
+    duration of the context
+    Args:
+      directory: A temporary directory for the downloads, output and caches
+    """
+    with contextlib.ExitStack() as stack:
+      stack.enter_context(mock.patch.dict(os.environ, HOME=directory))
+      stack.enter_context(mock.patch('itunespy.search_track', self.search_track))
+      stack.enter_context(mock.patch('itunespy.search', self.search))
+      stack.enter_context(mock.patch('youtube_dl.YoutubeDL', self.youtube_dl))
+      stack.enter_context(mock.patch.object(net, 'get', self.get))
+      stack.enter_context(mock.patch.object(cache, 'enabled', False))
+      stack.enter_context(mock.patch.object(cache, 'directory', directory))
+      stack.enter_context(mock.patch.object(library, 'directory', os.path.join(directory, 'Music')))
+      stack.enter_context(mock.patch.object(library, '_library', None))
+      # Measure the stages rather than the rate limits of the real services
+      stack.enter_context(mock.patch.dict(throttle.RATES, clear=True))
+      stack.enter_context(mock.patch.object(throttle, '_hosts', dict()))
+      yield self
+
+
+class Track():
+  """
+  Stands in for an itunespy track result
+  """
+  def __init__(self, data):
+    self.__dict__.update(data)
+
+
+def make_audio(path, seconds, rate=44100):
+  """
+  Writes a stereo sine wave of the specified length, one second at a time
+  """
+  period = [int(8000*math.sin(2*math.pi*440*i/rate)) for i in range(rate)]
+  second = array.array('h', [s for s in period for _ in range(2)]).tobytes()
+  with wave.open(path, 'wb') as f:
+    f.setnchannels(2)
+    f.setsampwidth(2)
+    f.setframerate(rate)
+    for _ in range(int(seconds)):
+      f.writeframes(second)
+  return path
+
+
+def reset():
+  """
+  Drops the results memoized in-process, so each run repeats the work
+  """
+  video._info.clear()
+  artwork._memo.clear()
+
+
+def run_stages(runs):
+  """
+  Runs each stage of the conversion of a song the specified number of times
+  Returns:
+    A dict of the latencies of each stage, in seconds
+  """
+  timings = defaultdict(list)
+  def timed(stage, func, *args):
+    reset()
+    start = time.perf_counter()
+    result = func(*args)
+    timings[stage].append(time.perf_counter()-start)
+    return result
+  for _ in range(runs):
+    data = timed('get_song_data', util.get_song_data, defaultdict(str, QUERY), False, False)
+    timed('get_url', video.get_url, data)
+    song = Song(data)
+    path = timed('download', song.download)
+    mp3 = timed('convert_to_mp3', song.convert_to_mp3, path)
+    timed('set_id3', song.set_id3, mp3)
+    os.remove(path)
+    os.remove(mp3)
+  return timings
+
+
+def percentile(values, percent):
+  values = sorted(values)
+  return values[min(len(values)-1, int(round(percent/100*(len(values)-1))))]
+
+
+def summarize(timings):
+  """
+  Summarizes the latencies of each stage
+  Returns:
+    A dict of the median and 95th percentile latencies, in ms, and the
+    throughput, in songs per second, of each stage
+  """
+  return {stage: {'p50': round(percentile(values, 50)*1000, 2),
+                  'p95': round(percentile(values, 95)*1000, 2),
+                  'throughput': round(len(values)/sum(values), 2)}
+          for stage, values in timings.items()}
+
+
+def compare(results, baseline, tolerance):
+  """
+  Finds the stages with a median latency above the baseline's
+  Returns:
+    A list of the names of the stages which have regressed
+  """
+  return [stage for stage, result in results.items()
+          if stage in baseline and result['p50'] > baseline[stage]['p50']*(1+tolerance)]
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Measure each conversion stage against local stand-ins')
+  parser.add_argument('--runs', type=int, default=5, help='the number of songs converted')
+  parser.add_argument('--latency', type=float, default=50, help='the delay of each request, in ms')
+  parser.add_argument('--seconds', type=float, default=30, help='the length of the generated audio')
+  parser.add_argument('--fixtures', default=FIXTURES, help='the directory of the recorded responses')
+  parser.add_argument('--baseline', default=BASELINE, help='the file the baseline is stored in')
+  parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='the slowdown allowed before flagging a stage')
+  args = parser.parse_args(args)
+  settings = {'runs': args.runs, 'latency': args.latency, 'seconds': args.seconds}
+  with tempfile.TemporaryDirectory() as temp:
+    audio = make_audio(os.path.join(temp, 'source.wav'), args.seconds)
+    backends = Backends(args.fixtures, args.latency/1000, audio)
+    with backends.install(temp):
+      results = summarize(run_stages(args.runs))
+  baseline = None
+  if not args.save and os.path.exists(args.baseline):
+    with open(args.baseline, encoding='utf-8') as f:
+      baseline = json.load(f)
+    if baseline['settings'] != settings:
+      print('Baseline recorded with different settings: %s' % baseline['settings'])
+  regressions = compare(results, baseline['stages'], args.tolerance) if baseline else []
+  print('%-16s %10s %10s %12s' % ('stage', 'p50 (ms)', 'p95 (ms)', 'songs/s'))
+  for stage, result in results.items():
+    flag = '  REGRESSION (baseline %.2f ms)' % baseline['stages'][stage]['p50'] if stage in regressions else ''
+    print('%-16s %10.2f %10.2f %12.2f%s' % (stage, result['p50'], result['p95'], result['throughput'], flag))
+  calls = ', '.join('%s %.1f' % (service, count/args.runs) for service, count in sorted(backends.calls.items()))
+  print('Requests per song: '+calls)
+  if args.save:
+    with open(args.baseline, 'w', encoding='utf-8') as f:
+      json.dump({'settings': settings, 'stages': results}, f, indent=2)
+    print('Saved the baseline to '+args.baseline)
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/remux_cpu.py
+Brett Stevenson (c) 2018
+
+Compares the CPU time of copying the audio of a download into the output
+format against re-encoding it. Synthetic AAC and Opus sources stand in for
+the formats YouTube serves, and each is remuxed into its own format and
+transcoded into its own format and MP3.
+  $ python benchmarks/remux_cpu.py --minutes 10
+"""
+
+import os, sys, math, time, wave, array, argparse, resource, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yt2mp3 import transcode
+
+# The download each output format is copied from
+SOURCES = {'m4a': 'source.m4a', 'opus': 'source.opus'}
+
+
+def make_source(path, minutes, rate=44100):
+  """
+  Writes a stereo sine wave of the specified length, one second at a time
+  """
+  period = [int(8000*math.sin(2*math.pi*440*i/rate)) for i in range(rate)]
+  second = array.array('h', [s for s in period for _ in range(2)]).tobytes()
+  with wave.open(path, 'wb') as f:
+    f.setnchannels(2)
+    f.setsampwidth(2)
+    f.setframerate(rate)
+    for _ in range(int(minutes*60)):
+      f.writeframes(second)
+  return path
+
+
+def measure(func, *args):
+  """
+  Runs a conversion, whose work is done by converter processes
+  Returns:
+    A tuple of the CPU and wall time of the conversion, in seconds
+  """
+  before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  start = time.perf_counter()
+  func(*args)
+  wall = time.perf_counter()-start
+  after = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return (after.ru_utime-before.ru_utime)+(after.ru_stime-before.ru_stime), wall
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Compare the CPU time of remuxing and transcoding')
+  parser.add_argument('--minutes', type=float, default=5, help='the length of the synthetic sources')
+  args = parser.parse_args(args)
+  with tempfile.TemporaryDirectory() as temp:
+    wav = make_source(os.path.join(temp, 'source.wav'), args.minutes)
+    print('%-6s %-6s %-10s %10s %10s %10s' % ('source', 'output', 'mode', 'cpu (s)', 'wall (s)', 'size (MB)'))
+    for format, name in SOURCES.items():
+      source = transcode.stream(wav, os.path.join(temp, name), transcode.FORMATS[format][1])
+      codec = transcode.get_codec(source)
+      runs = [(format, 'remux', transcode.remux, transcode.FORMATS[format][1]),
+              (format, 'transcode', transcode.stream, transcode.FORMATS[format][1]),
+              ('mp3', 'transcode', transcode.stream, 'mp3')]
+      for output, mode, func, muxer in runs:
+        path = os.path.join(temp, 'output'+transcode.FORMATS[output][0])
+        cpu, wall = measure(func, source, path, output if mode == 'remux' else muxer)
+        size = os.path.getsize(path)/(1024*1024)
+        print('%-6s %-6s %-10s %10.2f %10.2f %10.1f' % (codec, output, mode, cpu, wall, size))
+        os.remove(path)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/startup_time.py
+Brett Stevenson (c) 2018
+
+Reports the modules imported by the CLI for `--version`, URL mode and
+playlist mode, using the timings of `python -X importtime`. Network access
+is blocked with an unreachable proxy, so each mode exits at its first
+request having imported everything it needs to start.
+  $ python benchmarks/startup_time.py --runs 5 --top 10
+"""
+
+import os, sys, time, argparse, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+  'version': ['--version'],
+  'url': ['-u', 'hMr3KtYUCcI', '--retries', '0', '--timeout', '1', '--no-cache'],
+  'playlist': ['-p', 'PLAYLIST', '--retries', '0', '--timeout', '1', '--no-cache'],
+}
+
+
+def parse_importtime(output):
+  """
+  Parses the output of `python -X importtime`
+  Args:
+    output: The stderr of the interpreter
+  Returns:
+    A dict of the self and cumulative import time, in ms, of each
+    top-level import, keyed by module name
+  """
+  times = dict()
+  for line in output.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    own, cumulative, name = line[len('import time:'):].split('|')
+    # Nested imports are indented beneath the module importing them
+    if name[1:3] != '  ':
+      times[name.strip()] = (int(own)/1000, int(cumulative)/1000)
+  return times
+
+
+def measure(mode):
+  """
+  Runs the CLI in a new interpreter
+  Returns:
+    A tuple of the wall time, in ms, and the parsed import times
+  """
+  with tempfile.TemporaryDirectory() as temp:
+    env = dict(os.environ, PYTHONPATH=ROOT, HOME=temp, XDG_CACHE_HOME=temp,
+               HTTP_PROXY='http://127.0.0.1:9', HTTPS_PROXY='http://127.0.0.1:9')
+    cmd = [sys.executable, '-X', 'importtime', os.path.join(ROOT, 'bin', 'yt2mp3')]+MODES[mode]
+    start = time.perf_counter()
+    result = subprocess.run(cmd, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = (time.perf_counter()-start)*1000
+  return elapsed, parse_importtime(result.stderr.decode(errors='replace'))
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Measure the import time of each CLI mode')
+  parser.add_argument('--runs', type=int, default=3, help='the number of runs of each mode, keeping the fastest')
+  parser.add_argument('--top', type=int, default=8, help='the number of slowest imports listed for each mode')
+  args = parser.parse_args(args)
+  for mode in MODES:
+    elapsed, times = min((measure(mode) for _ in range(args.runs)), key=lambda run: run[0])
+    total = sum(cumulative for _, cumulative in times.values())
+    print('%-9s wall: %7.1f ms   imports: %7.1f ms' % (mode, elapsed, total))
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    for name, (own, cumulative) in slowest:
+      print('  %-30s %7.1f ms' % (name, cumulative))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
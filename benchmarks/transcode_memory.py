@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+benchmarks/transcode_memory.py
+Brett Stevenson (c) 2018
+
+Compares the peak memory of the streaming and in-memory MP3 conversion of
+a long synthetic audio file. Each conversion runs in its own interpreter
+so the peak resident set sizes don't interfere.
+  $ python benchmarks/transcode_memory.py --minutes 60
+"""
+
+import os, sys, json, math, wave, array, argparse, tempfile, subprocess
+
+# Measures one conversion and prints its peak memory as JSON
+CHILD = '''
+import sys, json, resource, pydub
+from yt2mp3 import transcode
+source, path, mode = sys.argv[1:4]
+if mode == 'stream':
+  transcode.stream(source, path)
+else:
+  pydub.AudioSegment.from_file(source).export(path, format='mp3')
+usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+print(json.dumps({'python': usage, 'encoder': children}))
+'''
+
+
+def make_source(path, minutes, rate=44100):
+  """
+  Writes a stereo sine wave of the specified length, one second at a time
+  """
+  period = [int(8000*math.sin(2*math.pi*440*i/rate)) for i in range(rate)]
+  second = array.array('h', [s for s in period for _ in range(2)]).tobytes()
+  with wave.open(path, 'wb') as f:
+    f.setnchannels(2)
+    f.setsampwidth(2)
+    f.setframerate(rate)
+    for _ in range(int(minutes*60)):
+      f.writeframes(second)
+  return path
+
+
+def measure(source, mode):
+  """
+  Converts the source file in a new interpreter
+  Returns:
+    A dict of the peak memory, in MB, of the interpreter and its encoder
+  """
+  with tempfile.TemporaryDirectory() as temp:
+    path = os.path.join(temp, 'song.mp3')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.check_output([sys.executable, '-c', CHILD, source, path, mode], env=env)
+  usage = json.loads(output.decode())
+  # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+  scale = 1024*1024 if sys.platform == 'darwin' else 1024
+  return {key: round(val/scale, 1) for key, val in usage.items()}
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description='Compare the peak memory of MP3 conversion modes')
+  parser.add_argument('--minutes', type=float, default=30, help='the length of the synthetic source')
+  args = parser.parse_args(args)
+  with tempfile.TemporaryDirectory() as temp:
+    source = make_source(os.path.join(temp, 'source.wav'), args.minutes)
+    size = os.path.getsize(source)/(1024*1024)
+    print('Source: %.1f minutes, %.1f MB of PCM' % (args.minutes, size))
+    for mode in ('stream', 'memory'):
+      usage = measure(source, mode)
+      print('%-8s python: %8.1f MB   encoder: %8.1f MB' % (mode, usage['python'], usage['encoder']))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
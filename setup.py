@@ -31,6 +31,9 @@ setuptools.setup(
     'setuptools>=40.6.3',
     'youtube_dl>=2018.12.17',
   ],
+  extras_require={
+    'replaygain': ['numpy>=1.15'],
+  },
   classifiers = [
     'Development Status :: 4 - Beta',
     'Programming Language :: Python :: 3',
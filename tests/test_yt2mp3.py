@@ -8,11 +8,14 @@ tests/test_yt2mp3.py
 Brett Stevenson (c) 2018
 """
 
-import os, pytest
-from mutagen.id3 import ID3
+import os, io, sys, math, time, wave, struct, asyncio, operator, threading, subprocess, mutagen, pytest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, WOAS
+from PIL import Image
 from collections import defaultdict, deque
-from yt2mp3 import itunes, opts, util, video
-from yt2mp3.song import Song
+from yt2mp3 import aio, artwork, batch, cache, catalog, chapters, daemon, itunes, library, loudness, metadata, net, opts, pipeline, scratch, sources, stats, sync, throttle, transcode, util, video
+from yt2mp3.song import Song, convert_chapters
 
 @pytest.fixture
 def test_data():
@@ -30,6 +33,109 @@ def test_song():
     data['video_url'] = video.get_url(data)
     return Song(data)
 
+class FakeYoutubeDL():
+    """
+    Stands in for youtube_dl and records each video info probe
+    """
+    calls = []
+    def __init__(self, opts=None):
+        self.opts = opts
+    def extract_info(self, url, download=True, process=True):
+        FakeYoutubeDL.calls.append(url)
+        return {'id': video.get_id(url), 'title': 'Have a Cigar',
+                'duration': 308, 'formats': []}
+
+@pytest.fixture
+def info_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(FakeYoutubeDL, 'calls', [])
+    monkeypatch.setattr('youtube_dl.YoutubeDL', FakeYoutubeDL)
+    monkeypatch.setattr(video, '_info', video.OrderedDict())
+    monkeypatch.setattr(video, '_info_store', cache.Store('video_info', video.INFO_TTL, str(tmp_path)))
+    return FakeYoutubeDL.calls
+
+@pytest.fixture
+def itunes_cache(monkeypatch, tmp_path):
+    calls = []
+    def search(term, *args, **kwargs):
+        calls.append(term)
+        if term == 'nomatch':
+            raise LookupError('No results found with the keyword '+term)
+        return [term]
+    monkeypatch.setattr('itunespy.search', search)
+    monkeypatch.setattr(itunes, '_store', cache.Store('itunes', itunes.CACHE_TTL, str(tmp_path)))
+    return calls
+
+def make_image(size, format='JPEG'):
+    output = io.BytesIO()
+    Image.new('RGB', (size, size), 'purple').save(output, format=format)
+    return output.getvalue()
+
+def make_wav(path, seconds, rate=44100):
+    """
+    Writes a stereo sine wave of the specified length
+    """
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        for second in range(seconds):
+            samples = (int(8000*math.sin(2*math.pi*440*i/rate)) for i in range(rate))
+            f.writeframes(b''.join(struct.pack('<hh', s, s) for s in samples))
+    return str(path)
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """
+    Serves a short page, or an image for .jpg paths, for every request over
+    keep-alive connections
+    """
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+        body = make_image(10) if self.path.endswith('.jpg') else b'<html></html>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+
+class ThrottlingHandler(LocalHandler):
+    """
+    Responds with 429 whenever more than two requests are in progress
+    """
+    active = 0
+    lock = threading.Lock()
+    def do_GET(self):
+        with ThrottlingHandler.lock:
+            ThrottlingHandler.active += 1
+            throttled = ThrottlingHandler.active > 2
+        try:
+            time.sleep(0.02)
+            if throttled:
+                self.send_response(429)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                super().do_GET()
+        finally:
+            with ThrottlingHandler.lock:
+                ThrottlingHandler.active -= 1
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+    server.connections = []
+    get_request = server.get_request
+    def count_request():
+        request = get_request()
+        server.connections.append(request[1])
+        return request
+    server.get_request = count_request
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
 def multiple_inputs(inputs):
     """ 
     Provides a function to call for every input requested.
@@ -45,6 +151,24 @@ def test_arguments():
     assert args.resolution == 480
     assert ' '.join(args.artist) == 'pink floyd'
     assert ' '.join(args.track) == 'have a cigar'
+    assert args.jobs == 1 and args.stream
+
+# The import time allowed for `yt2mp3 --version`, in seconds
+STARTUP_BUDGET = 0.3
+
+def test_startup_time():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = [sys.executable, '-X', 'importtime', os.path.join(root, 'bin', 'yt2mp3'), '--version']
+    result = subprocess.run(cmd, env=dict(os.environ, PYTHONPATH=root),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.stdout.strip() == b'v1.2.4'
+    imports = [line.split('|') for line in result.stderr.decode().splitlines()
+               if line.startswith('import time:') and 'self [us]' not in line]
+    # Heavy dependencies should only be imported by the code paths using them
+    modules = {name.strip().split('.')[0] for _, _, name in imports}
+    assert not modules & {'youtube_dl', 'bs4', 'lxml', 'pydub', 'PIL', 'mutagen', 'requests', 'itunespy', 'cursesmenu'}
+    elapsed = sum(int(cumulative) for _, cumulative, name in imports if name[1:3] != '  ' and name.strip() != 'site')
+    assert elapsed/1e6 < STARTUP_BUDGET
 
 def test_get_song_data(test_data):
     input = defaultdict(str, {'track_name': 'Have a Cigar',
@@ -83,10 +207,118 @@ def test_itunes_data_failure():
         itunes.get_data(fail_data)
     assert err.type == SystemExit
 
+def test_itunes_cache(itunes_cache, monkeypatch):
+    assert itunes.keyword_search('Have a  Cigar') == 'Have a  Cigar'
+    assert itunes.keyword_search('have a cigar') == 'Have a  Cigar'
+    assert itunes_cache == ['Have a  Cigar']
+    # Misses should be cached as well
+    assert itunes.keyword_search('nomatch') is None
+    assert itunes.keyword_search('NoMatch') is None
+    assert itunes_cache == ['Have a  Cigar', 'nomatch']
+    monkeypatch.setattr(cache, 'enabled', False)
+    itunes.keyword_search('have a cigar')
+    assert len(itunes_cache) == 3
+
+class Result():
+    """
+    Stands in for an itunespy result
+    """
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+def test_itunes_discography(itunes_cache, monkeypatch):
+    albums = [str(i) for i in range(25)]
+    requests = []
+    def lookup(id=None, entity=None, **kwargs):
+        requests.append((id, entity))
+        if entity == 'album':
+            return [Result(kind=None)]+[Result(collection_id=int(album)) for album in albums]
+        time.sleep(0.2)
+        # Each album is followed by its tracks
+        return [result for album in id.split(',') for result in
+                [Result(collection_id=int(album))]+[Result(kind='song', collection_id=int(album), track_name=album+'-'+str(n))
+                                                     for n in range(2)]]
+    monkeypatch.setattr('itunespy.search_artist', lambda term, **kwargs: [Result(artist_id=1)])
+    monkeypatch.setattr('itunespy.lookup', lookup)
+    start = time.time()
+    songs = [song.track_name for song in itunes.get_discography('Pink Floyd')]
+    assert time.time()-start < 0.4
+    assert songs == [album+'-'+str(n) for album in albums for n in range(2)]
+    # The tracks of several albums should be retrieved by each request
+    assert [id for id, entity in requests if entity == 'song'] == [','.join(albums[i:i+10]) for i in (0, 10, 20)]
+    # The discography should be cached even when it isn't read in full
+    requests.clear()
+    assert next(itunes.get_discography('pink floyd')).track_name == '0-0'
+    assert [song.track_name for song in itunes.get_data({'artist_name': 'Pink  Floyd', 'track_name': ''})] == songs
+    assert not requests
+
+def test_cache_eviction(tmp_path):
+    store = cache.Store('test', directory=str(tmp_path), max_entries=2)
+    store.set('a', 1)
+    store.set('b', None)
+    assert store.get('a') == 1
+    store.set('c', 3)
+    assert store.get('b', 'missing') == 'missing'
+    assert store.get('a') == 1 and store.get('c') == 3
+    store.ttl = -1
+    assert store.get('a') is None
+    store.clear()
+    store.ttl = None
+    assert store.get('c') is None
+
 def test_get_video_url(test_data, test_song):
     url = video.get_url(test_data)
     assert url == test_song.video_url and video.validate_url(url)
 
+def test_pooled_connections(monkeypatch, local_server):
+    url = 'http://127.0.0.1:%s/' % local_server.server_address[1]
+    # Restore the settings and session of the other tests afterwards
+    monkeypatch.setattr(net, 'TIMEOUT', net.TIMEOUT)
+    monkeypatch.setattr(net, 'RETRIES', net.RETRIES)
+    monkeypatch.setattr(net, '_session', None)
+    net.configure(timeout=5)
+    for page in ('results', 'watch', 'artwork'):
+        assert net.get(url+page).content == b'<html></html>'
+    assert len(local_server.connections) == 1
+    assert net.get_ssl_context() is net.get_ssl_context()
+
+def test_throttled_requests(monkeypatch):
+    monkeypatch.setattr(throttle, 'BACKOFF', 0.01)
+    monkeypatch.setattr(throttle, '_hosts', dict())
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/' % server.server_address[1]
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            pages = list(executor.map(lambda i: net.get(url+str(i)).content, range(40)))
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Every request succeeds once the concurrency has adapted to the server
+    assert pages == [b'<html></html>']*40
+    host = throttle.get_host('127.0.0.1')
+    assert host.throttled and host.limit < throttle.CONCURRENCY
+
+def test_throttle_retries(monkeypatch, tmp_path):
+    monkeypatch.setattr(throttle, 'BACKOFF', 0.01)
+    monkeypatch.setattr(throttle, 'RETRIES', 2)
+    monkeypatch.setattr(throttle, '_hosts', dict())
+    calls = []
+    def search(term, *args, **kwargs):
+        calls.append(term)
+        # itunespy fails to parse the page of a throttled request
+        raise ConnectionError('Cannot fetch JSON data')
+    monkeypatch.setattr('itunespy.search_track', search)
+    monkeypatch.setattr(itunes, '_store', cache.Store('itunes', itunes.CACHE_TTL, str(tmp_path)))
+    # Failed requests are raised rather than treated as no match
+    with pytest.raises(throttle.ThrottledError):
+        itunes.get_data({'track_name': 'Have a Cigar', 'artist_name': ''}, False)
+    assert len(calls) == 3
+    # Other errors aren't retried
+    with pytest.raises(KeyError):
+        throttle.call('example.com', operator.getitem, {}, 'missing')
+    assert throttle.get_host('example.com').throttled == 0
+
 def test_url_validation():
     errors = []
     videos = [
@@ -112,6 +344,87 @@ def test_video_title_data(test_data):
     data = video.get_data(title).__dict__
     assert [test_data[key] == data[key] for key in test_data.keys()]
 
+def test_catalog_match(itunes_cache, monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, 'directory', str(tmp_path))
+    monkeypatch.setattr(catalog, '_catalog', None)
+    songs = catalog.get_catalog(create=True)
+    assert songs.add([{'wrapperType': 'track', 'kind': 'song', 'trackId': 1, 'artistName': 'Pink Floyd',
+                       'trackName': 'Have a Cigar', 'collectionName': 'Wish You Were Here'},
+                      {'wrapperType': 'track', 'kind': 'music-video', 'artistName': 'Pink Floyd',
+                       'trackName': 'Have a Cigar'},
+                      {'track_name': 'Wish You Were Here', 'artist_name': 'Pink Floyd'},
+                      {'track_name': 'Have a Cigar', 'artist_name': 'Foo Fighters'}]) == 3
+    # Updating a song shouldn't duplicate it
+    assert songs.add([{'track_id': 1, 'track_name': 'Have a Cigar', 'artist_name': 'Pink Floyd',
+                       'collection_name': 'Wish You Were Here'}]) == 1
+    assert len(songs) == 3
+    assert songs.match('Pink Floyd Have a Cigar').artist_name == 'Pink Floyd'
+    assert songs.match('foo fighters - have a cigar').artist_name == 'Foo Fighters'
+    assert songs.match('Pink Floid wish you where here').track_name == 'Wish You Were Here'
+    assert songs.match('Cigar Box Guitar Tutorial') is None
+    # Only low-confidence matches should use the iTunes API
+    assert video.get_data('Pink Floyd - Have A Cigar (Official Audio) [HD]').collection_name == 'Wish You Were Here'
+    assert video.get_data('The Dark Side of the Moon') == 'The Dark Side of the Moon'
+    assert itunes_cache == ['The Dark Side of the Moon']
+
+def test_video_info_cache(info_cache, monkeypatch):
+    url = 'https://www.youtube.com/watch?v=hMr3KtYUCcI'
+    assert video.get_id(url) == video.get_id('https://youtu.be/hMr3KtYUCcI') == 'hMr3KtYUCcI'
+    assert video.get_title(url) == 'Have a Cigar'
+    assert video.get_info(url)['duration'] == 308
+    assert len(info_cache) == 1
+    # Probes don't keep the formats, which only a download needs
+    assert video.get_info(url, formats=True)['formats'] == []
+    assert len(info_cache) == 2
+    # Subsequent runs should use the persistent cache
+    video._info.clear()
+    assert video.get_title(url) == 'Have a Cigar'
+    assert 'formats' not in video.get_info(url)
+    assert len(info_cache) == 2
+    # Probes only keep the cached fields, and the least recently used are evicted
+    monkeypatch.setattr(video, 'MEMO_SIZE', 2)
+    for video_id in ('aaaaaaaaaaa', 'bbbbbbbbbbb', 'ccccccccccc'):
+        assert 'formats' not in video.get_info('https://www.youtube.com/watch?v='+video_id)
+    assert list(video._info) == ['bbbbbbbbbbb', 'ccccccccccc']
+    assert len(video._info_locks) == video.INFO_LOCKS
+
+@pytest.fixture
+def slow_videos(info_cache, monkeypatch):
+    """
+    Candidate videos with the injected probe latency and duration of each
+    """
+    videos = {'https://www.youtube.com/watch?v=aaaaaaaaaaa': (0.2, 200),
+              'https://www.youtube.com/watch?v=bbbbbbbbbbb': (0.3, 310),
+              'https://www.youtube.com/watch?v=ccccccccccc': (0.05, 308),
+              'https://www.youtube.com/watch?v=ddddddddddd': (1, 308)}
+    class SlowYoutubeDL(FakeYoutubeDL):
+        def extract_info(self, url, download=True, process=True):
+            FakeYoutubeDL.calls.append(url)
+            time.sleep(videos[url][0])
+            return {'id': video.get_id(url), 'title': url, 'duration': videos[url][1]}
+    monkeypatch.setattr('youtube_dl.YoutubeDL', SlowYoutubeDL)
+    monkeypatch.setattr(video, 'search', lambda query: sorted(videos))
+    return info_cache
+
+def test_concurrent_video_url(slow_videos):
+    data = defaultdict(str, {'track_name': 'Have a Cigar', 'artist_name': 'Pink Floyd',
+                             'track_time': 308000})
+    start = time.time()
+    url = video.get_url(data, jobs=4)
+    # The highest ranked match is returned without waiting for the slowest probe
+    assert url == 'https://www.youtube.com/watch?v=bbbbbbbbbbb'
+    assert time.time()-start < 0.9
+
+def test_video_url_cancel(slow_videos):
+    data = defaultdict(str, {'track_name': 'Have a Cigar', 'artist_name': 'Pink Floyd',
+                             'track_time': 308000})
+    assert video.get_url(data, jobs=1) == 'https://www.youtube.com/watch?v=bbbbbbbbbbb'
+    # The remaining probes should be cancelled once a match is confirmed
+    assert slow_videos == ['https://www.youtube.com/watch?v=aaaaaaaaaaa',
+                           'https://www.youtube.com/watch?v=bbbbbbbbbbb']
+    data['track_time'] = 1000
+    assert video.get_url(data, jobs=4) == 'https://www.youtube.com/watch?v=aaaaaaaaaaa'
+
 def test_video_metadata(test_data):
     errors = []
     url = 'https://www.youtube.com/watch?v=hMr3KtYUCcI'
@@ -140,13 +453,146 @@ def test_video_download_verbose(test_song):
 
 def test_convert_mp3(test_song):
     errors = []
-    video_dir = os.path.expanduser('~/Downloads/Music/temp/')
+    video_dir = scratch.get_job().path
     video_path = os.path.join(video_dir, os.listdir(video_dir)[0])
     song_path = test_song.convert_to_mp3(video_path)
     if not os.path.exists(song_path):
         errors.append('The output MP3 file doesn\'t exist')
     assert not errors, 'errors occured:\n{}'.format('\n'.join(errors))
 
+def test_stream_convert(tmp_path):
+    source = make_wav(tmp_path / 'source.wav', 3)
+    chunks = []
+    path = transcode.stream(source, str(tmp_path / 'song.mp3'), chunk_size=4096,
+                            observers=[lambda chunk: chunks.append(len(chunk))])
+    assert os.path.getsize(path) > 0
+    assert max(chunks) == 4096
+    assert sum(chunks) == 3*transcode.SAMPLE_RATE*transcode.CHANNELS*transcode.SAMPLE_WIDTH
+
+def test_stream_convert_failure(tmp_path):
+    source = tmp_path / 'source.webm'
+    source.write_bytes(b'not a video')
+    with pytest.raises(transcode.CouldntDecodeError):
+        transcode.stream(str(source), str(tmp_path / 'song.mp3'))
+    assert not os.path.exists(str(tmp_path / 'song.mp3'))
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_single_pass_tagging(monkeypatch, tmp_path, test_data, stream):
+    covers = {480: make_image(100), 1000: make_image(1000)}
+    monkeypatch.setattr(library, 'directory', str(tmp_path))
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path), str(tmp_path / 'library.db')))
+    monkeypatch.setattr(Song, 'get_cover_image', lambda self, resolution: covers[resolution])
+    data = defaultdict(str, test_data, video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI')
+    song = Song(data)
+    path = song.convert_to_mp3(make_wav(tmp_path / 'source.wav', 2), stream)
+    assert os.listdir(os.path.dirname(path)) == ['Have a Cigar.mp3']
+    tags = ID3(path)
+    assert tags['TIT2'].text[0] == 'Have a Cigar' and tags['APIC:Cover'].data == covers[480]
+    assert 'TSSE' not in tags
+    # The tags written while converting are kept
+    mtime = os.stat(path).st_mtime_ns
+    song.set_id3(path)
+    assert os.stat(path).st_mtime_ns == mtime
+    assert library.get_library().find('Pink Floyd', 'Have a Cigar', 'Wish You Were Here')
+    # Retagging reuses the padding, and only grows the file for larger tags
+    size = os.path.getsize(path)
+    Song(dict(data, track_name='Cigar')).set_id3(path)
+    assert os.path.getsize(path) == size and ID3(path)['TIT2'].text[0] == 'Cigar'
+    Song(data).set_id3(path, 1000)
+    assert os.path.getsize(path) > size and ID3(path)['APIC:Cover'].data == covers[1000]
+
+@pytest.mark.parametrize('format, muxer', [('m4a', 'ipod'), ('opus', 'opus')])
+def test_remux_formats(monkeypatch, tmp_path, test_data, format, muxer):
+    cover = make_image(100)
+    monkeypatch.setattr(library, 'directory', str(tmp_path / 'Music'))
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path / 'Music'), str(tmp_path / 'library.db')))
+    monkeypatch.setattr(Song, 'get_cover_image', lambda self, resolution: cover)
+    data = defaultdict(str, test_data, video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI')
+    wav = make_wav(tmp_path / 'source.wav', 2)
+    source = transcode.stream(wav, str(tmp_path / ('source.'+format)), muxer)
+    spans = []
+    stats.add_handler(spans.append)
+    try:
+        # Audio which already has the codec of the format is copied
+        path = Song(data).convert(source, format)
+        assert path.endswith('.'+format) and [span.name for span in spans] == ['remux']
+        assert transcode.get_codec(path) == transcode.get_codec(source)
+        # Any other audio is re-encoded
+        other = Song(dict(data, track_name='Money'))
+        assert transcode.get_codec(other.convert(wav, format)) == transcode.get_codec(source)
+        assert spans[-1].name == 'transcode'
+    finally:
+        stats.remove_handler(spans.append)
+    values = metadata.read(path)
+    assert values['track'] == 'Have a Cigar' and values['album'] == 'Wish You Were Here'
+    assert values['track_number'] == '3' and values['url'] == data['video_url']
+    tags = mutagen.File(path).tags
+    assert 'covr' in tags or 'metadata_block_picture' in tags
+    # The library indexes every output format
+    assert library.get_library().owned(['hMr3KtYUCcI']) == {'hMr3KtYUCcI'}
+
+@pytest.mark.parametrize('format, stream', [('mp3', True), ('mp3', False), ('opus', True)])
+def test_replaygain_tagging(monkeypatch, tmp_path, test_data, format, stream):
+    monkeypatch.setattr(library, 'directory', str(tmp_path / 'Music'))
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path / 'Music'), str(tmp_path / 'library.db')))
+    monkeypatch.setattr(Song, 'get_cover_image', lambda self, resolution: make_image(100))
+    wav = make_wav(tmp_path / 'source.wav', 2)
+    # A sine wave is as loud as its mean square, offset by the K-weighting
+    expected = -0.691+10*math.log10(2*(8000/32768)**2/2)
+    with open(wav, 'rb') as f:
+        meter = loudness.Meter()
+        meter(f.read()[44:])
+    assert abs(meter.result()['loudness']-expected) < 0.1
+    if format == 'opus':
+        # Copied audio is measured by decoding it alone
+        wav = transcode.stream(wav, str(tmp_path / 'source.opus'), 'opus')
+    song = Song(defaultdict(str, test_data, video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI'))
+    path = song.convert(wav, format, stream, replaygain=True)
+    gain = loudness.get_gain(song.loudness, format)
+    if format == 'opus':
+        assert mutagen.File(path).tags['R128_TRACK_GAIN'] == [gain['R128_TRACK_GAIN']]
+        assert abs(int(gain['R128_TRACK_GAIN'])/256-(-23-expected)) < 0.5
+    else:
+        tags = ID3(path)
+        assert tags['TXXX:REPLAYGAIN_TRACK_GAIN'].text[0] == gain['REPLAYGAIN_TRACK_GAIN']
+        assert abs(float(gain['REPLAYGAIN_TRACK_GAIN'].split()[0])-(-18-expected)) < 0.2
+        assert tags['TIT2'].text[0] == 'Have a Cigar' and 'APIC:Cover' in tags
+
+def test_chapter_split(monkeypatch, tmp_path, test_data):
+    monkeypatch.setattr(library, 'directory', str(tmp_path / 'Music'))
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path / 'Music'), str(tmp_path / 'library.db')))
+    monkeypatch.setattr(Song, 'get_cover_image', lambda self, resolution: make_image(100))
+    info = {'title': 'Pink Floyd - Wish You Were Here (Full Album)', 'uploader': 'Pink Floyd',
+            'chapters': [{'start_time': 0, 'end_time': 1, 'title': '01. Shine On You Crazy Diamond (0:00)'},
+                         {'start_time': 1, 'end_time': 2.5, 'title': '2 - Welcome To The Machine'},
+                         {'start_time': 2.5, 'end_time': None, 'title': 'Hidden Track'}]}
+    tracks = [Result(**dict(test_data, track_name=name, track_number=i+1, track_count=5))
+              for i, name in enumerate(('Shine On You Crazy Diamond (Pts. 1-5)', 'Welcome to the Machine',
+                                        'Have a Cigar', 'Wish You Were Here', 'Shine On You Crazy Diamond (Pts. 6-9)'))]
+    monkeypatch.setattr(video, 'get_info', lambda url, formats=False: info)
+    monkeypatch.setattr(itunes, 'get_album', lambda keywords: list(reversed(tracks)))
+    url = 'https://www.youtube.com/watch?v=hMr3KtYUCcI'
+    sections = chapters.get_songs(url)
+    assert [song.track for song, _, _ in sections] == ['Shine On You Crazy Diamond (Pts. 1-5)',
+                                                        'Welcome to the Machine', 'Hidden Track']
+    assert sections[2][0].album == 'Wish You Were Here' and sections[2][0].track_number == '3'
+    assert [(start, end) for _, start, end in sections] == [(0, 1), (1, 2.5), (2.5, None)]
+    # Every chapter is encoded from a single decode of the video
+    decodes = []
+    popen = subprocess.Popen
+    def record(cmd, *args, **kwargs):
+        if 'pipe:1' in cmd and '-vn' in cmd:
+            decodes.append(cmd)
+        return popen(cmd, *args, **kwargs)
+    monkeypatch.setattr(subprocess, 'Popen', record)
+    paths = convert_chapters(sections, make_wav(tmp_path / 'source.wav', 4))
+    assert len(decodes) == 1
+    lengths = [mutagen.File(path).info.length for path in paths]
+    assert [round(length) for length in lengths] == [1, 2, 2] and sum(lengths) < 4.2
+    assert ID3(paths[1])['TIT2'].text[0] == 'Welcome to the Machine'
+    assert ID3(paths[1])['TRCK'].text[0] == '2/5'
+    assert sorted(os.listdir(os.path.dirname(paths[0]))) == sorted(os.path.basename(path) for path in paths)
+
 def test_set_id3_tags(test_song):
     errors = []
     path = os.path.expanduser('~/Downloads/Music/')
@@ -163,17 +609,253 @@ def test_set_id3_tags(test_song):
         errors.append('[TCON] Genre tag does not match expected result')
     assert not errors, 'errors occured:\n{}'.format('\n'.join(errors))
 
+def test_artwork_encoding():
+    jpeg = make_image(100)
+    assert artwork.get_jpeg_size(jpeg) == (100, 100)
+    # JPEG images within the resolution are embedded without re-encoding
+    assert artwork.to_jpeg(jpeg, 480) is jpeg
+    assert artwork.get_jpeg_size(artwork.to_jpeg(jpeg, 50)) == (50, 50)
+    png = make_image(100, 'PNG')
+    assert artwork.get_jpeg_size(png) is None
+    assert artwork.get_jpeg_size(artwork.to_jpeg(png)) == (100, 100)
+
+def test_artwork_cache(monkeypatch, tmp_path):
+    requested = []
+    class Response():
+        content = make_image(100)
+    def get(url, *args, **kwargs):
+        requested.append(url)
+        return Response()
+    monkeypatch.setattr(net, 'get', get)
+    monkeypatch.setattr(artwork, '_memo', artwork.OrderedDict())
+    monkeypatch.setattr(cache, '_stores', [])
+    monkeypatch.setattr(artwork, '_store', cache.Store('artwork', artwork.CACHE_TTL, str(tmp_path), 1))
+    url = 'https://is1-ssl.mzstatic.com/image/thumb/Music/source/100x100bb.jpg'
+    data = artwork.get_image(url, 480)
+    assert artwork.get_image(url, 480) is data
+    assert requested == ['https://is1-ssl.mzstatic.com/image/thumb/Music/source/480x480bb.jpg']
+    # The image should be reused from disk by later runs
+    artwork._memo.clear()
+    assert artwork.get_image(url, 480) == data
+    assert len(requested) == 1
+    # Only the most recent images are kept, and clearing the cache removes them
+    artwork.get_image(url, 100)
+    artwork._memo.clear()
+    artwork.get_image(url, 480)
+    assert len(requested) == 3
+    artwork._memo.clear()
+    cache.clear()
+    artwork.get_image(url, 480)
+    assert len(requested) == 4
+
+def write_tagged(path, artist, track, album, url=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    tags = ID3()
+    tags.add(TPE1(encoding=3, text=artist))
+    tags.add(TIT2(encoding=3, text=track))
+    tags.add(TALB(encoding=3, text=album))
+    if url:
+        tags.add(WOAS(url=url))
+    tags.save(path)
+    return path
+
+def test_library_index(monkeypatch, tmp_path):
+    music = str(tmp_path / 'Music')
+    songs = library.Library(music, str(tmp_path / 'library.db'))
+    path = write_tagged(os.path.join(music, 'Pink Floyd', 'Cigar.mp3'), 'Pink Floyd',
+                        'Have a Cigar', 'Wish You Were Here',
+                        'https://www.youtube.com/watch?v=hMr3KtYUCcI')
+    write_tagged(os.path.join(music, 'Pink Floyd', 'Money.mp3'), 'Pink Floyd', 'Money',
+                 'The Dark Side of the Moon')
+    assert songs.find('pink floyd', 'have a  cigar', 'Wish You Were Here') == path
+    assert not songs.find('Pink Floyd', 'Have a Cigar', 'Animals')
+    assert songs.owned(['hMr3KtYUCcI', 'C0DPdy98e4c']) == {'hMr3KtYUCcI'}
+    # Unchanged files shouldn't have their tags read again
+    read = []
+    monkeypatch.setattr(library, 'read_tags', lambda path: read.append(path) or (None, '', '', ''))
+    os.remove(path)
+    songs.refresh(force=True)
+    assert not read and not songs.owned(['hMr3KtYUCcI'])
+    assert songs.find('Pink Floyd', 'Money')
+    # Songs deleted after the index was refreshed shouldn't count as existing
+    write_tagged(path, 'Pink Floyd', 'Have a Cigar', 'Wish You Were Here',
+                 'https://www.youtube.com/watch?v=hMr3KtYUCcI')
+    songs.add(path, 'hMr3KtYUCcI', 'Pink Floyd', 'Have a Cigar', 'Wish You Were Here')
+    assert songs.owned(['hMr3KtYUCcI']) == {'hMr3KtYUCcI'}
+    os.remove(path)
+    os.remove(os.path.join(music, 'Pink Floyd', 'Money.mp3'))
+    assert not songs.owned(['hMr3KtYUCcI']) and not songs.find('Pink Floyd', 'Money')
+    assert songs.paths() == []
+
+def test_song_file_exists(monkeypatch, tmp_path):
+    music = str(tmp_path / 'Music')
+    monkeypatch.setattr(library, '_library', library.Library(music, str(tmp_path / 'library.db')))
+    write_tagged(os.path.join(music, 'Pink Floyd', 'Speak to Me.mp3'), 'Pink Floyd', 'Speak to Me',
+                 'The Dark Side of the Moon', 'https://www.youtube.com/watch?v=hMr3KtYUCcI')
+    def get_song(track):
+        return Song(defaultdict(str, track_name=track, artist_name='Pink Floyd',
+                                collection_name='The Dark Side of the Moon',
+                                video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI'))
+    assert get_song('Speak to Me').file_exists('mp3')
+    # A song in another format isn't a duplicate
+    assert not get_song('Speak to Me').file_exists('m4a')
+    # The other chapters of a video aren't owned because one of them is
+    assert get_song('Breathe').file_exists('mp3')
+    assert not get_song('Breathe').file_exists('mp3', chapter=True)
+    assert get_song('Speak to Me').file_exists('mp3', chapter=True)
+
 def test_get_playlist_videos():
     url = 'https://www.youtube.com/playlist?list=PLGqB3S8f_uiLkCQziivGYI3zNtLJvfUWm'
-    videos = util.get_video_list(url)
+    videos = [vid['url'] for vid in util.get_video_list(url)]
     assert videos == ['https://www.youtube.com/watch?v=C0DPdy98e4c', 'https://www.youtube.com/watch?v=_FrOQC-zEog', 'https://www.youtube.com/watch?v=yvPr9YV7-Xw']
 
+def test_lazy_playlist(monkeypatch, tmp_path):
+    pages = []
+    def entries():
+        for page in range(3):
+            pages.append(page)
+            for i in range(2):
+                video_id = ('video%s_%s' % (page, i)).ljust(11, '0')
+                yield {'_type': 'url', 'id': video_id, 'url': video_id, 'title': 'Song %s' % video_id}
+    class FakePlaylistDL(FakeYoutubeDL):
+        def extract_info(self, url, download=True, process=True, ie_key=None):
+            assert self.opts['extract_flat'] and not process
+            if 'list=' in url:
+                return {'_type': 'url', 'url': 'https://www.youtube.com/channel/test', 'ie_key': 'YoutubeTab'}
+            return {'_type': 'playlist', 'entries': entries()}
+    monkeypatch.setattr('youtube_dl.YoutubeDL', FakePlaylistDL)
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path), str(tmp_path / 'library.db')))
+    videos = util.skip_owned(util.get_video_list('https://www.youtube.com/playlist?list=test'), size=2)
+    first = next(videos)
+    assert first['url'] == 'https://www.youtube.com/watch?v=video0_0000'
+    assert first['title'] == 'Song video0_0000'
+    assert pages == [0]
+    assert len(list(videos)) == 5 and pages == [0, 1, 2]
+
+def test_batch_records(tmp_path):
+    records = tmp_path / 'songs.jsonl'
+    records.write_text('{"track": "Money", "artist": "Pink Floyd"}\n\n'
+                       '{"url": "hMr3KtYUCcI"}\n')
+    with batch.Journal(str(tmp_path / 'songs.journal')) as journal:
+        items = list(batch.get_items(str(records), journal))
+    assert items[0]['data']['artist_name'] == 'Pink Floyd' and not items[0]['collection']
+    assert items[1]['data']['video_url'] == 'https://www.youtube.com/watch?v=hMr3KtYUCcI'
+    assert not any(item['interactive'] for item in items)
+
+def test_batch_journal(tmp_path):
+    records = tmp_path / 'songs.csv'
+    records.write_text('track,artist,album,url\n'
+                       'Have a Cigar,Pink Floyd,Wish You Were Here,\n'
+                       'Money,Pink Floyd,,\n')
+    path = str(tmp_path / 'songs.csv.journal')
+    video_path = tmp_path / 'hMr3KtYUCcI.webm'
+    video_path.write_bytes(b'')
+    with batch.Journal(path) as journal:
+        first, second = batch.get_items(str(records), journal)
+        assert first['collection'] and first['data']['collection_name'] == 'Wish You Were Here'
+        first['data'] = defaultdict(str, first['data'], video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI')
+        journal.record('resolve', first)
+        first['video'] = str(video_path)
+        journal.record('download', first)
+        journal.record('tag', second)
+    # Simulate a run interrupted while writing to the journal
+    with open(path, 'a') as f:
+        f.write('{"key": "')
+    with batch.Journal(path) as journal:
+        items = list(batch.get_items(str(records), journal))
+    assert len(items) == 1
+    assert items[0]['song'].video_url == 'https://www.youtube.com/watch?v=hMr3KtYUCcI'
+    assert items[0]['video'] == str(video_path) and 'path' not in items[0]
+    assert pipeline.download_song(items[0]) is items[0]
+
+def test_batch_resume_converted(monkeypatch, tmp_path):
+    records = tmp_path / 'songs.csv'
+    records.write_text('track,artist,album,url\nHave a Cigar,Pink Floyd,,hMr3KtYUCcI\n')
+    path = str(tmp_path / 'songs.csv.journal')
+    song_path = str(tmp_path / 'Have a Cigar.mp3')
+    open(song_path, 'wb').close()
+    measurement = {'loudness': -12.5, 'peak': 0.9}
+    with batch.Journal(path) as journal:
+        item, = batch.get_items(str(records), journal)
+        journal.record('resolve', item)
+        item['song'] = Song(item['data'])
+        item['song'].path, item['song'].tagged, item['song'].loudness = song_path, True, measurement
+        item['path'] = song_path
+        journal.record('convert', item)
+    with batch.Journal(path) as journal:
+        item, = batch.get_items(str(records), journal)
+    song = item['song']
+    assert item['path'] == song.path == song_path and 'video' not in item
+    assert song.tagged and song.loudness == measurement
+    # A song tagged while converting keeps its tags, including the gain
+    written = []
+    monkeypatch.setattr(Song, '_write_tags', lambda self, path, resolution: written.append(path))
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path), str(tmp_path / 'library.db')))
+    pipeline.tag_song(item)
+    assert not written
+
+def test_download_retry(info_cache, monkeypatch, tmp_path):
+    import youtube_dl
+    attempts = []
+    class DownloadingYoutubeDL(FakeYoutubeDL):
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            pass
+        def process_ie_result(self, info, download=True):
+            attempts.append(info)
+            if len(attempts) == 1:
+                raise youtube_dl.utils.DownloadError('ERROR: HTTP Error 403: Forbidden')
+            open(self.opts['outtmpl'] % {'id': info['id'], 'ext': 'webm'}, 'wb').close()
+            return dict(info, ext='webm', acodec='opus')
+    monkeypatch.setattr('youtube_dl.YoutubeDL', DownloadingYoutubeDL)
+    monkeypatch.setattr(scratch, 'root', str(tmp_path))
+    monkeypatch.setattr(scratch, '_job', None)
+    monkeypatch.setattr(throttle, '_hosts', dict())
+    song = Song(defaultdict(str, video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI'))
+    path = song.download()
+    assert os.path.exists(path) and song.codec == 'opus'
+    # A failed download is retried with newly extracted formats
+    assert len(attempts) == 2 and len(info_cache) == 2
+    # The download itself isn't limited as a YouTube request
+    host = throttle.get_host(throttle.YOUTUBE)
+    assert host.limit == host.concurrency and not host.throttled
+
+def test_aio_convert_many(monkeypatch):
+    def get_song_data(data, collection=False, interactive=True):
+        assert not interactive
+        if data['track_name'] == 'nomatch':
+            raise LookupError('No results found with the keyword nomatch')
+        return defaultdict(str, data, video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI')
+    def convert(self, video, format='mp3', stream=True, resolution=480, replaygain=False):
+        time.sleep(0.05 if self.track == 'slow' else 0)
+        self.path = self.track+'.mp3'
+        return self.path
+    monkeypatch.setattr(util, 'get_song_data', get_song_data)
+    monkeypatch.setattr(Song, 'file_exists', lambda self, format='mp3', chapter=False: self.track == 'exists')
+    monkeypatch.setattr(Song, 'download', lambda self, verbose=False, format='mp3': self.track+'.webm')
+    monkeypatch.setattr(Song, 'convert', convert)
+    monkeypatch.setattr(Song, 'set_id3', lambda self, path, resolution=480: None)
+    queries = [{'track': track, 'artist': 'Pink Floyd'} for track in ('slow', 'nomatch', 'exists', 'fast')]
+    async def collect(return_exceptions):
+        with ThreadPoolExecutor(2) as executor:
+            return [song async for song in aio.convert_many(queries, 2, return_exceptions, executor)]
+    results = asyncio.run(collect(True))
+    assert sorted(song.path for song in results if isinstance(song, Song)) == ['fast.mp3', 'slow.mp3']
+    assert [type(err) for err in results if not isinstance(err, Song)] in ([LookupError, FileExistsError],
+                                                                            [FileExistsError, LookupError])
+    # Errors should be raised instead of exiting
+    with pytest.raises(LookupError):
+        asyncio.run(collect(False))
+    with pytest.raises(ValueError):
+        asyncio.run(aio.resolve('https://example.com/watch?v=hMr3KtYUCcI'))
+
 # Make sure temporary files are being cleaned up
 def test_cleanup(test_song):
     errors = []
     directory = os.path.expanduser('~/Downloads/Music/')
-    video_dir = os.path.join(directory, 'temp/')
-    cover_dir = os.path.join(directory, 'CoverArt/')
+    video_dir = scratch.get_job().path
     song_path = os.path.join(directory, test_song.artist, test_song.track+'.mp3')
     util.cleanup()
     # Remove test mp3 file and artist diectory if empty
@@ -183,6 +865,196 @@ def test_cleanup(test_song):
         os.rmdir(os.path.dirname(song_path))
     if os.path.isdir(video_dir):
         errors.append('The temporary video files weren\'t cleaned up')
-    if os.path.isdir(cover_dir):
-        errors.append('The temporary cover-art files weren\'t cleaned up')
     assert not errors, 'errors occured:\n{}'.format('\n'.join(errors))
+
+def test_scratch_jobs(monkeypatch, tmp_path):
+    monkeypatch.setattr(scratch, 'root', str(tmp_path))
+    monkeypatch.setattr(scratch, '_job', None)
+    other = scratch.Job()
+    job = scratch.get_job()
+    assert job is scratch.get_job() and job.path != other.path
+    video_path = os.path.join(job.path, 'hMr3KtYUCcI.webm')
+    other_path = os.path.join(other.path, 'hMr3KtYUCcI.webm')
+    for path in (video_path, other_path):
+        open(path, 'wb').close()
+    # Each job only removes its own files
+    job.remove(other_path)
+    assert os.path.exists(other_path)
+    item = {'song': Song(defaultdict(str, video_url='https://www.youtube.com/watch?v=hMr3KtYUCcI')),
+            'video': video_path, 'path': 'song.mp3'}
+    monkeypatch.setattr(Song, 'set_id3', lambda self, path, resolution=480: None)
+    pipeline.tag_song(item)
+    assert not os.path.exists(video_path)
+    util.cleanup()
+    assert not os.path.exists(job.path) and os.path.exists(other_path)
+    # A batch resumes with the downloads of its previous run
+    resumed = scratch.resume('songs.csv')
+    open(os.path.join(resumed.path, 'hMr3KtYUCcI.webm'), 'wb').close()
+    monkeypatch.setattr(scratch, '_job', None)
+    assert os.listdir(scratch.resume('songs.csv').path) == ['hMr3KtYUCcI.webm']
+
+def test_playlist_sync(monkeypatch, tmp_path, test_data):
+    monkeypatch.setattr(library, '_library', library.Library(str(tmp_path), str(tmp_path/'library.db')))
+    def video_entry(video_id):
+        return {'id': video_id, 'url': 'https://www.youtube.com/watch?v='+video_id, 'title': video_id}
+    path = str(tmp_path/'playlist.jsonl')
+    with sync.Manifest(path) as manifest:
+        assert manifest.diff(map(video_entry, ('a'*11, 'b'*11))) == [video_entry('a'*11), video_entry('b'*11)]
+        for video_id in ('a'*11, 'b'*11):
+            song_path = tmp_path/(video_id+'.mp3')
+            song_path.write_bytes(b'')
+            data = defaultdict(str, test_data, video_url='https://www.youtube.com/watch?v='+video_id)
+            manifest.record('tag', {'song': Song(data), 'data': data, 'path': str(song_path)})
+    # Only videos added since the last sync are converted, and removed ones are pruned
+    with sync.Manifest(path) as manifest:
+        assert manifest.diff(map(video_entry, ('b'*11, 'c'*11)), prune=True) == [video_entry('c'*11)]
+        assert list(manifest.entries) == ['b'*11]
+    assert not (tmp_path/('a'*11+'.mp3')).exists() and (tmp_path/('b'*11+'.mp3')).exists()
+    with sync.Manifest(path) as manifest:
+        assert list(manifest.entries) == ['b'*11]
+    # Songs which were already in the library are pruned as well
+    owned = write_tagged(str(tmp_path/'Pink Floyd'/'Money.mp3'), 'Pink Floyd', 'Money',
+                         'The Dark Side of the Moon', 'https://www.youtube.com/watch?v='+'d'*11)
+    with sync.Manifest(path) as manifest:
+        videos = manifest.diff(map(video_entry, ('b'*11, 'c'*11, 'd'*11)))
+        assert list(util.skip_owned(videos, callback=manifest.skip_owned)) == [video_entry('c'*11)]
+    with sync.Manifest(path) as manifest:
+        assert manifest.diff(map(video_entry, ('b'*11, 'c'*11)), prune=True) == [video_entry('c'*11)]
+    assert not os.path.exists(owned)
+    assert sync.get_path('https://www.youtube.com/playlist?list=PLx&index=2').endswith('PLx.jsonl')
+
+def test_source_cache(monkeypatch, tmp_path):
+    store = sources.Sources(str(tmp_path/'sources'), max_bytes=250)
+    monkeypatch.setattr(sources, '_sources', store)
+    monkeypatch.setattr(sources, 'enabled', True)
+    for video_id in ('a'*11, 'b'*11, 'c'*11):
+        path = tmp_path/(video_id+'.webm')
+        path.write_bytes(video_id[0].encode()*100)
+        assert sources.add(video_id, 'mp3', str(path), 'opus') != str(path) and not path.exists()
+    # The least recently used download is evicted beyond the size cap
+    assert sources.get('a'*11, 'mp3') is None and sources.get('b'*11, 'm4a') is None
+    path, codec = sources.get('b'*11, 'mp3')
+    assert codec == 'opus' and open(path, 'rb').read() == b'b'*100 and store.size() == 200
+    # Corrupt downloads are removed rather than converted
+    with open(store.get('c'*11, 'mp3')[0], 'r+b') as f:
+        f.write(b'x')
+    assert sources.get('c'*11, 'mp3') is None and store.size() == 100
+    # A cached download skips youtube_dl entirely
+    def fail(*args, **kwargs):
+        raise AssertionError('The video was downloaded again')
+    monkeypatch.setattr('youtube_dl.YoutubeDL', fail)
+    song = Song(defaultdict(str, video_url='https://www.youtube.com/watch?v='+'b'*11))
+    assert song.download(format='mp3') == path and song.codec == 'opus'
+    # Converting a cached download leaves it in the cache
+    monkeypatch.setattr(Song, 'file_exists', lambda self, format='mp3', chapter=False: False)
+    monkeypatch.setattr(Song, 'convert', lambda self, video, *args, **kwargs: 'song.mp3')
+    monkeypatch.setattr(Song, 'set_id3', lambda self, path, resolution=480: None)
+    asyncio.run(aio.convert(song))
+    assert os.path.exists(path) and sources.get('b'*11, 'mp3') == (path, 'opus')
+    store.close()
+
+def test_daemon_jobs(monkeypatch, tmp_path, test_data):
+    def get_song_data(data, collection=False, interactive=True):
+        if data['video_url'] == 'nomatch':
+            raise LookupError('No songs were found')
+        return defaultdict(str, test_data, video_url=data['video_url'])
+    monkeypatch.setattr(util, 'get_song_data', get_song_data)
+    monkeypatch.setattr(util, 'get_video_list', lambda url: iter(
+        {'url': 'https://www.youtube.com/watch?v='+vid, 'title': vid} for vid in ('a', 'b')))
+    monkeypatch.setattr(Song, 'file_exists', lambda self, format='mp3', chapter=False: False)
+    def create(callback, errback):
+        stages = [pipeline.Stage('resolve', pipeline.resolve_song, 2),
+                  pipeline.Stage('tag', lambda item: dict(item, path=item['song'].track+'.'+item.get('format', 'mp3')))]
+        return pipeline.Pipeline(stages, callback=callback, label=pipeline.get_label, errback=errback)
+    address = str(tmp_path/'daemon.sock')
+    worker = daemon.Daemon(create)
+    server = daemon.create_server(worker, address)
+    worker.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert daemon.is_running(address)
+        job = daemon.submit({'url': 'hMr3KtYUCcI', 'format': 'm4a'}, address, interval=0.05)
+        assert job['status'] == 'done' and job['songs'][0]['path'] == 'Have a Cigar.m4a'
+        job = daemon.submit({'url': 'nomatch'}, address, interval=0.05)
+        assert job['status'] == 'failed' and 'No songs were found' in job['songs'][0]['error']
+        job = daemon.submit({'playlist': 'PLx'}, address, interval=0.05)
+        assert job['status'] == 'done' and len(job['songs']) == 2
+        with pytest.raises(ValueError):
+            daemon.request(address, 'POST', '/jobs', {'track': 'Have a Cigar'})
+        assert len(daemon.request(address, 'GET', '/jobs')['jobs']) == 3
+    finally:
+        server.shutdown()
+        server.server_close()
+        worker.close()
+    assert not daemon.is_running(address)
+
+def test_pipeline_stages():
+    stages = [pipeline.Stage('double', lambda x: x*2, 2),
+              pipeline.Stage('negate', operator.neg, 2, process=True),
+              pipeline.Stage('filter', lambda x: x if x % 4 else None, 3)]
+    with pipeline.Pipeline(stages) as songs:
+        results = list(songs.run(range(10)))
+    assert sorted(results) == sorted(-x*2 for x in range(10) if x % 2)
+
+def fetch(item):
+    with stats.span('fetch') as span:
+        span.bytes = item*10
+    return item
+
+def test_stats_report():
+    report, names = stats.Report(), []
+    stats.add_handler(report)
+    stats.add_handler(lambda span: names.append(span.name))
+    stages = [pipeline.Stage('fetch', fetch, 2, process=True),
+              pipeline.Stage('check', lambda x: 1/(x-3), 2)]
+    try:
+        with pipeline.Pipeline(stages, label=str) as songs:
+            list(songs.run(range(1, 6)))
+    finally:
+        del stats._handlers[:]
+    result = report.to_dict()
+    tracks = {track['track']: track for track in result['tracks']}
+    # Spans from the worker processes should be attributed to their tracks
+    assert sorted(tracks) == ['1', '2', '3', '4', '5']
+    assert tracks['4']['bytes'] == 40 and set(tracks['4']['spans']) == {'fetch', 'check'}
+    assert tracks['3']['errors'] and not tracks['5']['errors']
+    assert result['spans']['fetch']['count'] == 10 and result['spans']['fetch']['bytes'] == 150
+    assert result['spans']['check']['p50'] <= result['spans']['check']['p95']
+    assert names.count('check') == 5
+
+def get_settings(item):
+    return net.TIMEOUT, net.RETRIES, cache.enabled, scratch.root
+
+# Worker processes should use the command-line options of the main process
+def test_pipeline_settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, 'enabled', False)
+    monkeypatch.setattr(scratch, 'root', str(tmp_path))
+    monkeypatch.setattr(net, 'TIMEOUT', (3, 7))
+    monkeypatch.setattr(net, 'RETRIES', 1)
+    stages = [pipeline.Stage('settings', get_settings, 2, process=True)]
+    with pipeline.Pipeline(stages) as songs:
+        assert list(songs.run([1, 2])) == [((3, 7), 1, False, str(tmp_path))]*2
+    # A single conversion at a time runs without a process pool
+    args = opts.parse_options(['-u', 'hMr3KtYUCcI', '--jobs', '1'])
+    with pipeline.create(args) as songs:
+        assert songs._pool is None and not any(stage.process for stage in songs.stages)
+
+def fetch_artwork(url):
+    return len(artwork.get_image(url, 480))
+
+# Cover-art fetched while converting in a worker process respects --no-cache
+def test_pipeline_artwork_cache(monkeypatch, tmp_path, local_server):
+    monkeypatch.setattr(cache, 'enabled', False)
+    monkeypatch.setattr(cache, 'directory', str(tmp_path))
+    url = 'http://127.0.0.1:%s/vi/youtube/maxresdefault.jpg' % local_server.server_address[1]
+    stages = [pipeline.Stage('convert', fetch_artwork, 2, process=True)]
+    with pipeline.Pipeline(stages) as songs:
+        assert list(songs.run([url, url])) == [len(make_image(10))]*2
+    assert not os.listdir(str(tmp_path))
+
+# A failing item should be dropped without stopping the others
+def test_pipeline_stage_failure():
+    stages = [pipeline.Stage('invert', lambda x: 1/x, 2)]
+    with pipeline.Pipeline(stages) as songs:
+        results = list(songs.run(range(-2, 3)))
+    assert sorted(results) == [-1, -0.5, 0.5, 1]
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/aio.py
+Brett Stevenson (c) 2018
+"""
+
+import asyncio, functools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from yt2mp3 import pipeline, scratch, util, video
+from yt2mp3.song import Song
+
+# The number of songs converted concurrently by convert_many
+CONCURRENCY = 4
+
+
+def _get_data(query):
+  """
+  Builds the input data for a query
+  Args:
+    query: A YouTube video URL or ID, or a dict containing the track,
+      artist, album and/or url
+  Returns:
+    A dict of the input values
+  Raises:
+    ValueError: If the YouTube URL isn't valid
+  """
+  if isinstance(query, str):
+    data = util.get_input_data(url=query)
+  else:
+    data = util.get_input_data(**query)
+  if data['video_url'] and not video.validate_url(data['video_url']):
+    raise ValueError('Unable to validate the provided URL: '+data['video_url'])
+  return data
+
+
+async def _run(executor, func, *args):
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+
+async def resolve(query):
+  """
+  Retrieves the song data for a query without blocking the event loop
+  Args:
+    query: A YouTube video URL or ID, or a dict containing the track,
+      artist, album and/or url
+  Returns:
+    A Song containing the retrieved song data
+  Raises:
+    ValueError: If the YouTube URL isn't valid
+    LookupError: If no song data or matching video is found
+  """
+  data = _get_data(query)
+  data = await _run(None, util.get_song_data, data, 'collection_name' in data, False)
+  if not data['video_url']:
+    raise LookupError('Unable to find a video for '+data['track_name']+' by '+data['artist_name'])
+  return Song(data)
+
+
+async def convert(query, resolution=480, overwrite=False, stream=True, executor=None, format='mp3'):
+  """
+  Resolves, downloads, converts and tags a song without blocking the event
+  loop
+  Args:
+    query: A Song, a YouTube video URL or ID, or a dict containing the track,
+      artist, album and/or url
+    resolution: The target resolution of the cover-art
+    overwrite: A bool specifying if an existing song should be replaced
+    stream: A bool specifying if the audio should be converted in chunks
+    executor: The executor used for converting, defaults to a thread pool
+    format: The output format, 'mp3', 'm4a' or 'opus'
+  Returns:
+    The converted Song, with the path of its converted file
+  Raises:
+    FileExistsError: If the song already exists in the output directory
+  """
+  song = query if isinstance(query, Song) else await resolve(query)
+  if not overwrite and await _run(None, song.file_exists, format):
+    raise FileExistsError('This song already exists in the output directory: '+song.track)
+  item = {'song': song}
+  item['video'] = await _run(None, song.download, False, format)
+  try:
+    item = await _run(executor, functools.partial(pipeline.convert_song, stream=stream, resolution=resolution,
+                                                  format=format), item)
+  finally:
+    # Only the job's own download is removed, never a cached source
+    scratch.get_job().remove(item['video'])
+  song = item['song']
+  await _run(None, song.set_id3, item['path'], resolution)
+  return song
+
+
+async def convert_many(queries, concurrency=CONCURRENCY, return_exceptions=False, executor=None, **kwargs):
+  """
+  Converts many songs concurrently, yielding each as it completes
+  Args:
+    queries: An iterable of Songs, YouTube video URLs or IDs, or dicts
+      containing the track, artist, album and/or url
+    concurrency: The number of songs converted at a time
+    return_exceptions: A bool specifying if errors should be yielded in
+      place of the failed songs instead of raised
+    executor: The executor used for converting, defaults to a process pool
+    kwargs: Additional arguments passed to convert
+  Returns:
+    An asynchronous generator of the converted Songs
+  """
+  concurrency = max(1, concurrency)
+  pool = executor
+  if pool is None:
+    pool = ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=pipeline.apply_settings, initargs=(pipeline.get_settings(),))
+  queries = iter(queries)
+  pending = set()
+  try:
+    while True:
+      # Only start as many songs as can be converted at a time
+      for query in queries:
+        pending.add(asyncio.ensure_future(convert(query, executor=pool, **kwargs)))
+        if len(pending) >= concurrency:
+          break
+      if not pending:
+        return
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        if task.exception() is None:
+          yield task.result()
+        elif return_exceptions:
+          yield task.exception()
+        else:
+          raise task.exception()
+  finally:
+    for task in pending:
+      task.cancel()
+    if executor is None:
+      pool.shutdown(wait=False)
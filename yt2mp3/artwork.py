@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/artwork.py
+Brett Stevenson (c) 2018
+"""
+
+import io, hashlib, threading
+from collections import OrderedDict
+from yt2mp3 import cache, net, stats
+
+# The number of images kept in memory
+MEMO_SIZE = 64
+# The number of seconds an image remains in the persistent cache, and the
+# number of images kept there
+CACHE_TTL = 90*24*60*60
+CACHE_SIZE = 1000
+
+_memo = OrderedDict()
+_lock = threading.Lock()
+_store = cache.Store('artwork', CACHE_TTL, max_entries=CACHE_SIZE)
+
+
+def get_url(url, resolution):
+  """
+  Builds the URL of the cover-art image with the specified resolution
+  Args:
+    url: The artwork URL provided by the iTunes API or a YouTube thumbnail
+    resolution: The target resolution of the cover-art
+  Returns:
+    The URL of the cover-art image
+  """
+  if 'youtube' in url:
+    return url
+  ext = '/%sx%sbb.jpg' % (resolution, resolution)
+  return '/'.join(url.split('/')[:-1])+ext
+
+
+def get_image(url, resolution):
+  """
+  Retrieves the cover-art as JPEG data, downloading and encoding each image
+  only once and sharing it between every track that uses it
+  Args:
+    url: The artwork URL provided by the iTunes API or a YouTube thumbnail
+    resolution: The target resolution of the cover-art
+  Returns:
+    The JPEG data of the cover-art image
+  """
+  img_url = get_url(url, resolution)
+  key = hashlib.sha1(('%s|%s' % (img_url, resolution)).encode('utf-8')).hexdigest()
+  with _lock:
+    if key in _memo:
+      _memo.move_to_end(key)
+      return _memo[key]
+  data = _store.get(key)
+  if data is None:
+    # YouTube thumbnails are embedded at their original size
+    with stats.span('artwork.fetch') as span:
+      content = net.get(img_url).content
+      span.bytes = len(content)
+    data = to_jpeg(content, None if 'youtube' in img_url else resolution)
+    _store.set(key, data)
+  with _lock:
+    _memo[key] = data
+    while len(_memo) > MEMO_SIZE:
+      _memo.popitem(last=False)
+  return data
+
+
+def to_jpeg(data, resolution=None):
+  """
+  Converts image data to JPEG, only decoding the image when it isn't already
+  a JPEG within the specified resolution
+  Args:
+    data: The bytes of an image
+    resolution: The maximum width and height of the image, if any
+  Returns:
+    The JPEG data of the image
+  """
+  size = get_jpeg_size(data)
+  if size and (resolution is None or max(size) <= resolution):
+    return data
+  from PIL import Image
+  image = Image.open(io.BytesIO(data))
+  if resolution:
+    image.thumbnail((resolution, resolution))
+  output = io.BytesIO()
+  image.convert('RGB').save(output, format='JPEG', quality=90)
+  return output.getvalue()
+
+
+def get_jpeg_size(data):
+  """
+  Reads the dimensions of JPEG data from its frame header
+  Args:
+    data: The bytes of an image
+  Returns:
+    A tuple of the width and height, or None if the data isn't a JPEG
+  """
+  if data[:2] != b'\xff\xd8':
+    return None
+  i = 2
+  while i+9 < len(data):
+    if data[i] != 0xFF:
+      return None
+    marker = data[i+1]
+    if marker == 0xFF:
+      i += 1
+      continue
+    # Start of frame markers, excluding DHT, JPG and DAC
+    if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+      height = int.from_bytes(data[i+5:i+7], 'big')
+      width = int.from_bytes(data[i+7:i+9], 'big')
+      return (width, height)
+    i += 2+int.from_bytes(data[i+2:i+4], 'big')
+  return None
+
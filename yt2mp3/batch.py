@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/batch.py
+Brett Stevenson (c) 2018
+"""
+
+import os, csv, json, hashlib, threading
+from collections import defaultdict
+from yt2mp3 import library, util
+from yt2mp3.song import Song
+
+FIELDS = ('track', 'artist', 'album', 'url')
+JSON_EXTENSIONS = ('.json', '.jsonl', '.ndjson')
+
+
+def read_records(path):
+  """
+  Streams the records of a batch file
+  Args:
+    path: The path of a CSV file with a header row, or a JSON-lines file
+  Returns:
+    A generator of dicts containing the track, artist, album and URL
+  """
+  with open(path, newline='', encoding='utf-8') as f:
+    if path.lower().endswith(JSON_EXTENSIONS):
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+    else:
+      for row in csv.DictReader(f):
+        yield row
+
+
+def get_key(record):
+  """
+  Identifies a batch record by its normalized values
+  Args:
+    record: A dict containing the track, artist, album and URL
+  Returns:
+    A string which is identical for equivalent records
+  """
+  values = '|'.join(library.normalize(record.get(field)) for field in FIELDS)
+  return hashlib.sha1(values.encode('utf-8')).hexdigest()
+
+
+def get_items(path, journal):
+  """
+  Creates the pipeline items for the records of a batch file, resuming each
+  record from its last completed stage
+  Args:
+    path: The path of the batch file
+    journal: The Journal of the completed stages
+  Returns:
+    A generator of the pipeline items that haven't been completed
+  """
+  for i, record in enumerate(read_records(path)):
+    data = util.get_input_data(**{field: record.get(field) for field in FIELDS})
+    title = data['video_url'] or ' - '.join(val for val in (data['track_name'], data['artist_name']) if val)
+    item = {'key': get_key(record), 'data': data, 'index': i, 'title': title,
+            'collection': 'collection_name' in data, 'interactive': False}
+    item = journal.resume(item)
+    if item:
+      yield item
+
+
+class Journal():
+  """
+  A class used to represent an append-only journal of the pipeline stages
+  completed for each batch record
+  ...
+  Attributes
+  ----------
+  path : str
+    The path of the journal file
+  entries : dict
+    The completed stages of each record, keyed by the record key
+  """
+  def __init__(self, path):
+    self.path = path
+    self.entries = defaultdict(dict)
+    self._lock = threading.Lock()
+    if os.path.exists(path):
+      with open(path, encoding='utf-8') as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # Skip a line left incomplete by an interrupted run
+            continue
+          self.entries[entry['key']][entry['stage']] = entry
+    self._file = open(path, 'a', encoding='utf-8')
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+  def record(self, stage, item):
+    """
+    Appends a completed stage of a pipeline item to the journal
+    Args:
+      stage: The name of the completed stage
+      item: The pipeline item
+    """
+    if 'key' not in item:
+      return
+    entry = {'key': item['key'], 'stage': stage}
+    if stage == 'resolve':
+      entry['data'] = dict(item['data'])
+    elif stage == 'download':
+      entry['video'] = item['video']
+    elif stage == 'convert':
+      # Keep whether the song was tagged while converting, and its
+      # loudness, so a resumed song is tagged the same way
+      song = item['song']
+      entry.update(path=item['path'], tagged=song.tagged and song.path == item['path'],
+                   loudness=song.loudness)
+    with self._lock:
+      self.entries[item['key']][stage] = entry
+      self._file.write(json.dumps(entry, default=str)+'\n')
+      self._file.flush()
+
+
+  def resume(self, item):
+    """
+    Restores the results of the completed stages of a pipeline item
+    Args:
+      item: The pipeline item
+    Returns:
+      The item, or None if every stage has been completed
+    """
+    done = self.entries.get(item['key'], {})
+    if 'tag' in done:
+      return None
+    if 'resolve' in done:
+      item['data'] = defaultdict(str, done['resolve']['data'])
+      item['song'] = Song(item['data'])
+      # Only reuse intermediate files which still exist
+      if 'convert' in done and os.path.exists(done['convert']['path']):
+        item['path'] = item['song'].path = done['convert']['path']
+        item['song'].tagged = done['convert'].get('tagged', False)
+        item['song'].loudness = done['convert'].get('loudness')
+      elif 'download' in done and os.path.exists(done['download']['video']):
+        item['video'] = done['download']['video']
+    return item
+
+
+  def close(self):
+    """
+    Closes the journal file
+    """
+    self._file.close()
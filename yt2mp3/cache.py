@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/cache.py
+Brett Stevenson (c) 2018
+"""
+
+import os, time, pickle, sqlite3, threading
+
+# The default location of the persistent caches
+directory = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'yt2mp3')
+# Set to False to bypass every cache
+enabled = True
+
+_stores = list()
+
+
+def clear():
+  """
+  Removes every entry from each of the persistent caches
+  """
+  for store in _stores:
+    store.clear()
+
+
+class Store():
+  """
+  A class used to represent a persistent key-value cache backed by SQLite
+  ...
+  Attributes
+  ----------
+  name : str
+    The name of the cache, used as the database filename
+  ttl : int
+    The number of seconds an entry remains valid, or None to never expire
+  directory : str
+    The directory containing the database, defaults to the cache directory
+  max_entries : int
+    The number of entries kept before the least recently used are evicted
+  """
+  def __init__(self, name, ttl=None, directory=None, max_entries=None):
+    self.name = name
+    self.ttl = ttl
+    self.directory = directory
+    self.max_entries = max_entries
+    self._conn = None
+    self._lock = threading.Lock()
+    _stores.append(self)
+
+
+  @property
+  def path(self):
+    return os.path.join(self.directory or directory, self.name+'.db')
+
+
+  def _connect(self):
+    if self._conn is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+      self._conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, '
+                         'value BLOB, created REAL, accessed REAL)')
+      self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+    return self._conn
+
+
+  def get(self, key, default=None):
+    """
+    Retrieves a cached value
+    Args:
+      key: A string identifying the cached value
+      default: The value returned if the key isn't cached or has expired
+    Returns:
+      The cached value, if a valid entry exists
+    """
+    if not enabled:
+      return default
+    now = time.time()
+    with self._lock:
+      conn = self._connect()
+      row = conn.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+      if row is None or (self.ttl is not None and now-row[1] > self.ttl):
+        return default
+      if self.max_entries:
+        with conn:
+          conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+    return pickle.loads(row[0])
+
+
+  def set(self, key, value):
+    """
+    Adds or replaces a cached value
+    Args:
+      key: A string identifying the cached value
+      value: A picklable value to cache
+    """
+    if not enabled:
+      return
+    blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    now = time.time()
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.execute('REPLACE INTO entries (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                     (key, blob, now, now))
+        # Evict the least recently used entries beyond the size cap
+        if self.max_entries:
+          conn.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries '
+                       'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+  def values(self):
+    """
+    Retrieves every valid cached value
+    Returns:
+      A generator of the cached values
+    """
+    if not enabled:
+      return
+    now = time.time()
+    with self._lock:
+      rows = self._connect().execute('SELECT value, created FROM entries').fetchall()
+    for value, created in rows:
+      if self.ttl is None or now-created <= self.ttl:
+        yield pickle.loads(value)
+
+
+  def clear(self):
+    """
+    Removes every entry from the cache
+    """
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.execute('DELETE FROM entries')
+
+
+  def close(self):
+    """
+    Closes the connection to the cache database
+    """
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
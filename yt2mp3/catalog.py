@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/catalog.py
+Brett Stevenson (c) 2018
+"""
+
+import os, re, json, sqlite3, difflib, threading
+from types import SimpleNamespace
+from yt2mp3 import cache, library, metadata
+
+# A bool specifying if the catalog is used to match video titles
+enabled = True
+# The lowest score of a match which is used without asking the iTunes API
+MATCH_THRESHOLD = 0.75
+# The number of full-text results scored for each title
+CANDIDATES = 20
+# The song data kept for each catalog entry
+FIELDS = ('track_id', 'track_name', 'artist_name', 'collection_name', 'primary_genre_name',
+          'artwork_url_100', 'track_number', 'track_count', 'disc_number', 'disc_count',
+          'release_date', 'track_time')
+
+
+def tokenize(text):
+  """
+  Splits text into normalized words
+  Args:
+    text: A string, or None
+  Returns:
+    A list of the lowercase words of the text
+  """
+  return re.findall(r'\w+', library.normalize(text))
+
+
+def to_entry(result):
+  """
+  Converts an iTunes result into the song data kept in the catalog
+  Args:
+    result: An itunespy result, a dict of its values, or a raw iTunes API
+      result
+  Returns:
+    A dict of the song data, or None if the result isn't a song
+  """
+  if not isinstance(result, dict):
+    result = getattr(result, '__dict__', {})
+  elif 'trackName' in result:
+    if result.get('kind', 'song') != 'song':
+      return None
+    from itunespy.track import Track
+    result = vars(Track(result))
+  if not result.get('track_name') or not result.get('artist_name'):
+    return None
+  return {key: result[key] for key in FIELDS if result.get(key) is not None}
+
+
+def score(keywords, entry):
+  """
+  Rates how well a song matches the keywords of a video title, where the
+  track and artist names should both appear in the title, allowing for
+  misspelled words
+  Args:
+    keywords: A string containing the cleaned video title
+    entry: A dict of song data
+  Returns:
+    A number from 0 to 1, where 1 is an exact match
+  """
+  words = tokenize(keywords)
+  if not words:
+    return 0.0
+  def coverage(tokens):
+    if not tokens:
+      return 0.0
+    found = sum(1 for token in tokens if token in words or difflib.get_close_matches(token, words, 1, 0.8))
+    return found/len(tokens)
+  track = tokenize(entry.get('track_name'))
+  artist = tokenize(entry.get('artist_name'))
+  # Penalize titles with words unrelated to the song
+  similarity = difflib.SequenceMatcher(None, ' '.join(sorted(words)), ' '.join(sorted(track+artist))).ratio()
+  return 0.45*coverage(track)+0.3*coverage(artist)+0.25*similarity
+
+
+class Catalog():
+  """
+  A class used to represent a local catalog of song data, with a full-text
+  index for matching video titles without the iTunes API
+  ...
+  Attributes
+  ----------
+  path : str
+    The path of the catalog database
+  """
+  def __init__(self, path):
+    self.path = path
+    self._conn = None
+    self._lock = threading.Lock()
+
+
+  def _connect(self):
+    if self._conn is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+      with self._conn:
+        self._conn.execute('CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, key TEXT UNIQUE, data TEXT)')
+        self._conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(artist, track, album)')
+    return self._conn
+
+
+  def __len__(self):
+    with self._lock:
+      return self._connect().execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+
+  def add(self, results):
+    """
+    Adds or updates the entries of songs
+    Args:
+      results: An iterable of itunespy results, dicts of their values, or
+        raw iTunes API results
+    Returns:
+      The number of songs added or updated
+    """
+    count = 0
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        for result in results:
+          entry = to_entry(result)
+          if entry is None:
+            continue
+          key = str(entry.get('track_id') or '|'.join(library.normalize(entry.get(field)) for field in
+                                                       ('artist_name', 'track_name', 'collection_name')))
+          row = conn.execute('SELECT id FROM songs WHERE key = ?', (key,)).fetchone()
+          if row:
+            conn.execute('UPDATE songs SET data = ? WHERE id = ?', (json.dumps(entry), row[0]))
+            conn.execute('DELETE FROM songs_fts WHERE rowid = ?', row)
+            rowid = row[0]
+          else:
+            rowid = conn.execute('INSERT INTO songs (key, data) VALUES (?, ?)', (key, json.dumps(entry))).lastrowid
+          conn.execute('INSERT INTO songs_fts (rowid, artist, track, album) VALUES (?, ?, ?, ?)',
+                       (rowid, entry['artist_name'], entry['track_name'], entry.get('collection_name', '')))
+          count += 1
+    return count
+
+
+  def search(self, keywords, limit=CANDIDATES):
+    """
+    Finds the songs sharing words with the keywords
+    Args:
+      keywords: A string containing the cleaned video title
+      limit: The maximum number of songs to return
+    Returns:
+      A list of dicts of song data, with the most relevant first
+    """
+    words = tokenize(keywords)
+    if not words:
+      return []
+    terms = ['"%s"' % word for word in words]
+    # Prefer songs containing every word, then every word but one, to allow
+    # for a misspelled or unrelated word, and finally any of the words
+    attempts = [[' AND '.join(terms)]]
+    if len(terms) > 1:
+      attempts.append([' AND '.join(terms[:i]+terms[i+1:]) for i in range(len(terms))])
+    attempts.append([' OR '.join(terms)])
+    rows = dict()
+    with self._lock:
+      conn = self._connect()
+      for queries in attempts:
+        for query in queries:
+          rows.update(conn.execute('SELECT songs.id, songs.data FROM songs_fts JOIN songs ON songs.id = songs_fts.rowid '
+                                   'WHERE songs_fts MATCH ? ORDER BY rank LIMIT ?', (query, limit)).fetchall())
+        if rows:
+          break
+    return [json.loads(data) for data in rows.values()]
+
+
+  def match(self, keywords, threshold=None):
+    """
+    Finds the song best matching the keywords of a video title
+    Args:
+      keywords: A string containing the cleaned video title
+      threshold: The lowest score of a match which is returned, defaults to
+        MATCH_THRESHOLD
+    Returns:
+      An object with the song data as attributes, like the itunespy
+      results, or None if no song scores above the threshold
+    """
+    best, best_score = None, 0.0
+    for entry in self.search(keywords):
+      rating = score(keywords, entry)
+      if rating > best_score:
+        best, best_score = entry, rating
+    if threshold is None:
+      threshold = MATCH_THRESHOLD
+    return SimpleNamespace(**best) if best and best_score >= threshold else None
+
+
+  def import_file(self, path):
+    """
+    Imports the songs of a JSON file of iTunes API results
+    Args:
+      path: The path of a saved iTunes API response, a JSON list of results
+        or a JSON-lines file with a result per line
+    Returns:
+      The number of songs imported
+    """
+    with open(path, encoding='utf-8') as f:
+      try:
+        results = json.load(f)
+      except ValueError:
+        f.seek(0)
+        results = [json.loads(line) for line in f if line.strip()]
+    if isinstance(results, dict):
+      results = results.get('results', [results])
+    return self.add(results)
+
+
+  def import_cache(self, store):
+    """
+    Imports the songs of previously cached iTunes lookups
+    Args:
+      store: The cache Store of the iTunes lookups
+    Returns:
+      The number of songs imported
+    """
+    results = list()
+    for value in store.values():
+      for result in value if isinstance(value, list) else [value]:
+        if hasattr(result, 'track_name'):
+          results.append(result)
+    return self.add(results)
+
+
+  def import_library(self, songs):
+    """
+    Imports the tags of the songs in the output directory
+    Args:
+      songs: The Library of the output directory
+    Returns:
+      The number of songs imported
+    """
+    results = list()
+    for path in songs.paths():
+      try:
+        values = metadata.read(path)
+      except OSError:
+        continue
+      results.append({'track_name': values['track'], 'artist_name': values['artist'],
+                      'collection_name': values['album'], 'primary_genre_name': values['genre'],
+                      'track_number': values['track_number'], 'track_count': values['track_count'],
+                      'disc_number': values['disc_number'], 'disc_count': values['disc_count'],
+                      'release_date': values['date']})
+    return self.add(results)
+
+
+  def close(self):
+    """
+    Closes the catalog database
+    """
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog(create=False):
+  """
+  Retrieves the catalog shared by the program
+  Args:
+    create: A bool specifying if the catalog should be created if it
+      hasn't been built
+  Returns:
+    The Catalog, or None if it's disabled or hasn't been built
+  """
+  global _catalog
+  path = os.path.join(cache.directory, 'catalog.db')
+  if not create and not (enabled and (_catalog or os.path.exists(path))):
+    return None
+  with _catalog_lock:
+    if _catalog is None:
+      _catalog = Catalog(path)
+    return _catalog
+
+
+def build(paths=()):
+  """
+  Imports the cached iTunes lookups, the tags of the library and any files
+  of iTunes API results into the catalog
+  Args:
+    paths: A list of paths of JSON files of iTunes API results
+  Returns:
+    The number of songs imported
+  """
+  from yt2mp3 import itunes
+  songs = get_catalog(create=True)
+  count = songs.import_cache(itunes.get_store())+songs.import_library(library.get_library())
+  for path in paths:
+    count += songs.import_file(path)
+  return count
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/chapters.py
+Brett Stevenson (c) 2018
+"""
+
+import re, difflib, logging
+from collections import defaultdict
+from colorama import Fore, Style
+from yt2mp3 import itunes, library, metadata, video
+from yt2mp3.song import Song
+
+# The similarity a chapter title needs to be matched to an album track
+MATCH_THRESHOLD = 0.6
+# The album data kept for chapters which don't match a track
+ALBUM_FIELDS = ('artist_name', 'collection_name', 'primary_genre_name', 'artwork_url_100',
+                'release_date', 'track_count', 'disc_number', 'disc_count')
+
+
+def get_chapters(info):
+  """
+  Reads the chapters of a video from its extracted info
+  Args:
+    info: The youtube_dl info of the video
+  Returns:
+    A list of dicts containing the title, start and end of each chapter in
+    seconds, ordered by their start, where the end of the last chapter may
+    be None
+  """
+  chapters = sorted(info.get('chapters') or [], key=lambda chapter: chapter.get('start_time') or 0)
+  results = list()
+  for i, chapter in enumerate(chapters):
+    end = chapter.get('end_time')
+    if end is None and i+1 < len(chapters):
+      end = chapters[i+1].get('start_time')
+    results.append({'title': chapter.get('title') or 'Track %s' % (i+1),
+                    'start': float(chapter.get('start_time') or 0),
+                    'end': None if end is None else float(end)})
+  return results
+
+
+def clean_title(title):
+  """
+  Removes the numbering and timestamps from a chapter title
+  Args:
+    title: The title of the chapter
+  Returns:
+    The title of the track
+  """
+  title = re.sub(r'\(?\b\d{1,2}:\d{2}(:\d{2})?\b\)?', '', title)
+  title = re.sub(r'^\s*\d{1,3}\s*[.):\-–]?\s+', '', title)
+  return ' '.join(title.strip(' -–|:').split())
+
+
+def similarity(title, track):
+  """
+  Rates how closely a chapter title matches the name of a track
+  Args:
+    title: The cleaned title of the chapter
+    track: The track name
+  Returns:
+    A number from 0 to 1, where 1 is an exact match
+  """
+  title = library.normalize(video.get_keywords(title))
+  track = library.normalize(video.get_keywords(track))
+  if not title or not track:
+    return 0.0
+  if title in track or track in title:
+    return max(0.9, difflib.SequenceMatcher(None, title, track).ratio())
+  return difflib.SequenceMatcher(None, title, track).ratio()
+
+
+def match(titles, tracks, threshold=MATCH_THRESHOLD):
+  """
+  Pairs each chapter title with a different track of the album, best
+  matches first
+  Args:
+    titles: A list of the cleaned chapter titles
+    tracks: A list of the songs of the album, in track order
+    threshold: The similarity required to match a title to a track
+  Returns:
+    A list of the track matched to each title, or None if no track matches
+  """
+  scores = sorted(((similarity(title, track.track_name), i, j) for i, title in enumerate(titles)
+                   for j, track in enumerate(tracks)), key=lambda score: -score[0])
+  matched, used = [None]*len(titles), set()
+  for score, i, j in scores:
+    if score < threshold:
+      break
+    if matched[i] is None and j not in used:
+      matched[i] = tracks[j]
+      used.add(j)
+  # The chapters of a complete album follow the order of its tracks
+  if len(titles) == len(tracks):
+    for i, track in enumerate(tracks):
+      if matched[i] is None and i not in used:
+        matched[i] = track
+        used.add(i)
+  return matched
+
+
+def get_songs(url):
+  """
+  Retrieves the song data of each chapter of a video, matching the chapter
+  titles against the tracks of the album named by the video title
+  Args:
+    url: A YouTube video URL
+  Returns:
+    A list of tuples of the Song and the start and end of its chapter in
+    seconds
+  Raises:
+    LookupError: If the video doesn't have chapters
+  """
+  info = video.get_info(url)
+  chapters = get_chapters(info)
+  if not chapters:
+    raise LookupError('The video doesn\'t have any chapters: '+url)
+  try:
+    tracks = itunes.get_album(video.get_keywords(info.get('title')))
+  except LookupError:
+    tracks = list()
+  tracks = sorted(tracks, key=lambda track: (metadata.to_number(getattr(track, 'disc_number', 0)),
+                                             metadata.to_number(getattr(track, 'track_number', 0))))
+  titles = [clean_title(chapter['title']) for chapter in chapters]
+  matches = match(titles, tracks)
+  if tracks:
+    logging.info(Fore.GREEN+'✔ '+Style.RESET_ALL+'Matched %s of %s chapters to %s',
+                 sum(1 for track in matches if track), len(chapters), tracks[0].collection_name)
+  else:
+    logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Unable to find the album, tagging the chapters by their titles')
+  thumbnail = 'https://img.youtube.com/vi/'+video.get_id(url)+'/maxresdefault.jpg'
+  sections = list()
+  for i, (chapter, title, track) in enumerate(zip(chapters, titles, matches)):
+    if track:
+      data = defaultdict(str, track.__dict__)
+    elif tracks:
+      data = defaultdict(str, {key: getattr(tracks[0], key, '') for key in ALBUM_FIELDS})
+      data.update(track_name=title, track_number=i+1)
+    else:
+      data = defaultdict(str, track_name=title, artist_name=info.get('uploader') or '',
+                         collection_name=info.get('title') or '', track_number=i+1,
+                         track_count=len(chapters), disc_number=1, disc_count=1)
+    data['video_url'] = url
+    if not data['artwork_url_100']:
+      data['artwork_url_100'] = thumbnail
+    song = Song(data)
+    song.filename = song.filename.replace('/', '')
+    sections.append((song, chapter['start'], chapter['end']))
+  return sections
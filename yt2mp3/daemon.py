@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/daemon.py
+Brett Stevenson (c) 2018
+"""
+
+import os, json, time, uuid, queue, socket, logging, threading, http.client, socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from colorama import Fore, Style
+from yt2mp3 import cache, util
+
+# The number of seconds between polls of a submitted job
+POLL_INTERVAL = 0.5
+# The number of seconds a client waits for the daemon to respond
+CLIENT_TIMEOUT = 10
+# The number of finished jobs kept for polling
+HISTORY = 1000
+# The options of a job which override those the daemon was started with
+JOB_OPTIONS = ('collection', 'overwrite', 'format', 'stream', 'resolution', 'replaygain')
+
+
+def get_default_address():
+  """
+  Determines the address the daemon listens on when none is specified
+  Returns:
+    The path of a Unix socket in the cache directory, or a localhost port
+    where Unix sockets aren't supported
+  """
+  if hasattr(socket, 'AF_UNIX'):
+    return os.path.join(cache.directory, 'daemon.sock')
+  return '127.0.0.1:8765'
+
+
+def parse_address(address):
+  """
+  Parses the address of the daemon
+  Args:
+    address: The path of a Unix socket, or a localhost port as 'PORT' or
+      'HOST:PORT'
+  Returns:
+    The socket path, or a tuple of the host and port
+  """
+  address = address or get_default_address()
+  host, _, port = address.rpartition(':')
+  if port.isdigit() and os.sep not in address:
+    return (host or '127.0.0.1', int(port))
+  return address
+
+
+class Job():
+  """
+  A class used to represent a submitted request and the songs converted
+  for it
+  ...
+  Attributes
+  ----------
+  id : str
+    The identifier used to poll the job
+  request : dict
+    The submitted URL, track, artist, album or playlist, and options
+  status : str
+    'queued', 'running', 'done' or 'failed'
+  songs : list
+    A dict of the title, status, path and error of each song
+  error : str
+    The reason the job failed, if it did
+  """
+  def __init__(self, request):
+    self.id = uuid.uuid4().hex[:12]
+    self.request = request
+    self.status = 'queued'
+    self.songs = list()
+    self.error = None
+    self.created = time.time()
+    self.finished = None
+    self.expanded = False
+
+
+  def to_dict(self):
+    return {'id': self.id, 'request': self.request, 'status': self.status, 'songs': self.songs,
+            'error': self.error, 'created': self.created, 'finished': self.finished}
+
+
+class Daemon():
+  """
+  A class used to represent a long-running worker, which passes the songs
+  of each submitted job through a single pipeline so that the imports,
+  caches, connections and converter processes stay warm between jobs
+  ...
+  Attributes
+  ----------
+  create_pipeline : callable
+    A function taking a stage callback and errback which returns the
+    Pipeline songs are converted with
+  jobs : dict
+    The submitted jobs, keyed by ID
+  """
+  def __init__(self, create_pipeline):
+    self.create_pipeline = create_pipeline
+    self.jobs = dict()
+    self._queue = queue.Queue()
+    self._lock = threading.Lock()
+    self._pipeline = None
+    self._thread = None
+
+
+  def start(self):
+    """
+    Starts converting the songs of submitted jobs in the background
+    """
+    self._pipeline = self.create_pipeline(self._completed, self._failed)
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+
+  def close(self):
+    """
+    Stops the pipeline, abandoning any unfinished jobs
+    """
+    self._queue.put(None)
+    if self._pipeline:
+      self._pipeline.close()
+
+
+  def submit(self, request):
+    """
+    Queues a job
+    Args:
+      request: A dict containing the url, track, artist and album of a song,
+        or the playlist URL or ID, and any options overriding the daemon's
+    Returns:
+      The queued Job
+    Raises:
+      ValueError: If the request doesn't specify any songs
+    """
+    if not (request.get('url') or request.get('playlist') or request.get('track') and request.get('artist')):
+      raise ValueError('A video URL, playlist or track and artist name are required')
+    job = Job(request)
+    with self._lock:
+      self.jobs[job.id] = job
+      # Forget the oldest finished jobs
+      finished = [other for other in self.jobs.values() if other.finished]
+      for other in sorted(finished, key=lambda other: other.finished)[:max(0, len(self.jobs)-HISTORY)]:
+        del self.jobs[other.id]
+    self._queue.put(job)
+    return job
+
+
+  def get(self, job_id):
+    """
+    Retrieves the status of a job
+    Args:
+      job_id: The ID of the job
+    Returns:
+      A dict of the job, or None if it doesn't exist
+    """
+    with self._lock:
+      job = self.jobs.get(job_id)
+      return json.loads(json.dumps(job.to_dict())) if job else None
+
+
+  def list(self):
+    """
+    Lists the status of every job
+    Returns:
+      A list of dicts of the jobs, oldest first
+    """
+    with self._lock:
+      return [{'id': job.id, 'status': job.status, 'songs': len(job.songs)}
+              for job in sorted(self.jobs.values(), key=lambda job: job.created)]
+
+
+  def _run(self):
+    for _ in self._pipeline.run(self._items()):
+      pass
+
+
+  def _items(self):
+    """
+    Creates the pipeline items of each job as it's submitted
+    """
+    while True:
+      job = self._queue.get()
+      if job is None:
+        return
+      options = {key: job.request[key] for key in JOB_OPTIONS if job.request.get(key) is not None}
+      try:
+        if job.request.get('playlist'):
+          playlist = job.request['playlist']
+          url = 'https://www.youtube.com/playlist?list='+playlist.split('list=')[-1]
+          videos = ((vid['url'], vid['title']) for vid in util.get_video_list(url))
+        else:
+          videos = [(job.request.get('url'), None)]
+        for i, (url, title) in enumerate(videos):
+          data = util.get_input_data(job.request.get('track'), job.request.get('artist'),
+                                     job.request.get('album'), url)
+          data['video_title'] = title or ''
+          with self._lock:
+            job.status = 'running'
+            job.songs.append({'title': title or data['video_url'] or data['track_name'],
+                              'status': 'queued', 'path': None, 'error': None})
+          yield dict(options, key='%s/%s' % (job.id, i), job=job.id, position=i, data=data,
+                     interactive=False, collection=options.get('collection', 'collection_name' in data))
+      except Exception as err:
+        with self._lock:
+          job.error = str(err)
+      with self._lock:
+        job.expanded = True
+        self._update(job)
+
+
+  def _completed(self, stage, item):
+    with self._lock:
+      job = self.jobs.get(item['job'])
+      if job is None:
+        return
+      song = job.songs[item['position']]
+      song['status'] = stage
+      if 'song' in item:
+        song['title'] = item['song'].artist+' - '+item['song'].track
+      if stage == 'tag':
+        song['status'] = 'done'
+        song['path'] = item['path']
+        self._update(job)
+
+
+  def _failed(self, stage, item, err):
+    with self._lock:
+      job = self.jobs.get(item['job'])
+      if job is None:
+        return
+      song = job.songs[item['position']]
+      if err is None:
+        # Songs are only dropped once they're found in the output directory
+        song['status'] = 'skipped'
+      else:
+        song['status'] = 'failed'
+        song['error'] = '%s failed: %s' % (stage, err)
+      self._update(job)
+
+
+  def _update(self, job):
+    """
+    Marks a job as finished once every one of its songs has been completed
+    """
+    if not job.expanded or any(song['status'] not in ('done', 'failed', 'skipped') for song in job.songs):
+      return
+    if job.error or not job.songs or all(song['status'] == 'failed' for song in job.songs):
+      job.status = 'failed'
+    else:
+      job.status = 'done'
+    job.finished = time.time()
+
+
+class Handler(BaseHTTPRequestHandler):
+  """
+  Serves the JSON API of the daemon
+    POST /jobs         submits a job, responding with its ID
+    GET  /jobs         lists the jobs
+    GET  /jobs/{id}    responds with the status and songs of a job
+    GET  /status       responds if the daemon is running
+  """
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    daemon = self.server.daemon
+    if self.path == '/status':
+      self._send(200, {'status': 'running', 'pid': os.getpid()})
+    elif self.path == '/jobs':
+      self._send(200, {'jobs': daemon.list()})
+    elif self.path.startswith('/jobs/'):
+      job = daemon.get(self.path[len('/jobs/'):])
+      self._send(200 if job else 404, job or {'error': 'No such job'})
+    else:
+      self._send(404, {'error': 'Not found'})
+
+
+  def do_POST(self):
+    if self.path != '/jobs':
+      self._send(404, {'error': 'Not found'})
+      return
+    try:
+      length = int(self.headers.get('Content-Length') or 0)
+      request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+      if not isinstance(request, dict):
+        raise ValueError('The job must be a JSON object')
+      job = self.server.daemon.submit(request)
+    except ValueError as err:
+      self._send(400, {'error': str(err)})
+      return
+    self._send(202, {'id': job.id, 'status': job.status})
+
+
+  def _send(self, status, body):
+    content = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+
+  def address_string(self):
+    # Unix socket clients have no address
+    return self.client_address[0] if self.client_address else 'local'
+
+
+  def log_message(self, format, *args):
+    logging.debug('Daemon: '+format, *args)
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+  class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(daemon, address=None):
+  """
+  Creates the HTTP server of the daemon's API
+  Args:
+    daemon: The Daemon jobs are submitted to
+    address: The path of a Unix socket, or a localhost port
+  Returns:
+    A server listening on the address, whose serve_forever method handles
+    requests until its shutdown method is called
+  Raises:
+    OSError: If another daemon is already listening on the address
+  """
+  address = parse_address(address)
+  if isinstance(address, tuple):
+    server = ThreadingHTTPServer(address, Handler)
+  else:
+    if os.path.exists(address):
+      if is_running(address):
+        raise OSError('A daemon is already listening on '+address)
+      # Remove the socket of a daemon which didn't shut down cleanly
+      os.remove(address)
+    os.makedirs(os.path.dirname(os.path.abspath(address)), exist_ok=True)
+    server = UnixHTTPServer(address, Handler)
+  server.daemon = daemon
+  return server
+
+
+def serve(create_pipeline, address=None):
+  """
+  Runs the daemon until it's interrupted
+  Args:
+    create_pipeline: A function taking a stage callback and errback which
+      returns the Pipeline songs are converted with
+    address: The path of a Unix socket, or a localhost port
+  """
+  daemon = Daemon(create_pipeline)
+  server = create_server(daemon, address)
+  daemon.start()
+  location = server.server_address
+  if isinstance(location, tuple):
+    location = 'http://%s:%s' % location[:2]
+  logging.info(Fore.GREEN+'✔ '+Style.RESET_ALL+'Listening for jobs on %s', location)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    daemon.close()
+    if not isinstance(server.server_address, tuple) and os.path.exists(server.server_address):
+      os.remove(server.server_address)
+
+
+class UnixConnection(http.client.HTTPConnection):
+  """
+  An HTTP connection over a Unix socket
+  """
+  def __init__(self, path, timeout=CLIENT_TIMEOUT):
+    super().__init__('localhost', timeout=timeout)
+    self.path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.path)
+
+
+def request(address, method, path, body=None):
+  """
+  Sends a request to the daemon's API
+  Args:
+    address: The path of a Unix socket, or a localhost port
+    method: The HTTP method
+    path: The path of the API endpoint
+    body: A dict sent as JSON, if any
+  Returns:
+    The decoded JSON response
+  Raises:
+    OSError: If the daemon isn't running
+    ValueError: If the daemon rejects the request
+  """
+  address = parse_address(address)
+  if isinstance(address, tuple):
+    conn = http.client.HTTPConnection(*address, timeout=CLIENT_TIMEOUT)
+  else:
+    conn = UnixConnection(address)
+  try:
+    content = json.dumps(body).encode('utf-8') if body is not None else None
+    conn.request(method, path, body=content, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    result = json.loads(response.read().decode('utf-8'))
+  finally:
+    conn.close()
+  if response.status >= 400:
+    raise ValueError(result.get('error') or 'The daemon responded with %s' % response.status)
+  return result
+
+
+def is_running(address=None):
+  """
+  Checks if a daemon is listening on an address
+  Args:
+    address: The path of a Unix socket, or a localhost port
+  Returns:
+    A bool indicating whether jobs can be submitted to the daemon
+  """
+  location = parse_address(address)
+  if not isinstance(location, tuple) and not os.path.exists(location):
+    return False
+  try:
+    return request(address, 'GET', '/status').get('status') == 'running'
+  except (OSError, ValueError):
+    return False
+
+
+def submit(request_data, address=None, wait=True, interval=POLL_INTERVAL):
+  """
+  Submits a job to the daemon, logging each song as it's completed
+  Args:
+    request_data: A dict containing the url, track, artist and album of a
+      song, or the playlist URL or ID, and any options
+    address: The path of a Unix socket, or a localhost port
+    wait: A bool specifying if the job should be polled until it finishes
+    interval: The number of seconds between polls
+  Returns:
+    A dict of the job
+  """
+  job = request(address, 'POST', '/jobs', request_data)
+  logging.info(Fore.YELLOW+'↳ '+Style.RESET_ALL+'Submitted job %s to the daemon', job['id'])
+  reported = set()
+  while wait:
+    job = request(address, 'GET', '/jobs/'+job['id'])
+    for i, song in enumerate(job['songs']):
+      if i in reported or song['status'] not in ('done', 'failed', 'skipped'):
+        continue
+      reported.add(i)
+      if song['status'] == 'done':
+        logging.info(Fore.GREEN+'✔ '+Style.RESET_ALL+'%s: %s', song['title'], song['path'])
+      elif song['status'] == 'skipped':
+        logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'%s already exists in the output directory', song['title'])
+      else:
+        logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'%s: %s', song['title'], song['error'])
+    if job['status'] in ('done', 'failed'):
+      if job['error']:
+        logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+job['error'])
+      break
+    time.sleep(interval)
+  return job
@@ -8,9 +8,24 @@ yt2mp3/itunes.py
 Brett Stevenson (c) 2018
 """
 
-import sys, os, itunespy, logging
+import sys, os, logging, threading
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 from colorama import Fore, Style
+from yt2mp3 import cache, stats, throttle
+
+CACHE_TTL = 30*24*60*60
+CACHE_SIZE = 10000
+# The number of albums whose tracks are retrieved by each lookup request,
+# and the number of requests made concurrently
+ALBUM_BATCH = 10
+ALBUM_JOBS = 4
+# The maximum number of results of a lookup request
+LOOKUP_LIMIT = 200
+
+# Marks a query that hasn't been cached
+_MISSING = object()
+_store = cache.Store('itunes', CACHE_TTL, max_entries=CACHE_SIZE)
 
 
 def get_data(data, exit_fail=True):
@@ -23,32 +38,133 @@ def get_data(data, exit_fail=True):
     A dict of song data retrieved from the iTunes API, if a match is found
   Raises:
     LookupError: If a match isn't found using the iTunes API
+    ConnectionError: If the iTunes API can't be reached or keeps throttling
+      requests
   """
   try:
-    if data['track_name'] and data['artist_name']:
-      for song in itunespy.search_track(data['track_name']):
-        if data['artist_name'].lower() == song.artist_name.lower():
-          if 'collection_name' not in data.keys():
-            return song
-          elif data['collection_name'].lower() in song.collection_name.lower():
-            return song
-    elif data['track_name']:
-      return itunespy.search_track(data['track_name'])
-    elif data['artist_name']:
-      songs = []
-      artists = itunespy.search_artist(data['artist_name'])[0]
-      for album in artists.get_albums():
-        for song in album.get_tracks():
-          songs.append(song)
-      return songs
-    # Attempt to find a close match if no exact matches
-    song = itunespy.search(' '.join([data['track_name'], data['artist_name'], data['collection_name']]))[0]
-    if song:
-      return song
+    if data.get('artist_name') and not data.get('track_name'):
+      return list(get_discography(data['artist_name']))
+    key = get_key('data', data.get('track_name'), data.get('artist_name'),
+                  data.get('collection_name'))
+    return _cached(key, _lookup_data, data)
   except LookupError as err:
     if exit_fail:
       logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+str(err))
       sys.exit()
+  except ConnectionError as err:
+    # Unlike a missing song, a failed request shouldn't pass for no match
+    if exit_fail:
+      logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Unable to reach the iTunes API: %s', err)
+      sys.exit()
+    raise
+
+
+def _lookup_data(data):
+  import itunespy
+  if data['track_name'] and data['artist_name']:
+    for song in search(itunespy.search_track, data['track_name']):
+      if data['artist_name'].lower() == song.artist_name.lower():
+        if 'collection_name' not in data.keys():
+          return song
+        elif data['collection_name'].lower() in song.collection_name.lower():
+          return song
+  elif data['track_name']:
+    return search(itunespy.search_track, data['track_name'])
+  # Attempt to find a close match if no exact matches
+  song = search(itunespy.search, ' '.join([data['track_name'], data['artist_name'], data['collection_name']]))[0]
+  if song:
+    return song
+
+
+def get_discography(artist_name, jobs=None):
+  """
+  Retrieves every song by an artist, looking up the tracks of several
+  albums per request and making the requests concurrently. Songs are
+  yielded as their albums arrive, and the full discography is cached once
+  every album has been retrieved, even if the caller stops reading early.
+  Args:
+    artist_name: The artist name query
+    jobs: The number of lookup requests made concurrently
+  Returns:
+    A generator of the songs of each album, in the order of the albums
+  Raises:
+    LookupError: If the artist or their albums can't be found
+  """
+  key = get_key('discography', artist_name)
+  songs = _store.get(key, _MISSING)
+  if songs is not _MISSING:
+    for song in songs:
+      yield song
+    return
+  import itunespy
+  with stats.span('itunes.lookup'):
+    artist = search(itunespy.search_artist, artist_name)[0]
+    albums = search(itunespy.lookup, id=artist.artist_id, entity='album', limit=LOOKUP_LIMIT)[1:]
+  ids = [str(album.collection_id) for album in albums]
+  if not ids:
+    raise LookupError('No albums found for the artist '+artist_name)
+  batches = [ids[i:i+ALBUM_BATCH] for i in range(0, len(ids), ALBUM_BATCH)]
+  executor = ThreadPoolExecutor(max_workers=max(1, jobs or ALBUM_JOBS))
+  futures = [executor.submit(stats.bind(_lookup_tracks), batch) for batch in batches]
+  executor.shutdown(wait=False)
+  try:
+    for future in futures:
+      for song in future.result():
+        yield song
+  finally:
+    if all(future.done() for future in futures):
+      _store_discography(key, futures)
+    else:
+      threading.Thread(target=_store_discography, args=(key, futures), daemon=True).start()
+
+
+def _store_discography(key, futures):
+  """
+  Caches a discography once the tracks of every album have been retrieved
+  """
+  try:
+    _store.set(key, [song for future in futures for song in future.result()])
+  except Exception:
+    # Leave a discography with missing albums uncached
+    pass
+
+
+def _lookup_tracks(ids):
+  """
+  Retrieves the tracks of several albums with a single lookup request
+  Args:
+    ids: A list of iTunes album IDs
+  Returns:
+    A list of the songs of each album, in the order of the albums
+  """
+  import itunespy
+  with stats.span('itunes.lookup'):
+    results = search(itunespy.lookup, id=','.join(ids), entity='song', limit=LOOKUP_LIMIT)
+  tracks = defaultdict(list)
+  for result in results:
+    if getattr(result, 'kind', None) == 'song':
+      tracks[str(result.collection_id)].append(result)
+  return [song for album in ids for song in tracks[album]]
+
+
+def get_album(keywords):
+  """
+  Retrieves the tracks of the album best matching the keywords
+  Args:
+    keywords: A string containing album and artist keywords
+  Returns:
+    A list of the songs of the album, in the order returned by the iTunes API
+  Raises:
+    LookupError: If a matching album isn't found using the iTunes API
+  """
+  import itunespy
+  def lookup():
+    album = search(itunespy.search_album, keywords)[0]
+    tracks = _lookup_tracks([str(album.collection_id)])
+    if not tracks:
+      raise LookupError('No tracks found for the album '+album.collection_name)
+    return tracks
+  return _cached(get_key('album', keywords), lookup)
 
 
 def keyword_search(keywords):
@@ -61,7 +177,81 @@ def keyword_search(keywords):
   Raises:
     LookupError: If a match isn't found using the iTunes API
   """
+  import itunespy
   try:
-    return itunespy.search(keywords)[0]
+    return _cached(get_key('search', keywords), lambda: search(itunespy.search, keywords)[0])
   except LookupError:
-    return None
\ No newline at end of file
+    return None
+
+
+def search(func, *args, **kwargs):
+  """
+  Sends a request to the iTunes API within its rate limit, retrying it if
+  it's throttled
+  Args:
+    func: The itunespy function making the request
+    args: The arguments of the function
+    kwargs: The keyword arguments of the function
+  Returns:
+    The itunespy results
+  Raises:
+    LookupError: If no results are found
+    ThrottledError: If the request is still throttled after every retry
+  """
+  return throttle.call(throttle.ITUNES, func, *args, **kwargs)
+
+
+def get_key(kind, *values):
+  """
+  Normalizes an iTunes query into a cache key
+  Args:
+    kind: A string identifying the type of query
+    values: The query values, where None marks a missing value
+  Returns:
+    A string which is identical for equivalent queries
+  """
+  values = ['\0' if val is None else ' '.join(str(val).lower().split()) for val in values]
+  return '|'.join([kind]+values)
+
+
+def get_store():
+  """
+  Retrieves the persistent cache of iTunes lookups
+  Returns:
+    The Store of the cached results
+  """
+  return _store
+
+
+def set_cache_ttl(days):
+  """
+  Sets the number of days cached iTunes results remain valid
+  Args:
+    days: A number of days
+  """
+  _store.ttl = days*24*60*60
+
+
+def _cached(key, lookup, *args):
+  """
+  Retrieves the result of an iTunes lookup from the cache, or performs the
+  lookup and caches its result, including failures to find a match
+  Args:
+    key: The normalized query
+    lookup: A function which queries the iTunes API
+  Returns:
+    The result of the lookup
+  Raises:
+    LookupError: If a match isn't found using the iTunes API
+  """
+  result = _store.get(key, _MISSING)
+  if result is _MISSING:
+    try:
+      with stats.span('itunes.lookup'):
+        result = lookup(*args)
+    except LookupError as err:
+      result = err
+    _store.set(key, result)
+  if isinstance(result, LookupError):
+    raise LookupError(*result.args)
+  return result
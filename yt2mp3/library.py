@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/library.py
+Brett Stevenson (c) 2018
+"""
+
+import os, sqlite3, threading
+from yt2mp3 import cache, metadata
+
+# The output directory of the converted songs
+directory = os.path.expanduser('~/Downloads/Music/')
+EXTENSIONS = ('.mp3', '.m4a', '.opus')
+
+
+def normalize(value):
+  """
+  Normalizes a tag value for comparison
+  Args:
+    value: A string, or None
+  Returns:
+    The lowercase value with consecutive whitespace collapsed
+  """
+  return ' '.join(str(value or '').lower().split())
+
+
+class Library():
+  """
+  A class used to represent an index of the songs in the output directory,
+  kept incrementally in SQLite
+  ...
+  Attributes
+  ----------
+  directory : str
+    The output directory of the converted songs
+  path : str
+    The path of the index database
+  """
+  def __init__(self, directory, path):
+    self.directory = directory
+    self.path = path
+    self._conn = None
+    self._lock = threading.Lock()
+    self._refreshed = False
+
+
+  def _connect(self):
+    if self._conn is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+      with self._conn:
+        self._conn.execute('CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY KEY, mtime REAL, '
+                           'size INTEGER, video_id TEXT, artist TEXT, track TEXT, album TEXT)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS songs_video_id ON songs (video_id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS songs_artist_track ON songs (artist, track)')
+    return self._conn
+
+
+  def refresh(self, force=False):
+    """
+    Updates the index with the songs added, changed or removed since the
+    last refresh, only reading the tags of files with a new mtime or size
+    Args:
+      force: A bool specifying if the index should be refreshed again
+    """
+    with self._lock:
+      if self._refreshed and not force:
+        return
+      conn = self._connect()
+      known = {row[0]: (row[1], row[2]) for row in conn.execute('SELECT path, mtime, size FROM songs')}
+      changed = list()
+      for path, stat in self._scan():
+        if known.pop(path, None) != (stat.st_mtime, stat.st_size):
+          changed.append((path, stat.st_mtime, stat.st_size)+read_tags(path))
+      with conn:
+        conn.executemany('DELETE FROM songs WHERE path = ?', [(path,) for path in known])
+        conn.executemany('REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+      self._refreshed = True
+
+
+  def _scan(self):
+    if not os.path.isdir(self.directory):
+      return
+    for artist in os.scandir(self.directory):
+      if not artist.is_dir():
+        continue
+      for entry in os.scandir(artist.path):
+        # Skip the temporary files of songs being converted
+        if entry.is_file() and entry.name.lower().endswith(EXTENSIONS) and not entry.name.startswith('.'):
+          yield entry.path, entry.stat()
+
+
+  def add(self, path, video_id, artist, track, album):
+    """
+    Adds or updates the index entry of a converted song
+    Args:
+      path: The path of the song
+      video_id: The ID of the source YouTube video
+      artist: The artist name of the song
+      track: The track name of the song
+      album: The album name of the song
+    """
+    stat = os.stat(path)
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.execute('REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (path, stat.st_mtime, stat.st_size, video_id,
+                      normalize(artist), normalize(track), normalize(album)))
+
+
+  def remove(self, path):
+    """
+    Removes the index entry of a deleted song
+    Args:
+      path: The path of the song
+    """
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.execute('DELETE FROM songs WHERE path = ?', (path,))
+
+
+  def paths(self):
+    """
+    Lists the songs in the library
+    Returns:
+      A list of the paths of the songs
+    """
+    self.refresh()
+    with self._lock:
+      return [row[0] for row in self._connect().execute('SELECT path FROM songs')]
+
+
+  def find(self, artist, track, album='', format=None):
+    """
+    Finds a song in the library, regardless of its filename
+    Args:
+      artist: The artist name of the song
+      track: The track name of the song
+      album: The album name the song should be from, if any
+      format: The format the song should be in, if any
+    Returns:
+      The path of the matching song, if one exists
+    """
+    self.refresh()
+    with self._lock:
+      rows = self._connect().execute('SELECT path, album FROM songs WHERE artist = ? AND track = ?',
+                                     (normalize(artist), normalize(track))).fetchall()
+    for path, song_album in rows:
+      if normalize(album) in song_album and has_format(path, format) and self._exists(path):
+        return path
+    return None
+
+
+  def owned(self, video_ids, format=None):
+    """
+    Determines which of the provided videos have already been converted
+    Args:
+      video_ids: An iterable of YouTube video IDs
+      format: The format the songs should be in, if any
+    Returns:
+      A set of the video IDs with a song in the library
+    """
+    self.refresh()
+    video_ids = list(video_ids)
+    rows = list()
+    with self._lock:
+      conn = self._connect()
+      # Stay within SQLite's limit on query parameters
+      for i in range(0, len(video_ids), 500):
+        batch = video_ids[i:i+500]
+        query = 'SELECT video_id, path FROM songs WHERE video_id IN (%s)' % ','.join('?'*len(batch))
+        rows.extend(conn.execute(query, batch))
+    return set(video_id for video_id, path in rows if has_format(path, format) and self._exists(path))
+
+
+  def find_video(self, video_id, format=None):
+    """
+    Finds the song converted from a video
+    Args:
+      video_id: The ID of the YouTube video
+      format: The format the song should be in, if any
+    Returns:
+      The path of the song, if one exists
+    """
+    self.refresh()
+    with self._lock:
+      rows = self._connect().execute('SELECT path FROM songs WHERE video_id = ?', (video_id,)).fetchall()
+    for path, in rows:
+      if has_format(path, format) and self._exists(path):
+        return path
+    return None
+
+
+  def _exists(self, path):
+    """
+    Checks that an indexed song hasn't been deleted or moved since the
+    index was refreshed, removing its entry if it has
+    """
+    if os.path.isfile(path):
+      return True
+    self.remove(path)
+    return False
+
+
+def has_format(path, format=None):
+  """
+  Checks if a song is in the specified output format
+  Args:
+    path: The path of the song
+    format: The output format, 'mp3', 'm4a' or 'opus', or None for any
+  Returns:
+    A bool indicating whether the song has the extension of the format
+  """
+  return format is None or path.lower().endswith('.'+format)
+
+
+def read_tags(path):
+  """
+  Reads the values indexed for a song from its tags
+  Args:
+    path: The path of the song
+  Returns:
+    A tuple of the normalized video ID, artist, track and album
+  """
+  artist = os.path.basename(os.path.dirname(path))
+  track = os.path.splitext(os.path.basename(path))[0]
+  try:
+    values = metadata.read(path)
+  except OSError:
+    return (None, normalize(artist), normalize(track), '')
+  video_id = values['url'].split('watch?v=')[-1] or None
+  return (video_id, normalize(values['artist'] or artist), normalize(values['track'] or track),
+          normalize(values['album']))
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_library():
+  """
+  Retrieves the index of the output directory shared by the program
+  Returns:
+    A Library of the songs in the output directory
+  """
+  global _library
+  with _library_lock:
+    if _library is None:
+      _library = Library(directory, os.path.join(cache.directory, 'library.db'))
+    return _library
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/loudness.py
+Brett Stevenson (c) 2018
+"""
+
+import math
+
+# The loudness the ReplayGain 2.0 and Opus R128 gains bring a track to, in LUFS
+REPLAYGAIN_REFERENCE = -18.0
+R128_REFERENCE = -23.0
+# The length of the gating blocks and the step between them, in seconds,
+# where each block is made of four steps so they overlap by 75%
+BLOCK = 0.4
+STEP = 0.1
+# The thresholds blocks must exceed to count towards the integrated
+# loudness, in LUFS and LU below the ungated loudness respectively
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def get_filters(rate):
+  """
+  Calculates the coefficients of the two biquads of the BS.1770 K-weighting
+  filter, a high shelf modelling the head followed by a high-pass
+  Args:
+    rate: The sample rate of the audio
+  Returns:
+    A list of tuples of the numerator and denominator coefficients of each
+    biquad, normalized so the first denominator coefficient is 1
+  """
+  filters = list()
+  # The high shelf boosting the frequencies above 1.5kHz by 4dB
+  gain, q, freq = 4.0, 1/math.sqrt(2), 1500.0
+  a = 10**(gain/40)
+  w = 2*math.pi*freq/rate
+  alpha = math.sin(w)/(2*q)
+  b = (a*((a+1)+(a-1)*math.cos(w)+2*math.sqrt(a)*alpha),
+       -2*a*((a-1)+(a+1)*math.cos(w)),
+       a*((a+1)+(a-1)*math.cos(w)-2*math.sqrt(a)*alpha))
+  den = ((a+1)-(a-1)*math.cos(w)+2*math.sqrt(a)*alpha,
+         2*((a-1)-(a+1)*math.cos(w)),
+         (a+1)-(a-1)*math.cos(w)-2*math.sqrt(a)*alpha)
+  filters.append((tuple(x/den[0] for x in b), tuple(x/den[0] for x in den)))
+  # The high-pass removing the frequencies below 38Hz
+  q, freq = 0.5, 38.0
+  w = 2*math.pi*freq/rate
+  alpha = math.sin(w)/(2*q)
+  b = ((1+math.cos(w))/2, -(1+math.cos(w)), (1+math.cos(w))/2)
+  den = (1+alpha, -2*math.cos(w), 1-alpha)
+  filters.append((tuple(x/den[0] for x in b), tuple(x/den[0] for x in den)))
+  return filters
+
+
+def get_weights(rate, size):
+  """
+  Calculates the power response of the K-weighting filter at each frequency
+  of a real FFT, scaled so that the weighted powers of a step sum to its
+  K-weighted mean square
+  Args:
+    rate: The sample rate of the audio
+    size: The number of samples in each step
+  Returns:
+    A NumPy array of the weight of each frequency
+  """
+  import numpy
+  z = numpy.exp(-1j*numpy.pi*numpy.arange(size//2+1)/(size/2))
+  response = numpy.ones(len(z))
+  for b, a in get_filters(rate):
+    response *= numpy.abs((b[0]+b[1]*z+b[2]*z**2)/(a[0]+a[1]*z+a[2]*z**2))**2
+  # Every frequency but DC and Nyquist stands for a conjugate pair
+  scale = numpy.full(len(z), 2.0)
+  scale[0] = 1
+  if size % 2 == 0:
+    scale[-1] = 1
+  return response*scale/size**2
+
+
+def integrate(powers):
+  """
+  Gates the K-weighted power of overlapping blocks into the integrated
+  loudness of a track
+  Args:
+    powers: A list of the K-weighted mean square of each step, summed over
+      the channels
+  Returns:
+    The integrated loudness in LUFS, or None if the track is silent or
+    shorter than a block
+  """
+  steps = int(round(BLOCK/STEP))
+  if len(powers) < steps:
+    return None
+  blocks = [sum(powers[i:i+steps])/steps for i in range(len(powers)-steps+1)]
+  threshold = 10**((ABSOLUTE_GATE+0.691)/10)
+  gated = [power for power in blocks if power > threshold]
+  if not gated:
+    return None
+  threshold = sum(gated)/len(gated)*10**(RELATIVE_GATE/10)
+  gated = [power for power in gated if power > threshold]
+  return -0.691+10*math.log10(sum(gated)/len(gated))
+
+
+class Meter():
+  """
+  A class used to measure the integrated loudness and sample peak of raw
+  audio as it's streamed through the converter, K-weighting each 100ms step
+  of every chunk at once in the frequency domain with NumPy
+  ...
+  Attributes
+  ----------
+  rate : int
+    The sample rate of the audio
+  channels : int
+    The number of interleaved channels
+  sample_width : int
+    The number of bytes in each signed little-endian sample
+  peak : float
+    The largest absolute sample so far, where full scale is 1
+  """
+  def __init__(self, rate=44100, channels=2, sample_width=2):
+    import numpy
+    self.rate = rate
+    self.channels = channels
+    self.sample_width = sample_width
+    self.peak = 0.0
+    self._dtype = numpy.dtype('<i%s' % sample_width)
+    self._scale = float(2**(8*sample_width-1))
+    self._size = int(round(rate*STEP))
+    self._weights = get_weights(rate, self._size)
+    self._powers = list()
+    self._pending = b''
+
+
+  def __call__(self, chunk):
+    """
+    Measures a chunk of raw audio, keeping any incomplete step for the next
+    Args:
+      chunk: The bytes of interleaved samples
+    """
+    import numpy
+    data = self._pending+chunk if self._pending else chunk
+    frame = self.sample_width*self.channels
+    usable = len(data)//(frame*self._size)*frame*self._size
+    self._pending = data[usable:]
+    if not usable:
+      return
+    samples = numpy.frombuffer(data, self._dtype, usable//self.sample_width)
+    self.peak = max(self.peak, max(int(samples.max()), -int(samples.min()))/self._scale)
+    # Arrange the samples as steps of separate channels
+    steps = samples.reshape(-1, self._size, self.channels).transpose(0, 2, 1)/self._scale
+    spectra = numpy.fft.rfft(steps, axis=-1)
+    powers = (spectra.real**2+spectra.imag**2)@self._weights
+    self._powers.extend(powers.sum(axis=1).tolist())
+
+
+  def result(self):
+    """
+    Completes the measurement
+    Returns:
+      A dict of the integrated loudness in LUFS, or None if the audio is
+      silent, and the sample peak
+    """
+    return {'loudness': integrate(self._powers), 'peak': self.peak}
+
+
+def get_gain(measurement, format='mp3'):
+  """
+  Formats the gain and peak of a measured track as the tags of its format,
+  using ReplayGain 2.0 tags for MP3 and M4A files and the R128 gain Opus
+  players apply
+  Args:
+    measurement: A dict of the integrated loudness and sample peak
+    format: The output format, 'mp3', 'm4a' or 'opus'
+  Returns:
+    A dict of the tag values keyed by their names, which is empty if the
+    track is silent
+  """
+  if not measurement or measurement['loudness'] is None:
+    return dict()
+  if format == 'opus':
+    # A Q7.8 fixed-point number of dB
+    gain = int(round((R128_REFERENCE-measurement['loudness'])*256))
+    return {'R128_TRACK_GAIN': str(max(-32768, min(32767, gain)))}
+  return {'REPLAYGAIN_TRACK_GAIN': '%.2f dB' % (REPLAYGAIN_REFERENCE-measurement['loudness']),
+          'REPLAYGAIN_TRACK_PEAK': '%.6f' % measurement['peak']}
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/metadata.py
+Brett Stevenson (c) 2018
+"""
+
+import os, base64
+from yt2mp3 import loudness
+
+# The ID3 frames, MP4 atoms and Vorbis comments holding each song value
+ID3_KEYS = {'track': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'genre': 'TCON', 'date': 'TDRC'}
+MP4_KEYS = {'track': '\xa9nam', 'artist': '\xa9ART', 'album_artist': 'aART', 'album': '\xa9alb',
+            'genre': '\xa9gen', 'date': '\xa9day', 'url': 'purl'}
+VORBIS_KEYS = {'track': 'title', 'artist': 'artist', 'album_artist': 'albumartist', 'album': 'album',
+               'genre': 'genre', 'date': 'date', 'url': 'website'}
+
+
+def get_values(song):
+  """
+  Collects the values of a song which are written to its tags
+  Args:
+    song: A Song
+  Returns:
+    A dict of the song values, keyed like MP4_KEYS and VORBIS_KEYS
+  """
+  return {'track': song.track or '', 'artist': song.artist or '', 'album_artist': song.artist or '',
+          'album': song.album or '', 'genre': song.genre or '', 'date': (song.release_date or '')[0:4],
+          'url': song.video_url or ''}
+
+
+def to_number(value):
+  """
+  Converts a track or disc number into an int
+  Args:
+    value: A string or number, which may be empty
+  Returns:
+    The int, or 0 if the value isn't a number
+  """
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return 0
+
+
+def write(path, song, cover=None):
+  """
+  Replaces the tags of an M4A or Opus file with the song data, cover-art and
+  measured gain, using the mutagen backend of its format
+  Args:
+    path: The path of the M4A or Opus file
+    song: The Song the file contains
+    cover: The JPEG data of the cover-art, if any
+  Raises:
+    ValueError: If the file isn't an M4A or Opus file
+  """
+  values = get_values(song)
+  extension = os.path.splitext(path)[1].lower()
+  if extension == '.m4a':
+    from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+    audio = MP4(path)
+    if audio.tags is None:
+      audio.add_tags()
+    audio.tags.clear()
+    for key, atom in MP4_KEYS.items():
+      if values[key]:
+        audio.tags[atom] = [values[key]]
+    audio.tags['trkn'] = [(to_number(song.track_number), to_number(song.track_count))]
+    audio.tags['disk'] = [(to_number(song.disc_number), to_number(song.disc_count))]
+    if cover:
+      audio.tags['covr'] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+    for name, value in loudness.get_gain(song.loudness, 'm4a').items():
+      audio.tags['----:com.apple.iTunes:'+name.lower()] = [MP4FreeForm(value.encode('utf-8'))]
+  elif extension == '.opus':
+    from mutagen.oggopus import OggOpus
+    from mutagen.flac import Picture
+    audio = OggOpus(path)
+    audio.tags.clear()
+    for key, comment in VORBIS_KEYS.items():
+      if values[key]:
+        audio.tags[comment] = [values[key]]
+    audio.tags['tracknumber'] = [str(song.track_number)]
+    audio.tags['tracktotal'] = [str(song.track_count)]
+    audio.tags['discnumber'] = [str(song.disc_number)]
+    audio.tags['disctotal'] = [str(song.disc_count)]
+    for name, value in loudness.get_gain(song.loudness, 'opus').items():
+      audio.tags[name] = [value]
+    if cover:
+      from yt2mp3 import artwork
+      picture = Picture()
+      picture.type = 3
+      picture.mime = 'image/jpeg'
+      picture.desc = 'Cover'
+      picture.width, picture.height = artwork.get_jpeg_size(cover) or (0, 0)
+      picture.depth = 24
+      picture.data = cover
+      audio.tags['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+  else:
+    raise ValueError('Unsupported tag format: '+path)
+  audio.save()
+
+
+def read(path):
+  """
+  Reads the song data of an MP3, M4A or Opus file
+  Args:
+    path: The path of the song
+  Returns:
+    A dict of the track, artist, album, genre, date and source URL, and
+    the track and disc numbers and counts as strings, with missing values
+    left empty
+  Raises:
+    OSError: If the file can't be read or has no tags
+  """
+  import mutagen
+  values = dict.fromkeys(('track', 'artist', 'album', 'genre', 'date', 'url', 'track_number',
+                          'track_count', 'disc_number', 'disc_count'), '')
+  extension = os.path.splitext(path)[1].lower()
+  try:
+    if extension == '.m4a':
+      from mutagen.mp4 import MP4
+      tags = MP4(path).tags or {}
+      for key, atom in MP4_KEYS.items():
+        if key in values and tags.get(atom):
+          values[key] = str(tags[atom][0])
+      for prefix, atom in (('track', 'trkn'), ('disc', 'disk')):
+        if tags.get(atom):
+          number, count = tags[atom][0]
+          values[prefix+'_number'], values[prefix+'_count'] = str(number or ''), str(count or '')
+    elif extension == '.opus':
+      from mutagen.oggopus import OggOpus
+      tags = OggOpus(path).tags
+      for key, comment in dict(VORBIS_KEYS, track_number='tracknumber', track_count='tracktotal',
+                               disc_number='discnumber', disc_count='disctotal').items():
+        if key in values and tags.get(comment):
+          values[key] = tags[comment][0]
+    else:
+      from mutagen.id3 import ID3
+      tags = ID3(path)
+      for key, frame in ID3_KEYS.items():
+        if frame in tags and tags[frame].text:
+          values[key] = str(tags[frame].text[0])
+      for prefix, frame in (('track', 'TRCK'), ('disc', 'TPOS')):
+        if frame in tags and tags[frame].text:
+          values[prefix+'_number'], _, values[prefix+'_count'] = str(tags[frame].text[0]).partition('/')
+      for frame in tags.getall('WOAS'):
+        values['url'] = frame.url
+  except mutagen.MutagenError as err:
+    raise OSError(str(err)) from err
+  return values
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/net.py
+Brett Stevenson (c) 2018
+"""
+
+import threading
+from yt2mp3 import throttle
+
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+# The CA certificates used to verify HTTPS connections, defaults to the
+# bundle used by requests
+CA_BUNDLE = None
+# The connect and read timeouts, in seconds
+TIMEOUT = (10, 30)
+RETRIES = 3
+# The number of hosts with pooled connections, and connections per host
+POOL_HOSTS = 10
+POOL_SIZE = 8
+
+_session = None
+_context = None
+_lock = threading.RLock()
+
+
+def create_adapter(**kwargs):
+  """
+  Creates an adapter which shares a single SSL context between every
+  connection pool, rather than loading the CA certificates for each new
+  connection
+  Args:
+    kwargs: The arguments of the requests HTTPAdapter
+  Returns:
+    An HTTPAdapter
+  """
+  from requests.adapters import HTTPAdapter
+
+  class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+      kwargs['ssl_context'] = get_ssl_context()
+      return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+      kwargs['ssl_context'] = get_ssl_context()
+      return super().proxy_manager_for(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+      super().cert_verify(conn, url, verify, cert)
+      # The shared context already holds the default CA certificates
+      if verify is True:
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+
+  return PooledAdapter(**kwargs)
+
+
+def get_ssl_context():
+  """
+  Retrieves the SSL context shared by every HTTPS connection
+  Returns:
+    An SSLContext which verifies certificates using the CA bundle
+  """
+  global _context
+  with _lock:
+    if _context is None:
+      import ssl
+      from requests.utils import DEFAULT_CA_BUNDLE_PATH
+      _context = ssl.create_default_context(cafile=CA_BUNDLE or DEFAULT_CA_BUNDLE_PATH)
+    return _context
+
+
+def get_session():
+  """
+  Retrieves the HTTP session shared by every request, which keeps
+  connections alive and retries failed requests
+  Returns:
+    A requests Session
+  """
+  global _session
+  with _lock:
+    if _session is None:
+      import requests
+      from urllib3.util.retry import Retry
+      retries = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+      adapter = create_adapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE,
+                               pool_block=True, max_retries=retries)
+      _session = requests.Session()
+      _session.headers.update(HEADERS)
+      _session.mount('https://', adapter)
+      _session.mount('http://', adapter)
+    return _session
+
+
+def configure(timeout=None, retries=None, pool_size=None):
+  """
+  Changes the settings of the shared HTTP session
+  Args:
+    timeout: The number of seconds to wait for a server to respond
+    retries: The number of times a failed request is retried
+    pool_size: The number of connections kept open to each host
+  """
+  global TIMEOUT, RETRIES, POOL_SIZE, _session
+  if timeout is not None:
+    TIMEOUT = (min(timeout, TIMEOUT[0]), timeout)
+  if retries is not None:
+    RETRIES = retries
+  if pool_size is not None:
+    POOL_SIZE = pool_size
+  with _lock:
+    if _session is not None:
+      _session.close()
+      _session = None
+
+
+def get(url, **kwargs):
+  """
+  Sends a GET request using the shared HTTP session
+  Args:
+    url: The URL to request
+    kwargs: Additional arguments for the request
+  Returns:
+    The requests Response
+  Raises:
+    HTTPError: If the server responds with an error status
+    ThrottledError: If the server is still throttling requests after every
+      retry
+  """
+  kwargs.setdefault('timeout', TIMEOUT)
+  return throttle.call(throttle.get_hostname(url), _get, url, **kwargs)
+
+
+def _get(url, **kwargs):
+  response = get_session().get(url, **kwargs)
+  response.raise_for_status()
+  return response
@@ -18,15 +18,36 @@ def parse_options(args):
   Returns:
     A parser object for handling command-line options
   """
-  parser = argparse.ArgumentParser(prog='yt2mp3', usage='%(prog)s [options]', add_help=True)
+  parser = argparse.ArgumentParser(prog='yt2mp3', usage='%(prog)s [serve] [options]', add_help=True)
   parser.add_argument('--version', action='version', version='v1.2.4', help='show the program version number and exit')
   parser.add_argument('-t', '--track', nargs='+', help='specify the track name query', default='')
   parser.add_argument('-a', '--artist', nargs='+', help='specify the artist name query', default='')
   parser.add_argument('-c', '--collection', action='store_true', help='specify the album name query')
   parser.add_argument('-u', '--url', help='specify the YouTube URL/ID of the video to convert')
   parser.add_argument('-p', '--playlist', help='specify the YouTube URL/ID of the playlist to convert')
+  parser.add_argument('--chapters', action='store_true', help='split the chapters of the video into tracks of its album')
+  parser.add_argument('-b', '--batch', help='specify a CSV or JSON-lines file of songs to convert')
+  parser.add_argument('--sync', action='store_true', help='only convert the playlist videos added since it was last synced')
+  parser.add_argument('--prune', action='store_true', help='delete the songs of videos removed from a synced playlist')
+  parser.add_argument('--journal', help='specify the journal file used to resume a batch')
   parser.add_argument('-r', '--resolution', type=int, help='specify the resolution for the cover-art image', default=480)
+  parser.add_argument('-j', '--jobs', type=int, help='specify the number of songs to process concurrently', default=1)
   parser.add_argument('-o', '--overwrite', action='store_true', help='overwrite file if one exists in output directory')
   parser.add_argument('-v', '--verbose', action='store_true', help='display a download progress bar')
+  parser.add_argument('--timeout', type=float, help='specify the number of seconds to wait for a server to respond')
+  parser.add_argument('--retries', type=int, help='specify the number of times a failed request is retried')
+  parser.add_argument('--format', choices=('mp3', 'm4a', 'opus'), default='mp3', help='specify the output format, copying audio which already has its codec')
+  parser.add_argument('--replaygain', action='store_true', help='measure the loudness of each song while converting and tag its gain (requires numpy)')
+  parser.add_argument('--no-stream', dest='stream', action='store_false', help='decode each song into memory before converting')
+  parser.add_argument('--no-cache', action='store_true', help='bypass the cached iTunes and video data')
+  parser.add_argument('--clear-cache', action='store_true', help='remove the cached iTunes and video data')
+  parser.add_argument('--cache-ttl', type=float, help='specify the number of days cached iTunes results remain valid')
+  parser.add_argument('--source-cache', nargs='?', type=float, const=2048, metavar='MB', help='keep downloaded audio for later runs, up to a size (default: 2048 MB)')
+  parser.add_argument('--build-catalog', nargs='*', metavar='FILE', help='import iTunes results and library tags into the local catalog')
+  parser.add_argument('--no-catalog', action='store_true', help='match video titles using the iTunes API only')
+  parser.add_argument('--scratch-dir', metavar='DIR', help='specify the directory for temporary files, such as a tmpfs mount')
+  parser.add_argument('--address', metavar='ADDR', help='specify the Unix socket path or localhost port of the daemon')
+  parser.add_argument('--no-daemon', action='store_true', help='convert songs in this process even when a daemon is running')
+  parser.add_argument('--stats', help='write a JSON report of the time and bytes of each stage to a file')
   parser.add_argument('-q', '--quiet', action='store_true', help='suppress command-line output')
   return parser.parse_args(args)
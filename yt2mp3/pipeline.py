@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/pipeline.py
+Brett Stevenson (c) 2018
+"""
+
+import logging, queue, threading, functools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from colorama import Fore, Style
+from yt2mp3 import cache, catalog, library, net, scratch, sources, stats, throttle, util, video
+from yt2mp3.song import Song
+
+# Marks the end of the input for each stage queue
+_DONE = object()
+
+
+class Stage():
+  """
+  A class used to represent a single stage of the conversion pipeline
+  ...
+  Attributes
+  ----------
+  name : str
+    A short name for the stage used for logging
+  func : callable
+    A function that processes an item and returns it, or None to drop it
+  workers : int
+    The number of items the stage processes concurrently
+  process : bool
+    Whether the function should run in a separate process
+  """
+  def __init__(self, name, func, workers=1, process=False):
+    self.name = name
+    self.func = func
+    self.workers = max(1, workers)
+    self.process = process
+
+
+class Pipeline():
+  """
+  A class used to run items through a series of stages joined by bounded
+  queues, so that each stage can work on a different item at the same time
+  ...
+  Attributes
+  ----------
+  stages : list
+    The ordered list of stages each item is passed through
+  maxsize : int
+    The maximum number of items waiting between two stages
+  callback : callable
+    A function called with the stage name and item after each stage
+  label : callable
+    A function which identifies the track of an item in the stats
+  errback : callable
+    A function called with the stage name, item and error when a stage
+    fails, or with None as the error when a stage drops the item
+  """
+  def __init__(self, stages, maxsize=2, callback=None, label=None, errback=None):
+    self.stages = stages
+    self.maxsize = max(1, maxsize)
+    self.callback = callback
+    self.label = label
+    self.errback = errback
+    self._cancel = threading.Event()
+    self._pool = None
+    workers = sum(s.workers for s in stages if s.process)
+    if workers:
+      # Avoid forking while the stage threads are running
+      context = multiprocessing.get_context('spawn')
+      self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                       initializer=apply_settings, initargs=(get_settings(),))
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+  def run(self, items):
+    """
+    Passes the provided items through each stage of the pipeline
+    Args:
+      items: An iterable of items to process
+    Returns:
+      A generator of the items that made it through every stage, in the
+      order they were completed
+    """
+    queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages)+1)]
+    feeder = threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)
+    feeder.start()
+    for i, stage in enumerate(self.stages):
+      remaining = [stage.workers]
+      lock = threading.Lock()
+      for _ in range(stage.workers):
+        worker = threading.Thread(target=self._work, daemon=True,
+                                  args=(stage, queues[i], queues[i+1], remaining, lock))
+        worker.start()
+    while True:
+      try:
+        item = queues[-1].get(timeout=0.1)
+      except queue.Empty:
+        continue
+      if item is _DONE:
+        return
+      yield item
+
+
+  def close(self):
+    """
+    Stops any pending work and shuts down the process pool
+    """
+    self._cancel.set()
+    if self._pool:
+      self._pool.shutdown(wait=False)
+      self._pool = None
+
+
+  def _put(self, q, item):
+    """
+    Adds an item to a bounded queue without blocking past cancellation
+    """
+    while not self._cancel.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+
+  def _feed(self, items, q):
+    try:
+      for item in items:
+        if not self._put(q, item):
+          return
+    except Exception as err:
+      logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Unable to retrieve the remaining songs: %s', err)
+    self._put(q, _DONE)
+
+
+  def _work(self, stage, inq, outq, remaining, lock):
+    while not self._cancel.is_set():
+      try:
+        item = inq.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      if item is _DONE:
+        # Let the other workers of this stage see the marker as well
+        self._put(inq, _DONE)
+        with lock:
+          remaining[0] -= 1
+          if remaining[0] == 0:
+            self._put(outq, _DONE)
+        return
+      track = self.label(item) if self.label else None
+      source, error = item, None
+      try:
+        with stats.tracking(track), stats.span(stage.name):
+          if stage.process and self._pool:
+            item, spans = self._pool.submit(_call_recorded, stage.func, item, track).result()
+            # Pass on the spans recorded in the worker process
+            for span in spans:
+              stats.emit(span)
+          else:
+            item = stage.func(item)
+      except (Exception, SystemExit) as err:
+        if not self._cancel.is_set():
+          logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'%s failed: %s', stage.name.capitalize(), err)
+        item, error = None, err
+      if item is not None:
+        if self.callback:
+          self.callback(stage.name, item)
+        self._put(outq, item)
+      elif self.errback and not self._cancel.is_set():
+        self.errback(stage.name, source, error)
+
+
+def get_settings():
+  """
+  Collects the settings changed by the command-line options, which a
+  spawned worker process would otherwise start without
+  Returns:
+    A dict of the settings of each module
+  """
+  return {'net': (net.TIMEOUT, net.RETRIES), 'throttle': (dict(throttle.RATES), throttle.RETRIES),
+          'cache': (cache.enabled, cache.directory), 'catalog': catalog.enabled,
+          'library': library.directory, 'scratch': scratch.root,
+          'sources': (sources.enabled, sources.max_bytes)}
+
+
+def apply_settings(settings):
+  """
+  Applies the settings of the main process in a worker process
+  Args:
+    settings: A dict of the settings returned by get_settings
+  """
+  net.TIMEOUT, net.RETRIES = settings['net']
+  throttle.RATES, throttle.RETRIES = settings['throttle']
+  cache.enabled, cache.directory = settings['cache']
+  catalog.enabled = settings['catalog']
+  library.directory = settings['library']
+  scratch.root = settings['scratch']
+  sources.enabled, sources.max_bytes = settings['sources']
+
+
+def _call_recorded(func, item, track):
+  """
+  Calls a stage function in a worker process, recording its spans so they
+  can be passed to the handlers of the main process
+  Returns:
+    A tuple of the processed item and its list of spans
+  """
+  spans = list()
+  stats.add_handler(spans.append)
+  try:
+    with stats.tracking(track):
+      item = func(item)
+  finally:
+    stats.remove_handler(spans.append)
+  return item, spans
+
+
+def get_label(item):
+  """
+  Identifies the track of a pipeline item in the stats
+  Args:
+    item: A dict containing the input data and playlist position
+  Returns:
+    A string which is the same for every stage of the item
+  """
+  if 'key' in item:
+    return item['key']
+  if 'index' in item:
+    return str(item['index']+1)
+  data = item['data']
+  return data['video_url'] or ' - '.join(val for val in (data['track_name'], data['artist_name']) if val)
+
+
+def resolve_song(item, collection=False, overwrite=False, format='mp3'):
+  """
+  Retrieves the song data for a pipeline item
+  Args:
+    item: A dict containing the input data and playlist position
+    collection: A boolean representing whether an album has been specified
+    overwrite: A boolean specifying if existing files should be replaced
+    format: The output format, 'mp3', 'm4a' or 'opus'
+  Returns:
+    The item with its Song, or None if the song already exists
+  """
+  if 'song' in item:
+    return item
+  if 'index' in item:
+    title = item.get('title') or item['data']['video_title'] or video.get_title(item['data']['video_url'])
+    if 'count' in item:
+      logging.info('%s of %s: %s', item['index']+1, item['count'], title)
+    else:
+      logging.info('%s: %s', item['index']+1, title)
+  collection = item.get('collection', collection)
+  item['data'] = util.get_song_data(item['data'], collection, item.get('interactive', True))
+  song = Song(item['data'])
+  stats.annotate(title=song.artist+' - '+song.track)
+  if not item.get('overwrite', overwrite) and song.file_exists(item.get('format', format)):
+    logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'This song already exists in the output directory')
+    return None
+  item['song'] = song
+  return item
+
+
+def download_song(item, verbose=False, format='mp3'):
+  """
+  Downloads the video of a pipeline item
+  """
+  if 'video' in item or 'path' in item:
+    return item
+  item['video'] = item['song'].download(verbose, item.get('format', format))
+  return item
+
+
+def convert_song(item, stream=True, resolution=480, format='mp3', replaygain=False):
+  """
+  Converts the downloaded video of a pipeline item to a tagged song
+  """
+  if 'path' in item:
+    return item
+  item['path'] = item['song'].convert(item['video'], item.get('format', format), item.get('stream', stream),
+                                      item.get('resolution', resolution), item.get('replaygain', replaygain))
+  return item
+
+
+def tag_song(item, resolution=480):
+  """
+  Adds the converted MP3 of a pipeline item to the library, tagging it if
+  it wasn't tagged while converting, and removes its downloaded video
+  """
+  item['song'].set_id3(item['path'], item.get('resolution', resolution))
+  if 'video' in item:
+    scratch.get_job().remove(item['video'])
+  return item
+
+
+def create(args, callback=None, errback=None):
+  """
+  Creates a pipeline for converting songs using the command-line options,
+  where an item can override the collection, overwrite, format, stream,
+  resolution and replaygain options with keys of the same name
+  Args:
+    args: The parsed command-line options
+    callback: A function called with the stage name and item after each stage
+    errback: A function called with the stage name, item and error when a
+      stage fails or drops an item
+  Returns:
+    A Pipeline which resolves, downloads, converts and tags each item
+  """
+  jobs = max(1, args.jobs)
+  # A single conversion at a time doesn't need a separate process
+  stages = [
+    Stage('resolve', lambda item: resolve_song(item, args.collection, args.overwrite, args.format), jobs),
+    Stage('download', lambda item: download_song(item, args.verbose, args.format), jobs),
+    Stage('convert', functools.partial(convert_song, stream=args.stream, resolution=args.resolution,
+                                       format=args.format, replaygain=args.replaygain), jobs, process=jobs > 1),
+    Stage('tag', lambda item: tag_song(item, args.resolution), jobs),
+  ]
+  return Pipeline(stages, maxsize=jobs*2, callback=callback, label=get_label, errback=errback)
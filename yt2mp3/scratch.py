@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/scratch.py
+Brett Stevenson (c) 2018
+"""
+
+import os, shutil, hashlib, tempfile, threading
+
+# The directory the scratch directories of each job are created in, such as a
+# tmpfs mount, defaults to the system's temporary directory
+root = None
+
+
+class Job():
+  """
+  A class used to represent the scratch directory of a single run, so that
+  concurrent runs never share or remove each other's intermediate files
+  ...
+  Attributes
+  ----------
+  name : str
+    The name of a job which is resumed across runs, if any
+  path : str
+    The scratch directory of the job
+  """
+  def __init__(self, name=None):
+    self.name = name
+    directory = root or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    if name:
+      self.path = os.path.join(directory, 'yt2mp3-'+name)
+      os.makedirs(self.path, exist_ok=True)
+    else:
+      self.path = tempfile.mkdtemp(prefix='yt2mp3-', dir=directory)
+
+
+  def owns(self, path):
+    """
+    Checks if a file is in the scratch directory of the job
+    Args:
+      path: The path of the file
+    Returns:
+      A bool indicating whether the job created the file
+    """
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.path)
+
+
+  def remove(self, path):
+    """
+    Removes an intermediate file once its track is done with it, leaving
+    any file which isn't part of the job
+    Args:
+      path: The path of the intermediate file
+    """
+    if self.owns(path) and os.path.exists(path):
+      os.remove(path)
+
+
+  def close(self):
+    """
+    Removes the scratch directory and every file left in it
+    """
+    shutil.rmtree(self.path, ignore_errors=True)
+
+
+_job = None
+_job_lock = threading.Lock()
+
+
+def get_job():
+  """
+  Retrieves the job of the current run, creating its scratch directory on
+  first use
+  Returns:
+    The current Job
+  """
+  global _job
+  with _job_lock:
+    if _job is None:
+      _job = Job()
+    return _job
+
+
+def resume(key):
+  """
+  Starts a job whose scratch directory is kept between runs with the same
+  key, such as the path of a batch file
+  Args:
+    key: A string identifying the work of the job
+  Returns:
+    The started Job
+  """
+  global _job
+  name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+  with _job_lock:
+    if _job is None or _job.name != name:
+      if _job is not None and _job.name is None:
+        _job.close()
+      _job = Job(name)
+    return _job
+
+
+def cleanup():
+  """
+  Removes the scratch directory of the current job, if one was created
+  """
+  global _job
+  with _job_lock:
+    if _job is not None:
+      _job.close()
+      _job = None
@@ -8,12 +8,23 @@ yt2mp3/song.py
 Brett Stevenson (c) 2018
 """
 
-import os, io, pydub, youtube_dl, requests, logging
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TPE2, TALB, TCON, TRCK, TDRC, TPOS
-from PIL import Image
+import io, os, copy, logging, tempfile
 from colorama import Fore, Style
-from yt2mp3 import util
+from yt2mp3 import artwork, library, loudness, metadata, scratch, sources, stats, util, video
+
+# The bytes of free space left in the tag of a new MP3, so it can be
+# retagged without rewriting the audio
+TAG_PADDING = 4096
+# The youtube_dl format requested for each output format, preferring audio
+# which can be copied without re-encoding
+DOWNLOAD_FORMATS = {
+  'mp3': 'bestaudio/best',
+  'm4a': 'bestaudio[ext=m4a]/bestaudio/best',
+  'opus': 'bestaudio[acodec=opus]/bestaudio/best',
+}
+# The number of times a failed download is retried with newly extracted
+# formats
+DOWNLOAD_RETRIES = 1
 
 class Song():
   """
@@ -38,89 +49,212 @@ class Song():
     self.release_date = data['release_date']
     self.filename = data['track_name']
     self.video_url = data['video_url']
+    self.path = None
+    self.tagged = False
+    self.codec = None
+    self.loudness = None
 
 
-  def download(self, verbose=False):
+  def download(self, verbose=False, format='mp3'):
     """
-    Downloads the video at the provided url
+    Downloads the video at the provided url, or reuses its audio from the
+    source cache
     Args:
       verbose: A bool value to specify the current logging mode
+      format: The output format the video will be converted to
     Returns:
       The path of the downloaded video file
     """
-    temp_dir = os.path.expanduser('~/Downloads/Music/temp/')
-    if not os.path.exists(temp_dir):
-      os.makedirs(temp_dir)
-    video_id = self.video_url.split('watch?v=')[-1]
+    video_id = video.get_id(self.video_url)
+    cached = sources.get(video_id, format)
+    if cached:
+      path, self.codec = cached
+      video.discard_formats(self.video_url)
+      logging.info(Fore.GREEN+'✔ '+Style.RESET_ALL+'Using the cached download')
+      return path
+    import youtube_dl
+    temp_dir = scratch.get_job().path
     ydl_opts = dict()
-    ydl_opts['outtmpl'] = temp_dir+'%(id)s.%(ext)s'
-    ydl_opts['format'] = 'bestaudio/best'
+    ydl_opts['outtmpl'] = os.path.join(temp_dir, '%(id)s.%(ext)s')
+    ydl_opts['format'] = DOWNLOAD_FORMATS.get(format, DOWNLOAD_FORMATS['mp3'])
     ydl_opts['quiet'] = True
     if verbose:
       ydl_opts['progress_hooks'] = [util.show_progressbar]
       logging.info(Fore.YELLOW+'↓ '+Style.RESET_ALL+'Downloading...')
     ydl = youtube_dl.YoutubeDL(ydl_opts)
-    video_info = None
-    with ydl:
-      ydl.download([self.video_url])
-      video_info = ydl.extract_info(self.video_url, download=False)
+    with ydl, stats.span('youtube.download') as span:
+      for attempt in range(DOWNLOAD_RETRIES+1):
+        # Reuse the info extracted while resolving the song data, which is
+        # the only request limited by the throttle, as the media itself is
+        # served by other hosts
+        video_info = copy.deepcopy(video.get_info(self.video_url, formats=True))
+        try:
+          video_info = ydl.process_ie_result(video_info, download=True)
+          break
+        except youtube_dl.utils.DownloadError as err:
+          if attempt == DOWNLOAD_RETRIES:
+            raise
+          logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Retrying the download: %s', err)
+          # The signed URLs of the formats may have expired
+          video.discard_formats(self.video_url)
+      path = os.path.join(temp_dir, video_id+'.'+video_info['ext'])
+      span.bytes = os.path.getsize(path)
+    self.codec = video_info.get('acodec')
+    video.discard_formats(self.video_url)
+    path = sources.add(video_id, format, path, self.codec)
     logging.info(Fore.GREEN+'✔ '+Style.RESET_ALL+'Download Complete')
-    path = os.path.join(temp_dir, video_id+'.'+video_info['ext'])
     return path
 
 
-  def convert_to_mp3(self, video):
+  def convert(self, video, format='mp3', stream=True, resolution=480, replaygain=False):
     """
-    Converts the downloaded video file to MP3
+    Converts the downloaded video file to a tagged song, copying its audio
+    without re-encoding if it already has a codec of the output format. The
+    song is written to a temporary file in the artist directory which is
+    then renamed into place, with the ID3 metadata of an MP3 written ahead
+    of the converted audio
     Args:
       video: A path to the downloaded video file
+      format: The output format, 'mp3', 'm4a' or 'opus'
+      stream: A bool specifying if the audio should be converted in chunks
+        rather than decoded into memory as a whole
+      resolution: The target resolution of the cover-art
+      replaygain: A bool specifying if the loudness of the song should be
+        measured while it's decoded and tagged as its ReplayGain or R128
+        gain
     Returns:
-      The path of the converted MP3 file
+      The path of the converted song
+    """
+    from yt2mp3 import transcode
+    meter = get_meter() if replaygain else None
+    observers = [meter] if meter else []
+    extension, muxer, _ = transcode.FORMATS[format]
+    copy_audio = transcode.can_copy(self.codec or transcode.get_codec(video), format)
+    if copy_audio:
+      logging.info(Fore.BLUE+'♬ '+Style.RESET_ALL+'Copying the audio to '+format.upper())
+    else:
+      logging.info(Fore.BLUE+'♬ '+Style.RESET_ALL+'Converting to '+format.upper())
+    song_path = self.get_path(extension)
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.part'+extension, dir=os.path.dirname(song_path))
+    try:
+      with os.fdopen(fd, 'wb') as f, stats.span('remux' if copy_audio else 'transcode') as span:
+        if format == 'mp3' and not copy_audio:
+          header = io.BytesIO()
+          self.get_tags(resolution).save(header, padding=lambda info: TAG_PADDING)
+          f.write(header.getvalue())
+          if stream:
+            transcode.stream(video, f, observers=observers)
+          else:
+            audio, meter = self._decode(video, meter is not None)
+            # The exporter writes from the start of the file it's given
+            audio = audio.export(io.BytesIO(), format='mp3', parameters=['-id3v2_version', '0'])
+            f.write(audio.getvalue())
+          f.close()
+          self.loudness = meter.result() if meter else None
+          if self.loudness:
+            # The gain is only known once the audio has been encoded, and
+            # fits in the padding of the tag written ahead of it
+            self._write_tags(temp_path, resolution)
+        else:
+          f.close()
+          if copy_audio:
+            transcode.remux(video, temp_path, format)
+            if meter:
+              # Copied audio has no transcode for the meter to observe
+              with stats.span('loudness'):
+                transcode.decode(video, observers)
+          elif stream:
+            transcode.stream(video, temp_path, muxer, observers=observers)
+          else:
+            audio, meter = self._decode(video, meter is not None)
+            audio.export(temp_path, format=muxer)
+          self.loudness = meter.result() if meter else None
+          self._write_tags(temp_path, resolution)
+        span.bytes = os.path.getsize(temp_path)
+      # Temporary files are only readable by their owner
+      os.chmod(temp_path, 0o644)
+      os.replace(temp_path, song_path)
+    except BaseException:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+    self.path = song_path
+    self.tagged = True
+    return song_path
+
+
+  def get_path(self, extension='.mp3'):
+    """
+    Determines the path the song is converted to, creating its artist
+    directory if necessary
+    Args:
+      extension: The extension of the output format
+    Returns:
+      The path of the song in the output directory
     """
-    logging.info(Fore.BLUE+'♬ '+Style.RESET_ALL+'Converting to MP3')
-    artist_dir = os.path.expanduser('~/Downloads/Music/')
-    artist_dir = os.path.join(artist_dir, self.artist.replace('/',''))
+    artist_dir = os.path.join(library.directory, self.artist.replace('/',''))
     if not os.path.exists(artist_dir):
       os.makedirs(artist_dir)
-    song_path = os.path.join(artist_dir, self.filename+'.mp3')
+    song_path = os.path.join(artist_dir, self.filename+extension)
     # TODO: Write test to cover
     if os.path.exists(song_path):
       self.filename = self.filename+' ('+self.album+')'
-      song_path = os.path.join(artist_dir, self.filename+'.mp3')
-    pydub.AudioSegment.from_file(video).export(song_path, format='mp3')
+      song_path = os.path.join(artist_dir, self.filename+extension)
     return song_path
 
 
+  def _decode(self, video, replaygain=False):
+    """
+    Decodes the downloaded video into memory
+    Returns:
+      A tuple of the pydub AudioSegment and the loudness Meter which has
+      measured it, if any
+    """
+    import pydub
+    audio = pydub.AudioSegment.from_file(video)
+    meter = get_meter(audio.frame_rate, audio.channels) if replaygain else None
+    if meter:
+      meter(audio.set_sample_width(meter.sample_width).raw_data)
+    return audio, meter
+
+
+  def convert_to_mp3(self, video, stream=True, resolution=480, replaygain=False):
+    """
+    Converts the downloaded video file to a tagged MP3
+    Args:
+      video: A path to the downloaded video file
+      stream: A bool specifying if the audio should be converted in chunks
+        rather than decoded into memory as a whole
+      resolution: The target resolution of the cover-art
+      replaygain: A bool specifying if the ReplayGain of the song should be
+        measured and tagged
+    Returns:
+      The path of the converted MP3 file
+    """
+    return self.convert(video, 'mp3', stream, resolution, replaygain)
+
+
   def get_cover_image(self, resolution):
     """
     Retrieves the cover-art image with the specified resolution
     Args:
       resolution: The target resolution of the cover-art
     Returns:
-      The path of the retrieved cover-art image
+      The JPEG data of the retrieved cover-art image
     """
-    img_url = self.artwork_url
-    if 'youtube' not in img_url:
-      ext = '/%sx%sbb.jpg' % (resolution, resolution)
-      img_url = '/'.join(img_url.split('/')[:-1])+ext
-    img_path = os.path.expanduser('~/Downloads/Music/CoverArt')
-    if not os.path.exists(img_path):
-      os.makedirs(img_path)
-    img_path = os.path.join(img_path, 'cover.jpg')
-    response = requests.get(img_url)
-    Image.open(io.BytesIO(response.content)).save(img_path)
-    return img_path
+    return artwork.get_image(self.artwork_url, resolution)
 
 
-  def set_id3(self, path, resolution=480):
+  def get_tags(self, resolution=480):
     """
-    Assigns the ID3 metadata of the MP3 file
+    Creates the ID3 metadata of the song
     Args:
-      path: The path of the converted MP3 file
       resolution: The target resolution of the cover-art
+    Returns:
+      A mutagen ID3 tag containing the song data and cover-art
     """
-    tags = ID3(path)
-    tags.delete()
+    from mutagen.id3 import ID3, APIC, TIT2, TPE1, TPE2, TALB, TCON, TRCK, TDRC, TPOS, TXXX, WOAS
+    tags = ID3()
     tags.add(TIT2(encoding=3, text=self.track))
     tags.add(TPE1(encoding=3, text=self.artist))
     tags.add(TPE2(encoding=3, text=self.artist))
@@ -129,23 +263,140 @@ class Song():
     tags.add(TRCK(encoding=3, text=self.track_number+'/'+self.track_count))
     tags.add(TPOS(encoding=3, text=self.disc_number+'/'+self.disc_count))
     tags.add(TDRC(encoding=3, text=self.release_date[0:4]))
+    tags.add(WOAS(url=self.video_url))
+    for name, value in loudness.get_gain(self.loudness).items():
+      tags.add(TXXX(encoding=3, desc=name, text=value))
     # Embed cover-art in ID3 metadata
-    img_path = self.get_cover_image(resolution)
-    tags.add(APIC(encoding=3, mime='image/jpg', type=3,
-                  desc=u'Cover', data=open(img_path, 'rb').read()))
-    tags.save()
+    tags.add(APIC(encoding=3, mime='image/jpeg', type=3,
+                  desc=u'Cover', data=self.get_cover_image(resolution)))
+    return tags
+
+
+  def set_id3(self, path, resolution=480):
+    """
+    Assigns the metadata of the converted song and adds it to the library,
+    unless it was written while converting. The existing ID3 tag of an MP3
+    is replaced in place, so the file is only rewritten if the new tag
+    doesn't fit
+    Args:
+      path: The path of the converted MP3, M4A or Opus file
+      resolution: The target resolution of the cover-art
+    """
+    if not (self.tagged and path == self.path):
+      self._write_tags(path, resolution)
+      self.path = path
+      self.tagged = True
+    library.get_library().add(path, video.get_id(self.video_url), self.artist, self.track, self.album)
 
 
-  def file_exists(self):
+  def _write_tags(self, path, resolution):
+    if path.lower().endswith('.mp3'):
+      self.get_tags(resolution).save(path, padding=keep_padding)
+    else:
+      metadata.write(path, self, self.get_cover_image(resolution))
+
+
+  def file_exists(self, format='mp3', chapter=False):
     """
     Checks if a duplicate file already exists in the output directory
+    Args:
+      format: The output format, as a song in another format isn't a
+        duplicate
+      chapter: A bool specifying if the song is a chapter of its video,
+        which shares the video with the other chapters
     Returns:
       A boolean value indicating whether the target file already exists
     """
-    path = os.path.expanduser('~/Downloads/Music/')
-    path = os.path.join(path, self.artist.replace('/',''), self.filename+'.mp3')
-    if os.path.exists(path):
-      tags = EasyID3(path)
-      if len(self.album) == '' or self.album in tags['album'][0]:
-        return True
-    return False
+    songs = library.get_library()
+    if songs.find(self.artist, self.track, self.album, format):
+      return True
+    # Chapters can only be matched by their artist and track
+    if chapter or not self.video_url:
+      return False
+    return bool(songs.owned([video.get_id(self.video_url)], format))
+
+
+def convert_chapters(sections, video, format='mp3', resolution=480):
+  """
+  Converts the chapters of a downloaded video to tagged songs, decoding the
+  video once and encoding each chapter as its audio is reached
+  Args:
+    sections: A list of tuples of a Song and the start and end of its
+      chapter in seconds, where an end of None continues to the end
+    video: A path to the downloaded video file
+    format: The output format, 'mp3', 'm4a' or 'opus'
+    resolution: The target resolution of the cover-art
+  Returns:
+    A list of the paths of the converted songs
+  """
+  from yt2mp3 import transcode
+  extension, muxer, _ = transcode.FORMATS[format]
+  logging.info(Fore.BLUE+'♬ '+Style.RESET_ALL+'Splitting %s chapters into %s files', len(sections), format.upper())
+  outputs, files, paths = list(), list(), list()
+  try:
+    for i, (song, start, end) in enumerate(sections):
+      song_path = song.get_path(extension)
+      # Chapters with the same title would otherwise replace each other
+      if song_path in (path for _, path in paths):
+        song.filename += ' (%s)' % (i+1)
+        song_path = song.get_path(extension)
+      fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.part'+extension, dir=os.path.dirname(song_path))
+      paths.append((temp_path, song_path))
+      f = os.fdopen(fd, 'wb')
+      files.append(f)
+      if format == 'mp3':
+        header = io.BytesIO()
+        song.get_tags(resolution).save(header, padding=lambda info: TAG_PADDING)
+        f.write(header.getvalue())
+        outputs.append((start, end, f))
+      else:
+        f.close()
+        outputs.append((start, end, temp_path))
+    with stats.span('split') as span:
+      transcode.split(video, outputs, muxer)
+      for f in files:
+        f.close()
+      span.bytes = sum(os.path.getsize(temp_path) for temp_path, _ in paths)
+    for (song, _, _), (temp_path, song_path) in zip(sections, paths):
+      if format != 'mp3':
+        song._write_tags(temp_path, resolution)
+      os.chmod(temp_path, 0o644)
+      os.replace(temp_path, song_path)
+      song.path = song_path
+      song.tagged = True
+  except BaseException:
+    for f in files:
+      f.close()
+    for temp_path, _ in paths:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+    raise
+  return [song_path for _, song_path in paths]
+
+
+def get_meter(rate=44100, channels=2):
+  """
+  Creates a loudness meter for 16-bit raw audio
+  Args:
+    rate: The sample rate of the audio
+    channels: The number of channels
+  Returns:
+    A loudness Meter, or None if NumPy isn't installed
+  """
+  try:
+    return loudness.Meter(rate, channels, 2)
+  except ImportError:
+    logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Measuring ReplayGain requires NumPy: pip install yt2mp3[replaygain]')
+    return None
+
+
+def keep_padding(info):
+  """
+  Chooses the padding of a replaced ID3 tag, reusing the space of the
+  existing tag so the audio isn't moved unless the new tag is larger
+  Args:
+    info: The mutagen PaddingInfo of the tag
+  Returns:
+    The number of bytes of padding to write
+  """
+  return info.padding if info.padding >= 0 else info.get_default_padding()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/sources.py
+Brett Stevenson (c) 2018
+"""
+
+import os, time, shutil, sqlite3, hashlib, logging, tempfile, threading
+from colorama import Fore, Style
+from yt2mp3 import cache
+
+# Set to True to keep the downloaded audio of each video for later runs
+enabled = False
+# The default number of bytes of audio kept before the least recently used
+# downloads are evicted
+MAX_BYTES = 2*1024**3
+# The number of bytes of audio kept by the shared cache
+max_bytes = MAX_BYTES
+# The number of bytes hashed at a time
+CHUNK_SIZE = 1024*1024
+
+
+class Sources():
+  """
+  A class used to represent the downloaded audio kept between runs, indexed
+  by video ID and output format in SQLite along with the size and SHA-256
+  digest each download is verified against before it's reused
+  ...
+  Attributes
+  ----------
+  directory : str
+    The directory containing the downloads and their index
+  max_bytes : int
+    The total size of the downloads kept before the least recently used
+    are evicted
+  """
+  def __init__(self, directory, max_bytes=MAX_BYTES):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self._conn = None
+    self._lock = threading.Lock()
+
+
+  def _connect(self):
+    if self._conn is None:
+      os.makedirs(self.directory, exist_ok=True)
+      self._conn = sqlite3.connect(os.path.join(self.directory, 'sources.db'), timeout=10,
+                                   check_same_thread=False)
+      self._conn.execute('CREATE TABLE IF NOT EXISTS sources (key TEXT PRIMARY KEY, filename TEXT, '
+                         'size INTEGER, digest TEXT, codec TEXT, accessed REAL)')
+    return self._conn
+
+
+  def get(self, video_id, format):
+    """
+    Retrieves a download, removing it if it no longer matches its digest
+    Args:
+      video_id: The ID of the YouTube video
+      format: The output format the video was downloaded for
+    Returns:
+      A tuple of the path and audio codec of the download, or None if it
+      isn't cached
+    """
+    key = video_id+'|'+format
+    with self._lock:
+      row = self._connect().execute('SELECT filename, size, digest, codec FROM sources WHERE key = ?',
+                                    (key,)).fetchone()
+    if row is None:
+      return None
+    filename, size, digest, codec = row
+    path = os.path.join(self.directory, filename)
+    try:
+      valid = os.path.getsize(path) == size and get_digest(path) == digest
+    except OSError:
+      valid = False
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        if not valid:
+          conn.execute('DELETE FROM sources WHERE key = ?', (key,))
+        else:
+          conn.execute('UPDATE sources SET accessed = ? WHERE key = ?', (time.time(), key))
+    if not valid:
+      logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'The cached download of %s is corrupt', video_id)
+      _remove(path)
+      return None
+    return path, codec
+
+
+  def add(self, video_id, format, path, codec=None):
+    """
+    Moves a download into the cache, evicting the least recently used
+    downloads beyond the size cap
+    Args:
+      video_id: The ID of the YouTube video
+      format: The output format the video was downloaded for
+      path: The path of the downloaded file
+      codec: The audio codec of the download, if known
+    Returns:
+      The path of the cached download, or the original path if it's
+      larger than the cache
+    """
+    size = os.path.getsize(path)
+    if size > self.max_bytes:
+      return path
+    digest = get_digest(path)
+    os.makedirs(self.directory, exist_ok=True)
+    filename = '%s.%s%s' % (video_id, format, os.path.splitext(path)[1])
+    cached_path = os.path.join(self.directory, filename)
+    # Downloads only appear in the cache once they've been moved completely
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=self.directory)
+    os.close(fd)
+    try:
+      shutil.move(path, temp_path)
+      os.replace(temp_path, cached_path)
+    except OSError:
+      _remove(temp_path)
+      raise
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.execute('REPLACE INTO sources (key, filename, size, digest, codec, accessed) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (video_id+'|'+format, filename, size, digest, codec, time.time()))
+        rows = conn.execute('SELECT key, filename, size FROM sources ORDER BY accessed DESC').fetchall()
+        total, evicted = 0, list()
+        for key, name, length in rows:
+          total += length
+          if total > self.max_bytes:
+            evicted.append((key, name))
+        conn.executemany('DELETE FROM sources WHERE key = ?', [(key,) for key, _ in evicted])
+    for _, name in evicted:
+      _remove(os.path.join(self.directory, name))
+    return cached_path
+
+
+  def size(self):
+    """
+    Totals the size of the cached downloads
+    Returns:
+      The number of bytes
+    """
+    with self._lock:
+      return self._connect().execute('SELECT COALESCE(SUM(size), 0) FROM sources').fetchone()[0]
+
+
+  def clear(self):
+    """
+    Removes every cached download
+    """
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        names = [row[0] for row in conn.execute('SELECT filename FROM sources')]
+        conn.execute('DELETE FROM sources')
+    for name in names:
+      _remove(os.path.join(self.directory, name))
+
+
+  def close(self):
+    """
+    Closes the connection to the index
+    """
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
+
+
+def get_digest(path):
+  """
+  Hashes the contents of a file
+  Args:
+    path: The path of the file
+  Returns:
+    The hex SHA-256 digest
+  """
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _remove(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+_sources = None
+_sources_lock = threading.Lock()
+
+
+def get_sources():
+  """
+  Retrieves the cache of downloads shared by the program
+  Returns:
+    The Sources in the cache directory
+  """
+  global _sources
+  with _sources_lock:
+    if _sources is None:
+      _sources = Sources(os.path.join(cache.directory, 'sources'), max_bytes)
+    return _sources
+
+
+def get(video_id, format):
+  """
+  Retrieves a cached download when the source cache is enabled
+  Args:
+    video_id: The ID of the YouTube video
+    format: The output format the video was downloaded for
+  Returns:
+    A tuple of the path and audio codec of the download, or None
+  """
+  if not (enabled and cache.enabled):
+    return None
+  return get_sources().get(video_id, format)
+
+
+def add(video_id, format, path, codec=None):
+  """
+  Caches a download when the source cache is enabled
+  Args:
+    video_id: The ID of the YouTube video
+    format: The output format the video was downloaded for
+    path: The path of the downloaded file
+    codec: The audio codec of the download, if known
+  Returns:
+    The path the download should be converted from
+  """
+  if not (enabled and cache.enabled):
+    return path
+  try:
+    return get_sources().add(video_id, format, path, codec)
+  except OSError as err:
+    logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Unable to cache the download: %s', err)
+    return path
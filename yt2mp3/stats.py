@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/stats.py
+Brett Stevenson (c) 2018
+"""
+
+import time, json, threading, contextlib
+from collections import defaultdict
+
+_handlers = list()
+_local = threading.local()
+
+
+class Span():
+  """
+  A class used to represent a timed unit of work, such as a pipeline stage
+  or a single request
+  ...
+  Attributes
+  ----------
+  name : str
+    The name of the work, such as 'resolve' for a pipeline stage or
+    'youtube.search' for a request made by one
+  track : str
+    The label of the track the work was done for, if any
+  start : float
+    The time the work started, in seconds since the epoch
+  duration : float
+    The number of seconds the work took
+  bytes : int
+    The number of bytes downloaded or written by the work
+  error : str
+    The error the work failed with, if any
+  attrs : dict
+    Any additional values describing the work
+  """
+  def __init__(self, name, track=None, **attrs):
+    self.name = name
+    self.track = track
+    self.start = time.time()
+    self.duration = 0.0
+    self.bytes = 0
+    self.error = None
+    self.attrs = attrs
+
+
+def add_handler(handler):
+  """
+  Registers a function which is called with each completed Span
+  Args:
+    handler: A function taking a Span
+  """
+  _handlers.append(handler)
+
+
+def remove_handler(handler):
+  """
+  Unregisters a function added with add_handler
+  Args:
+    handler: The registered function
+  """
+  if handler in _handlers:
+    _handlers.remove(handler)
+
+
+def emit(span):
+  """
+  Passes a completed Span to each registered handler
+  Args:
+    span: The completed Span
+  """
+  for handler in list(_handlers):
+    handler(span)
+
+
+def current_track():
+  """
+  Retrieves the label of the track the current thread is working on
+  Returns:
+    The label set with tracking, if any
+  """
+  return getattr(_local, 'track', None)
+
+
+@contextlib.contextmanager
+def tracking(track):
+  """
+  Attributes the spans of the current thread to a track for the duration of
+  the context
+  Args:
+    track: The label of the track
+  """
+  previous = current_track()
+  _local.track = track
+  try:
+    yield
+  finally:
+    _local.track = previous
+
+
+def bind(func):
+  """
+  Wraps a function so that its spans are attributed to the current track
+  when it's called from another thread
+  Args:
+    func: The function to wrap
+  Returns:
+    The wrapped function
+  """
+  track = current_track()
+  def wrapper(*args, **kwargs):
+    with tracking(track):
+      return func(*args, **kwargs)
+  return wrapper
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+  """
+  Times the work done in the context and passes the resulting Span to the
+  registered handlers
+  Args:
+    name: The name of the work
+    attrs: Any additional values describing the work
+  Returns:
+    The Span, so the work can record its bytes and attributes
+  """
+  current = Span(name, current_track(), **attrs)
+  if not hasattr(_local, 'spans'):
+    _local.spans = list()
+  _local.spans.append(current)
+  start = time.perf_counter()
+  try:
+    yield current
+  except BaseException as err:
+    current.error = str(err) or type(err).__name__
+    raise
+  finally:
+    current.duration = time.perf_counter()-start
+    _local.spans.pop()
+    emit(current)
+
+
+def annotate(**attrs):
+  """
+  Adds values describing the work to the innermost span of the current
+  thread, if any
+  Args:
+    attrs: The values to add
+  """
+  spans = getattr(_local, 'spans', None)
+  if spans:
+    spans[-1].attrs.update(attrs)
+
+
+def percentile(values, percent):
+  """
+  Finds the value below which the specified percent of values fall
+  Args:
+    values: A list of numbers
+    percent: The percentile to find, from 0 to 100
+  Returns:
+    The nearest value, or None if there are no values
+  """
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values)-1, int(round(percent/100*(len(values)-1))))]
+
+
+class Report():
+  """
+  A class used to represent a span handler which collects the timings of a
+  run into a per-track and aggregate report
+  ...
+  Attributes
+  ----------
+  spans : list
+    The completed spans, in the order they were completed
+  """
+  def __init__(self):
+    self.spans = list()
+    self._start = time.time()
+    self._lock = threading.Lock()
+
+
+  def __call__(self, span):
+    with self._lock:
+      self.spans.append(span)
+
+
+  def to_dict(self):
+    """
+    Summarizes the collected spans
+    Returns:
+      A dict of the totals of each track and the count, total, p50 and p95
+      duration and bytes of each span name
+    """
+    with self._lock:
+      spans = list(self.spans)
+    tracks = defaultdict(lambda: {'title': None, 'spans': defaultdict(float), 'bytes': 0, 'errors': []})
+    durations = defaultdict(list)
+    sizes = defaultdict(int)
+    for span in spans:
+      durations[span.name].append(span.duration)
+      sizes[span.name] += span.bytes
+      if span.track is None:
+        continue
+      track = tracks[span.track]
+      track['title'] = span.attrs.get('title') or track['title']
+      track['spans'][span.name] += span.duration
+      track['bytes'] += span.bytes
+      if span.error:
+        track['errors'].append('%s: %s' % (span.name, span.error))
+    return {
+      'elapsed': time.time()-self._start,
+      'tracks': [dict(track, track=label, spans=dict(track['spans'])) for label, track in tracks.items()],
+      'spans': {name: {'count': len(values),
+                       'total': sum(values),
+                       'p50': percentile(values, 50),
+                       'p95': percentile(values, 95),
+                       'bytes': sizes[name]}
+                for name, values in durations.items()},
+    }
+
+
+  def write(self, path):
+    """
+    Writes the report as JSON
+    Args:
+      path: The path of the report file
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+      json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/sync.py
+Brett Stevenson (c) 2018
+"""
+
+import os, re, json, logging, tempfile, threading
+from colorama import Fore, Style
+from yt2mp3 import cache, library, video
+
+
+def get_path(playlist):
+  """
+  Determines the location of the manifest of a playlist
+  Args:
+    playlist: A YouTube playlist URL or ID
+  Returns:
+    The path of the manifest in the cache directory
+  """
+  playlist_id = playlist.split('list=')[-1].split('&')[0]
+  return os.path.join(cache.directory, 'playlists', re.sub(r'[^\w-]', '', playlist_id)+'.jsonl')
+
+
+class Manifest():
+  """
+  A class used to represent the videos of a playlist which have been
+  converted, stored as an append-only JSON-lines file so that an
+  interrupted sync keeps the songs it completed
+  ...
+  Attributes
+  ----------
+  path : str
+    The path of the manifest file
+  entries : dict
+    The output path, track, artist, album and title of each converted
+    video, keyed by video ID
+  """
+  def __init__(self, path):
+    self.path = path
+    self.entries = dict()
+    self._lock = threading.Lock()
+    if os.path.exists(path):
+      with open(path, encoding='utf-8') as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # Skip a line left incomplete by an interrupted run
+            continue
+          if entry.get('removed'):
+            self.entries.pop(entry['id'], None)
+          else:
+            self.entries[entry['id']] = entry
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self._file = open(path, 'a', encoding='utf-8')
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+  def _write(self, entry):
+    with self._lock:
+      if entry.get('removed'):
+        self.entries.pop(entry['id'], None)
+      else:
+        self.entries[entry['id']] = entry
+      self._file.write(json.dumps(entry)+'\n')
+      self._file.flush()
+
+
+  def contains(self, video_id):
+    """
+    Checks if a video has been converted and its song still exists
+    Args:
+      video_id: The ID of the YouTube video
+    Returns:
+      A bool indicating whether the video can be skipped
+    """
+    entry = self.entries.get(video_id)
+    return bool(entry and entry['path'] and os.path.exists(entry['path']))
+
+
+  def diff(self, videos, prune=False):
+    """
+    Compares the current videos of the playlist with the manifest
+    Args:
+      videos: An iterable of dicts containing the ID, URL and title of each
+        video in the playlist
+      prune: A bool specifying if the songs of videos which have been
+        removed from the playlist should be deleted
+    Returns:
+      A list of the videos which haven't been converted, in playlist order
+    """
+    videos = list(videos)
+    current = set(vid['id'] for vid in videos)
+    removed = [video_id for video_id in self.entries if video_id not in current]
+    new = [vid for vid in videos if not self.contains(vid['id'])]
+    logging.info('%s new, %s removed and %s unchanged songs in the playlist',
+                 len(new), len(removed), len(videos)-len(new))
+    if prune and removed:
+      self.prune(removed)
+      self.compact()
+    return new
+
+
+  def prune(self, video_ids):
+    """
+    Deletes the songs of videos which have been removed from the playlist
+    Args:
+      video_ids: An iterable of the IDs of the removed videos
+    """
+    for video_id in video_ids:
+      entry = self.entries.get(video_id)
+      if entry is None:
+        continue
+      if entry['path'] and os.path.exists(entry['path']):
+        os.remove(entry['path'])
+        logging.info(Fore.RED+'✘ '+Style.RESET_ALL+'Removed %s', entry['path'])
+        library.get_library().remove(entry['path'])
+      self._write({'id': video_id, 'removed': True})
+
+
+  def record(self, stage, item):
+    """
+    Adds a converted pipeline item to the manifest
+    Args:
+      stage: The name of the completed stage
+      item: The pipeline item
+    """
+    if stage != 'tag':
+      return
+    song = item['song']
+    self._write({'id': video.get_id(song.video_url), 'path': item['path'], 'track': song.track,
+                 'artist': song.artist, 'album': song.album, 'title': item['data']['video_title']})
+
+
+  def skip(self, stage, item, err):
+    """
+    Adds a pipeline item to the manifest when it's dropped because its song
+    already exists in the output directory
+    Args:
+      stage: The name of the stage which dropped or failed the item
+      item: The pipeline item
+      err: The error the stage raised, or None if the item was dropped
+    """
+    if err is not None or stage != 'resolve':
+      return
+    data = item['data']
+    path = library.get_library().find(data['artist_name'], data['track_name'], data['collection_name'])
+    if path:
+      self._write({'id': video.get_id(data['video_url']), 'path': path, 'track': data['track_name'],
+                   'artist': data['artist_name'], 'album': data['collection_name'],
+                   'title': data['video_title']})
+
+
+  def skip_owned(self, vid, path):
+    """
+    Adds a playlist video to the manifest when it's skipped because its song
+    is already in the library
+    Args:
+      vid: A dict containing the ID and title of the video
+      path: The path of the song in the library
+    """
+    if path:
+      self._write({'id': vid['id'], 'path': path, 'track': '', 'artist': '', 'album': '',
+                   'title': vid['title']})
+
+
+  def compact(self):
+    """
+    Rewrites the manifest with only its current entries
+    """
+    with self._lock:
+      self._file.close()
+      fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+      with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for entry in self.entries.values():
+          f.write(json.dumps(entry)+'\n')
+      os.replace(temp, self.path)
+      self._file = open(self.path, 'a', encoding='utf-8')
+
+
+  def close(self):
+    """
+    Closes the manifest file
+    """
+    self._file.close()
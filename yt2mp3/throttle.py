@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/throttle.py
+Brett Stevenson (c) 2018
+"""
+
+import re, time, random, threading
+
+ITUNES = 'itunes.apple.com'
+YOUTUBE = 'www.youtube.com'
+# The sustained requests per second and the burst of requests allowed for
+# each host, where hosts which aren't listed are only limited once they
+# start throttling
+RATES = {ITUNES: (20/60, 20), YOUTUBE: (2, 10)}
+# The HTTP statuses servers respond with when requests are being throttled
+THROTTLE_STATUS = (403, 429)
+# The number of times a throttled request is retried, and the initial and
+# maximum number of seconds waited before retrying
+RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# The maximum number of concurrent requests to each host
+CONCURRENCY = 8
+
+_hosts = dict()
+_lock = threading.Lock()
+
+
+class ThrottledError(ConnectionError):
+  """
+  Raised when a request is still being throttled after every retry
+  """
+
+
+class Host():
+  """
+  A class used to represent the requests made to a single host, limiting
+  their rate with a token bucket and their concurrency with an
+  additive-increase/multiplicative-decrease window which shrinks each time
+  the host throttles a request
+  ...
+  Attributes
+  ----------
+  name : str
+    The hostname
+  rate : float
+    The number of tokens added to the bucket per second, or None if the
+    rate isn't limited
+  burst : float
+    The maximum number of tokens in the bucket
+  concurrency : int
+    The largest the concurrency window can grow to
+  limit : float
+    The current number of requests allowed at the same time
+  throttled : int
+    The number of requests the host has throttled
+  """
+  def __init__(self, name, rate=None, burst=1, concurrency=CONCURRENCY):
+    self.name = name
+    self.rate = rate
+    self.burst = max(1, burst)
+    self.concurrency = max(1, concurrency)
+    self.limit = float(self.concurrency)
+    self.throttled = 0
+    self._tokens = float(self.burst)
+    self._active = 0
+    self._failures = 0
+    self._updated = time.monotonic()
+    self._resume = 0.0
+    self._cond = threading.Condition()
+
+
+  def _refill(self, now):
+    if self.rate:
+      self._tokens = min(self.burst, self._tokens+(now-self._updated)*self.rate)
+    self._updated = now
+
+
+  def acquire(self):
+    """
+    Waits until a request can be made to the host without exceeding its
+    rate, its concurrency window or a backoff period
+    """
+    with self._cond:
+      while True:
+        now = time.monotonic()
+        self._refill(now)
+        wait = self._resume-now
+        if self.rate and self._tokens < 1:
+          wait = max(wait, (1-self._tokens)/self.rate)
+        if wait <= 0 and self._active < int(self.limit):
+          break
+        # Released requests wake the waiting threads early
+        self._cond.wait(wait if wait > 0 else None)
+      if self.rate:
+        self._tokens -= 1
+      self._active += 1
+
+
+  def release(self, throttled=False, retry_after=None):
+    """
+    Completes a request, adjusting the concurrency window to its outcome
+    Args:
+      throttled: A bool specifying if the host throttled the request
+      retry_after: The number of seconds the host asked to wait, if any
+    Returns:
+      The number of seconds the host is backed off for
+    """
+    with self._cond:
+      self._active -= 1
+      delay = 0.0
+      if throttled:
+        self.throttled += 1
+        self._failures += 1
+        self.limit = max(1.0, self.limit/2)
+        if retry_after is None:
+          # Spread the retries of concurrent requests apart
+          delay = min(MAX_BACKOFF, BACKOFF*2**(self._failures-1))*random.uniform(0.5, 1)
+        else:
+          delay = min(MAX_BACKOFF, retry_after)
+        self._resume = max(self._resume, time.monotonic()+delay)
+      else:
+        self._failures = 0
+        # Grow the window by about one request for each full window
+        self.limit = min(self.concurrency, self.limit+1/self.limit)
+      self._cond.notify_all()
+      return delay
+
+
+def get_host(name):
+  """
+  Retrieves the limits shared by every request to a host
+  Args:
+    name: The hostname
+  Returns:
+    The Host
+  """
+  with _lock:
+    if name not in _hosts:
+      rate, burst = RATES.get(name, (None, 1))
+      _hosts[name] = Host(name, rate, burst)
+    return _hosts[name]
+
+
+def reset():
+  """
+  Drops the limits learned for each host
+  """
+  with _lock:
+    _hosts.clear()
+
+
+def get_hostname(url):
+  """
+  Extracts the hostname of a URL
+  Args:
+    url: The URL of a request
+  Returns:
+    The lowercase hostname
+  """
+  from urllib.parse import urlsplit
+  return (urlsplit(url).hostname or '').lower()
+
+
+def get_status(err):
+  """
+  Finds the HTTP status and Retry-After header of a failed request, looking
+  through the errors wrapped by youtube_dl
+  Args:
+    err: The error raised by the request
+  Returns:
+    A tuple of the status and the number of seconds to wait, either of
+    which is None if unknown
+  """
+  seen = set()
+  while err is not None and id(err) not in seen:
+    seen.add(id(err))
+    # The errors of requests and urllib respectively
+    response = getattr(err, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(err, 'code', None)
+    if isinstance(status, int):
+      headers = getattr(response, 'headers', None) or getattr(err, 'headers', None) or {}
+      retry_after = headers.get('Retry-After')
+      return status, float(retry_after) if retry_after and retry_after.isdigit() else None
+    match = re.search(r'HTTP Error (\d{3})', str(err))
+    if match:
+      return int(match.group(1)), None
+    exc_info = getattr(err, 'exc_info', None)
+    err = getattr(err, 'cause', None) or (exc_info[1] if exc_info else None) or err.__cause__
+  return None, None
+
+
+def is_throttled(err):
+  """
+  Checks if a request failed because the host is throttling requests
+  Args:
+    err: The error raised by the request
+  Returns:
+    A tuple of a bool indicating if the request was throttled and the
+    number of seconds the host asked to wait, if any
+  """
+  status, retry_after = get_status(err)
+  if status is not None:
+    return status in THROTTLE_STATUS, retry_after
+  # itunespy can't parse the error page the iTunes API responds with
+  return type(err) is ConnectionError, None
+
+
+def call(host, func, *args, **kwargs):
+  """
+  Makes a request within the limits of its host, retrying it with
+  exponential backoff while the host throttles it
+  Args:
+    host: The hostname the function sends its request to
+    func: The function making the request
+    args: The arguments of the function
+    kwargs: The keyword arguments of the function
+  Returns:
+    The result of the function
+  Raises:
+    ThrottledError: If the request is still throttled after every retry
+  """
+  limits = get_host(host)
+  for attempt in range(RETRIES+1):
+    limits.acquire()
+    try:
+      result = func(*args, **kwargs)
+    except Exception as err:
+      throttled, retry_after = is_throttled(err)
+      limits.release(throttled, retry_after)
+      if not throttled:
+        raise
+      if attempt == RETRIES:
+        raise ThrottledError('Requests to %s are being throttled: %s' % (host, err)) from err
+      continue
+    limits.release()
+    return result
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+yt2mp3
+A program that simplifies the process of searching, downloading and
+converting Youtube videos to MP3 files with embedded metadata via the
+iTunes API.
+yt2mp3/transcode.py
+Brett Stevenson (c) 2018
+"""
+
+import os, re, subprocess, tempfile, pydub
+from pydub.exceptions import CouldntDecodeError, CouldntEncodeError
+
+# The format of the raw audio passed between the decoder and encoder
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+CHUNK_SIZE = 64*1024
+PCM_ARGS = ['-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS)]
+# The extension, ffmpeg muxer and codecs of each output format, where audio
+# already encoded with one of the codecs is copied rather than re-encoded
+FORMATS = {
+  'mp3': ('.mp3', 'mp3', ('mp3',)),
+  'm4a': ('.m4a', 'ipod', ('aac', 'mp4a')),
+  'opus': ('.opus', 'opus', ('opus',)),
+}
+
+
+def stream(source, path, format='mp3', chunk_size=CHUNK_SIZE, observers=()):
+  """
+  Converts an audio/video file by streaming its decoded audio through the
+  encoder in fixed-size chunks, so memory use doesn't grow with its length
+  Args:
+    source: The path of the file to convert
+    path: The path of the converted file, or a binary file the encoded audio
+      is appended to without any metadata, so the caller can write its own
+    format: The output format passed to the encoder
+    chunk_size: The number of bytes of raw audio handled at a time
+    observers: A list of functions called with each chunk of raw audio
+  Returns:
+    The path or file of the converted audio
+  Raises:
+    CouldntDecodeError: If the source file can't be decoded
+    CouldntEncodeError: If the converted file can't be written
+  """
+  decode_cmd = [pydub.AudioSegment.converter, '-v', 'error', '-i', source, '-vn']+PCM_ARGS+['pipe:1']
+  output = None if isinstance(path, str) else path
+  with tempfile.TemporaryFile() as decode_err, tempfile.TemporaryFile() as encode_err:
+    decoder = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, stderr=decode_err)
+    encoder = _open_encoder(path, format, encode_err)
+    try:
+      while True:
+        chunk = decoder.stdout.read(chunk_size)
+        if not chunk:
+          break
+        for observer in observers:
+          observer(chunk)
+        encoder.stdin.write(chunk)
+    except BrokenPipeError:
+      pass
+    finally:
+      decoder.stdout.close()
+      encoder.stdin.close()
+      decoder.wait()
+      encoder.wait()
+    if decoder.returncode or encoder.returncode:
+      if output is None and os.path.exists(path):
+        os.remove(path)
+      if decoder.returncode:
+        decode_err.seek(0)
+        raise CouldntDecodeError('Decoding failed: '+decode_err.read().decode(errors='replace'))
+      encode_err.seek(0)
+      raise CouldntEncodeError('Encoding failed: '+encode_err.read().decode(errors='replace'))
+  return path
+
+
+def _open_encoder(path, format, stderr):
+  """
+  Starts an encoder reading raw audio from its stdin
+  Args:
+    path: The path of the encoded file, or a binary file the encoded audio
+      is appended to without any metadata
+    format: The output format passed to the encoder
+    stderr: The file the errors of the encoder are written to
+  Returns:
+    The encoder process
+  """
+  cmd = [pydub.AudioSegment.converter, '-v', 'error', '-y']+PCM_ARGS+['-i', 'pipe:0', '-f', format]
+  if isinstance(path, str):
+    return subprocess.Popen(cmd+[path], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+  # The encoder writes straight to the file from its current position
+  path.flush()
+  cmd += ['-id3v2_version', '0', 'pipe:1'] if format == 'mp3' else ['pipe:1']
+  return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=path, stderr=stderr)
+
+
+def split(source, outputs, format='mp3', chunk_size=CHUNK_SIZE):
+  """
+  Converts sections of an audio/video file into separate files while
+  decoding it once, passing each chunk of decoded audio to the encoders of
+  the sections it overlaps, so memory use doesn't grow with the length of
+  the file or the number of sections
+  Args:
+    source: The path of the file to convert
+    outputs: A list of tuples of the start and end of each section in
+      seconds, where an end of None continues to the end of the file, and
+      the path or binary file of the section as accepted by stream
+    format: The output format passed to the encoders
+    chunk_size: The number of bytes of raw audio handled at a time
+  Returns:
+    The list of the paths or files of the converted sections
+  Raises:
+    CouldntDecodeError: If the source file can't be decoded
+    CouldntEncodeError: If a section can't be written
+  """
+  frame = CHANNELS*SAMPLE_WIDTH
+  bounds = [(int(round(start*SAMPLE_RATE))*frame, None if end is None else int(round(end*SAMPLE_RATE))*frame)
+            for start, end, _ in outputs]
+  decode_cmd = [pydub.AudioSegment.converter, '-v', 'error', '-i', source, '-vn']+PCM_ARGS+['pipe:1']
+  errors = [tempfile.TemporaryFile() for _ in outputs]
+  active, done = dict(), dict()
+  try:
+    with tempfile.TemporaryFile() as decode_err:
+      decoder = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, stderr=decode_err)
+      position = 0
+      try:
+        for chunk in iter(lambda: decoder.stdout.read(chunk_size), b''):
+          end_position = position+len(chunk)
+          for i, (start, end) in enumerate(bounds):
+            if i in done or start >= end_position or (end is not None and end <= position):
+              continue
+            if i not in active:
+              active[i] = _open_encoder(outputs[i][2], format, errors[i])
+            active[i].stdin.write(chunk[max(0, start-position):None if end is None else end-position])
+            # Finish each section as soon as it's complete
+            if end is not None and end <= end_position:
+              done[i] = _close(active.pop(i))
+          position = end_position
+      except BrokenPipeError:
+        pass
+      finally:
+        decoder.stdout.close()
+        decoder.wait()
+        for i in list(active):
+          done[i] = _close(active.pop(i))
+      failed = [i for i, code in sorted(done.items()) if code]
+      if decoder.returncode or failed:
+        for _, _, path in outputs:
+          if isinstance(path, str) and os.path.exists(path):
+            os.remove(path)
+        if decoder.returncode:
+          decode_err.seek(0)
+          raise CouldntDecodeError('Decoding failed: '+decode_err.read().decode(errors='replace'))
+        errors[failed[0]].seek(0)
+        raise CouldntEncodeError('Encoding failed: '+errors[failed[0]].read().decode(errors='replace'))
+  finally:
+    for err in errors:
+      err.close()
+  return [path for _, _, path in outputs]
+
+
+def _close(encoder):
+  """
+  Waits for an encoder to finish the audio written to it
+  Returns:
+    The exit status of the encoder
+  """
+  try:
+    encoder.stdin.close()
+  except BrokenPipeError:
+    pass
+  return encoder.wait()
+
+
+def decode(source, observers, chunk_size=CHUNK_SIZE):
+  """
+  Streams the decoded audio of a file to observers without encoding it,
+  for analysing audio which is copied rather than transcoded
+  Args:
+    source: The path of the audio/video file
+    observers: A list of functions called with each chunk of raw audio
+    chunk_size: The number of bytes of raw audio handled at a time
+  Raises:
+    CouldntDecodeError: If the source file can't be decoded
+  """
+  cmd = [pydub.AudioSegment.converter, '-v', 'error', '-i', source, '-vn']+PCM_ARGS+['pipe:1']
+  with tempfile.TemporaryFile() as decode_err:
+    decoder = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=decode_err)
+    try:
+      for chunk in iter(lambda: decoder.stdout.read(chunk_size), b''):
+        for observer in observers:
+          observer(chunk)
+    finally:
+      decoder.stdout.close()
+      decoder.wait()
+    if decoder.returncode:
+      decode_err.seek(0)
+      raise CouldntDecodeError('Decoding failed: '+decode_err.read().decode(errors='replace'))
+
+
+def get_codec(source):
+  """
+  Finds the codec of the first audio stream of a file from the stream
+  information the converter prints
+  Args:
+    source: The path of the audio/video file
+  Returns:
+    The ffmpeg name of the codec, or None if it can't be determined
+  """
+  cmd = [pydub.AudioSegment.converter, '-hide_banner', '-i', source]
+  result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  match = re.search(r'Stream #\S+.*?: Audio: (\w+)', result.stderr.decode(errors='replace'))
+  return match.group(1) if match else None
+
+
+def can_copy(codec, format):
+  """
+  Checks if audio with the specified codec can be remuxed into an output
+  format without re-encoding
+  Args:
+    codec: The ffmpeg or youtube_dl name of the codec, such as 'opus' or
+      'mp4a.40.2'
+    format: An output format in FORMATS
+  Returns:
+    A bool indicating whether the audio can be copied
+  """
+  return bool(codec) and codec.split('.')[0].lower() in FORMATS[format][2]
+
+
+def remux(source, path, format):
+  """
+  Copies the first audio stream of a file into a new container without
+  decoding it
+  Args:
+    source: The path of the audio/video file
+    path: The path of the remuxed file
+    format: An output format in FORMATS
+  Returns:
+    The path of the remuxed file
+  Raises:
+    CouldntEncodeError: If the audio stream can't be copied
+  """
+  cmd = [pydub.AudioSegment.converter, '-v', 'error', '-y', '-i', source, '-vn', '-map', '0:a:0',
+         '-c:a', 'copy', '-map_metadata', '-1', '-f', FORMATS[format][1], path]
+  result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  if result.returncode:
+    if os.path.exists(path):
+      os.remove(path)
+    raise CouldntEncodeError('Remuxing failed: '+result.stderr.decode(errors='replace'))
+  return path
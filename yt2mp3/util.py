@@ -8,44 +8,92 @@ yt2mp3/util.py
 Brett Stevenson (c) 2018
 """
 
-import sys, os, youtube_dl, shutil, cursesmenu, logging
+import sys, os, logging, threading, itertools
 from collections import defaultdict
 from colorama import Fore, Style
-from yt2mp3 import itunes, video
+from yt2mp3 import itunes, library, scratch, stats, throttle, video
 
+# Serializes user prompts when songs are resolved concurrently
+_prompt_lock = threading.Lock()
 
-def get_song_data(data, collection=False):
+def get_input_data(track='', artist='', album='', url=''):
+  """
+  Builds the dict of values used to retrieve the song data
+  Args:
+    track: The track name query
+    artist: The artist name query
+    album: The album name query
+    url: A YouTube video URL or ID
+  Returns:
+    A dict of the provided values
+  """
+  data = defaultdict(str)
+  data['track_name'] = (track or '').strip()
+  data['artist_name'] = (artist or '').strip()
+  if album and album.strip():
+    data['collection_name'] = album.strip()
+  url = (url or '').strip()
+  if len(url) == 11:
+    url = 'https://www.youtube.com/watch?v='+url
+  data['video_url'] = url
+  return data
+
+
+def get_song_data(data, collection=False, interactive=True):
   """
   Employs a variety of methods for retrieving song data for the provided input
   Args:
     data: A dict of values provided by the user
     collection: A boolean representing whether an album has been specified
+    interactive: A boolean specifying if the user can be prompted for input
   Returns:
     A dict of the retrieved song data
+  Raises:
+    LookupError: If no song data is found and the user can't be prompted
   """
   if data['video_url']:
     url = data['video_url']
-    result = video.get_data(video.get_title(url))
+    result = video.get_data(data['video_title'] or video.get_title(url))
     if not result:
-      data['track_name'] = input(' Track: ')
-      data['artist_name'] = input(' Artist: ')
-      data['artwork_url_100'] = 'https://img.youtube.com/vi/'+url.split('watch?v=')[-1]+'/maxresdefault.jpg'
+      if not interactive:
+        raise LookupError('Unable to find song data for '+url)
+      with _prompt_lock:
+        data['track_name'] = input(' Track: ')
+        data['artist_name'] = input(' Artist: ')
+      data['artwork_url_100'] = 'https://img.youtube.com/vi/'+video.get_id(url)+'/maxresdefault.jpg'
       result = itunes.get_data(data, False)
     if result:
       data = defaultdict(str, result.__dict__)
       data['video_url'] = url
+      # Songs matched from the tags of the library have no cover-art URL
+      if not data['artwork_url_100']:
+        data['artwork_url_100'] = 'https://img.youtube.com/vi/'+video.get_id(url)+'/maxresdefault.jpg'
   elif data['artist_name'] and data['track_name']:
-    result = itunes.get_data(data)
+    result = itunes.get_data(data, interactive)
     if result:
       data = defaultdict(str, result.__dict__)
       data['video_url'] = video.get_url(data, collection)
+    elif not interactive:
+      raise LookupError('Unable to find song data for '+data['track_name']+' by '+data['artist_name'])
+  elif not interactive:
+    raise LookupError('A track and artist name or video URL are required')
   else:
-    songs = itunes.get_data(data)
     if data['track_name']:
+      songs = itunes.get_data(data)
       options = ['%-30.25s %10.25s' % (s.track_name, s.artist_name) for s in songs]
-    elif data['artist_name']:
-      options = [s.track_name for s in songs]
-    result = songs[show_menu(options)]
+    else:
+      songs = list()
+      # List the discography as each album is retrieved
+      def get_options():
+        for song in itunes.get_discography(data['artist_name']):
+          songs.append(song)
+          yield song.track_name
+      options = get_options()
+    try:
+      result = songs[show_menu(options)]
+    except LookupError as err:
+      logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+str(err))
+      sys.exit()
     data = defaultdict(str, result.__dict__)
     data['video_url'] = video.get_url(data, collection)
   return data
@@ -53,27 +101,87 @@ def get_song_data(data, collection=False):
 
 def get_video_list(url):
   """
-  Retrieves a list of video URL's from the playlist URL
+  Lazily expands the playlist URL into its videos, a page at a time, without
+  retrieving the full metadata of each video
   Args:
     url: A YouTube playlist URL
   Returns:
-    A list of individual URL's for each video in the playlist
+    A generator of dicts containing the ID, URL and title of each video
+  """
+  import youtube_dl
+  ydl = youtube_dl.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'})
+  with stats.span('youtube.playlist'):
+    results = throttle.call(throttle.YOUTUBE, ydl.extract_info, url, download=False, process=False)
+    # Follow redirects to the extractor handling the playlist
+    while results.get('_type') in ('url', 'url_transparent'):
+      results = throttle.call(throttle.YOUTUBE, ydl.extract_info, results['url'], download=False,
+                              process=False, ie_key=results.get('ie_key'))
+  for entry in results.get('entries') or []:
+    video_id = entry.get('id') or video.get_id(entry['url'])
+    yield {'id': video_id,
+           'url': 'https://www.youtube.com/watch?v='+video_id,
+           'title': entry.get('title') or ''}
+
+
+def skip_owned(videos, size=100, format=None, callback=None):
+  """
+  Drops the playlist videos which have already been converted, checking
+  the library a page at a time
+  Args:
+    videos: An iterable of dicts containing the ID of each video
+    size: The number of videos checked at a time
+    format: The output format the songs should be in, if any
+    callback: A function called with each dropped video and the path of
+      its song
+  Returns:
+    A generator of the videos which haven't been converted
   """
-  results = youtube_dl.YoutubeDL({'quiet': True}).extract_info(url, download=False)
-  return [i['webpage_url'] for i in results['entries']]
+  videos = iter(videos)
+  while True:
+    page = list(itertools.islice(videos, size))
+    if not page:
+      return
+    owned = library.get_library().owned((vid['id'] for vid in page), format)
+    if owned:
+      logging.info('Skipping %s songs already in the output directory', len(owned))
+    for vid in page:
+      if vid['id'] not in owned:
+        yield vid
+      elif callback:
+        callback(vid, library.get_library().find_video(vid['id'], format))
 
 
 def show_menu(options):
   """
-  Displays an interactive menu of matching song entries
+  Displays an interactive menu of matching song entries, adding the entries
+  which are still being retrieved as they arrive
   Args:
-    options: A list of potential matches from the iTunes API
+    options: An iterable of potential matches from the iTunes API
   Returns:
     The index of the menu entry selected by the user
   """
-  menu = cursesmenu.SelectionMenu(options, title='Select an song')
-  selection = menu.get_selection(options)
-  if selection >= len(options):
+  import cursesmenu
+  from cursesmenu.items import SelectionItem
+  options = iter(options)
+  shown = list(itertools.islice(options, 1))
+  menu = cursesmenu.SelectionMenu(shown, title='Select an song')
+  menu.start()
+  error = None
+  try:
+    for option in options:
+      # Stop adding entries once the user has made a selection
+      if not menu.is_alive():
+        break
+      menu.append_item(SelectionItem(option, len(shown), menu))
+      shown.append(option)
+  except Exception as err:
+    # Let the user pick from the entries already shown
+    error = err
+  menu.join()
+  if error is not None:
+    logging.warning(Fore.RED+'✘ '+Style.RESET_ALL+'Unable to retrieve the remaining songs: %s', error)
+  selection = menu.selected_option
+  if selection < 0 or selection >= len(shown):
     sys.exit()
   return selection
 
@@ -95,12 +203,6 @@ def show_progressbar(status):
 
 def cleanup():
   """
-  Cleans up temporary directories/files used by the program
+  Cleans up the temporary files created by the current run
   """
-  directory = os.path.expanduser('~/Downloads/Music/')
-  video_dir = os.path.join(directory, 'temp/')
-  cover_dir = os.path.join(directory, 'CoverArt/')
-  if os.path.isdir(video_dir):
-    shutil.rmtree(video_dir)
-  if os.path.isdir(cover_dir):
-    shutil.rmtree(cover_dir)
+  scratch.cleanup()
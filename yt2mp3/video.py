@@ -8,64 +8,163 @@ yt2mp3/video.py
 Brett Stevenson (c) 2018
 """
 
-import sys, re, youtube_dl, urllib, ssl, string
-from urllib.request import Request, urlopen
-from collections import defaultdict
-from bs4 import BeautifulSoup
-from yt2mp3 import itunes
+import sys, re, urllib.parse, string, threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
+from yt2mp3 import cache, catalog, itunes, net, stats, throttle
 
-def get_url(data, collection=False):
+# Video info fields kept in the persistent cache
+INFO_KEYS = ('id', 'title', 'duration', 'uploader', 'webpage_url', 'thumbnail', 'chapters')
+INFO_TTL = 7*24*60*60
+# The number of candidate videos checked concurrently
+PROBE_JOBS = 4
+# The number of videos whose info is kept in memory
+MEMO_SIZE = 128
+# The number of locks shared by the videos being probed, so that each video
+# is only probed once at a time without a lock for every video
+INFO_LOCKS = 64
+
+_info = OrderedDict()
+_info_locks = [threading.Lock() for _ in range(INFO_LOCKS)]
+_info_lock = threading.Lock()
+_info_store = cache.Store('video_info', INFO_TTL)
+
+def get_url(data, collection=False, jobs=None):
   """
   Scrapes YouTube for a video matching the user input and iTunes track data
   Args:
     data: A dict of values provided by the user
     collection: A boolean representing whether an album has been specified
+    jobs: The number of candidate videos to check concurrently
   Returns:
     The URL of a YouTube video matching the provided values
   """
-  query = urllib.parse.quote(data['track_name']+' '+data['artist_name'])
-  url = 'https://www.youtube.com/results?search_query='+query
-  req = Request(url, headers={'User-Agent':'Mozilla/5.0'})
-  response = urlopen(req, context=ssl.create_default_context())
-  soup = BeautifulSoup(response.read(), 'lxml')
+  candidates = search(data['track_name']+' '+data['artist_name'])
+  if not candidates:
+    return None
+  # Check that the video time and album are similar to the track data
+  if 'track_time' in data.keys() or collection:
+    url = select(candidates, lambda url: is_match(url, data, collection), jobs or PROBE_JOBS)
+    if url:
+      return url
+  return candidates[0]
+
+
+def search(query):
+  """
+  Scrapes the YouTube search results for the provided query
+  Args:
+    query: A string containing the search keywords
+  Returns:
+    A list of the valid video URLs, in the order they were ranked
+  """
+  from bs4 import BeautifulSoup
+  url = 'https://www.youtube.com/results?search_query='+urllib.parse.quote(query)
+  with stats.span('youtube.search') as span:
+    content = net.get(url).content
+    span.bytes = len(content)
+  soup = BeautifulSoup(content, 'lxml')
   results = list()
   for vid in soup.findAll(attrs={'class':'yt-uix-tile-link'}):
     url = 'https://www.youtube.com' + vid['href']
     if validate_url(url):
-      # Check that video time is similar to the track time
-      if 'track_time' in data.keys():
-        target = data['track_time']//1000
-        vid_time = youtube_dl.YoutubeDL({'quiet': True}).extract_info(url, download=False)['duration']
-        if abs(target-vid_time) < 20:
-          if collection:
-            video_data = defaultdict(str, get_metadata(url))
-            if data['collection_name'].lower() in video_data['album'].lower():
-              return url
-          else:
-            return url
-      # Check video metadata if album has been specified by user
-      elif collection:
-        video_data = defaultdict(str, get_metadata(url))
-        if data['collection_name'].lower() in video_data['album'].lower():
-          return url
-      return url
+      results.append(url)
+  return results
+
+
+def is_match(url, data, collection=False):
+  """
+  Checks if a video matches the iTunes track data
+  Args:
+    url: A YouTube video URL
+    data: A dict of values provided by the user
+    collection: A boolean representing whether an album has been specified
+  Returns:
+    A bool indicating whether the video matches the track
+  """
+  if 'track_time' in data.keys():
+    target = data['track_time']//1000
+    if abs(target-get_info(url)['duration']) >= 20:
+      return False
+  # Check video metadata if album has been specified by user
+  if collection:
+    video_data = defaultdict(str, get_metadata(url))
+    return data['collection_name'].lower() in video_data['album'].lower()
+  return True
+
+
+def select(candidates, accept, jobs=None):
+  """
+  Checks the candidates concurrently and returns the highest ranked one that
+  is accepted, as soon as every candidate ranked above it has been rejected.
+  The checks which haven't started by then are skipped, while those already
+  running finish in the background
+  Args:
+    candidates: A list of candidates, in the order they were ranked
+    accept: A function which checks a candidate
+    jobs: The number of candidates to check concurrently
+  Returns:
+    The highest ranked accepted candidate, or None if none are accepted
+  """
+  done = threading.Event()
+  def check(candidate):
+    # Avoid any requests once a candidate has been selected
+    if done.is_set():
+      return False
+    return accept(candidate)
+  executor = ThreadPoolExecutor(max_workers=max(1, jobs or PROBE_JOBS))
+  futures = [executor.submit(stats.bind(check), candidate) for candidate in candidates]
+  try:
+    for candidate, future in zip(candidates, futures):
+      try:
+        if future.result():
+          return candidate
+      except Exception:
+        continue
+  finally:
+    done.set()
+    for future in futures:
+      future.cancel()
+    executor.shutdown(wait=False)
+  return None
 
 
 def get_data(title):
   """
-  Attempts to retrieve song data from the video title
+  Attempts to retrieve song data from the video title, using the local
+  catalog when it has a confident match
   Args:
     title: A string containing the title of the YouTube video
   Returns:
     A dict of song data if a match is found using the iTunes APi
   """
-  # Remove parenthesis, punctuation and nondescript words
+  keywords = get_keywords(title)
+  songs = catalog.get_catalog()
+  if songs:
+    with stats.span('catalog.match'):
+      result = songs.match(keywords)
+    if result:
+      return result
+  # Query iTunes API
+  result = itunes.keyword_search(keywords)
+  if songs and result:
+    songs.add([result])
+  return result
+
+
+def get_keywords(title):
+  """
+  Cleans a video title into search keywords
+  Args:
+    title: A string containing the title of the YouTube video
+  Returns:
+    A string of the title without parenthesis, punctuation and nondescript
+    words
+  """
   pattern = r'\([^)]*\)|\[[^]]*\]|ft(\.)?|feat(\.)?|\blyrics?\b|official|video|audio|h(d|q)'
   keywords = re.sub(pattern, '', str(title), flags=re.I)
   keywords = keywords.translate(str.maketrans('', '', string.punctuation))
-  keywords = ' '.join(keywords.split())
-  # Query iTunes API
-  return itunes.keyword_search(keywords)
+  return ' '.join(keywords.split())
 
 
 def get_title(url):
@@ -76,7 +175,78 @@ def get_title(url):
   Returns:
     A string containing the title of the provided YouTube video
   """
-  return youtube_dl.YoutubeDL({'quiet': True}).extract_info(url, download=False)['title']
+  return get_info(url)['title']
+
+
+def get_id(url):
+  """
+  Retrieves the ID of the provided YouTube video
+  Args:
+    url: A YouTube video URL or ID
+  Returns:
+    A string containing the 11 character video ID
+  """
+  match = re.search(r'(?:v=|youtu\.be\/)([a-zA-Z0-9_\-]{11})', str(url))
+  return match.group(1) if match else str(url)
+
+
+def get_info(url, formats=False):
+  """
+  Retrieves the youtube_dl info of the provided YouTube video, probing each
+  video at most once per run and reusing cached info from previous runs
+  Args:
+    url: A YouTube video URL
+    formats: A bool specifying if the downloadable formats are required
+  Returns:
+    A dict containing the video info
+  """
+  import youtube_dl
+  video_id = get_id(url)
+  with _info_locks[hash(video_id) % len(_info_locks)]:
+    with _info_lock:
+      info = _info.get(video_id)
+      if info:
+        _info.move_to_end(video_id)
+    if info and (not formats or 'formats' in info):
+      return info
+    if not formats:
+      info = _info_store.get(video_id)
+      if info:
+        _remember(video_id, info)
+        return info
+    with stats.span('youtube.info'):
+      info = throttle.call(throttle.YOUTUBE, youtube_dl.YoutubeDL({'quiet': True}).extract_info,
+                           url, download=False, process=False)
+    fields = {key: info[key] for key in INFO_KEYS if key in info}
+    _info_store.set(video_id, fields)
+    # Only keep the formats of a video which is about to be downloaded
+    if not formats:
+      info = fields
+    _remember(video_id, info)
+    return info
+
+
+def _remember(video_id, info):
+  """
+  Keeps the info of a video in memory, evicting the least recently used
+  """
+  with _info_lock:
+    _info[video_id] = info
+    _info.move_to_end(video_id)
+    while len(_info) > MEMO_SIZE:
+      _info.popitem(last=False)
+
+
+def discard_formats(url):
+  """
+  Releases the downloadable formats of a video once they're no longer needed
+  Args:
+    url: A YouTube video URL
+  """
+  with _info_lock:
+    info = _info.get(get_id(url))
+    if info and 'formats' in info:
+      _info[get_id(url)] = {key: info[key] for key in INFO_KEYS if key in info}
 
 
 def get_metadata(url):
@@ -87,9 +257,11 @@ def get_metadata(url):
   Returns:
     A dict of the retrieved song data
   """
-  req = Request(url, headers={'User-Agent':'Mozilla/5.0'})
-  response = urlopen(req, context=ssl.create_default_context())
-  soup = BeautifulSoup(response.read(), 'lxml')
+  from bs4 import BeautifulSoup
+  with stats.span('youtube.metadata') as span:
+    content = net.get(url).content
+    span.bytes = len(content)
+  soup = BeautifulSoup(content, 'lxml')
   section = soup.find('ul', attrs={'class': 'watch-extras-section'})
   video_data = {}
   for item in section.find_all('li', recursive=False):